@@ -52,128 +52,4366 @@ if sys.platform == "win32" and hasattr(os, "add_dll_directory"):
 import subprocess
 import glob
 import re # For parsing progress
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-def find_first_mp3(input_dir):
-    """Finds the first .mp3 file in the specified directory."""
-    mp3_files = glob.glob(os.path.join(input_dir, "*.mp3"))
-    if not mp3_files:
-        mp3_files = glob.glob(os.path.join(input_dir, "*.MP3")) # Case-insensitive check
-    if mp3_files:
-        return mp3_files[0]
+import time
+import json
+import hashlib
+import argparse
+import contextlib
+import multiprocessing
+import queue
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+# Model and stem layout used by both the demucs CLI run and the in-process batch mode
+DEMUCS_MODEL_NAME = "htdemucs"
+TWO_STEMS = "vocals"
+# htdemucs' sample rate and channel count, for decoding tracks before any model is loaded
+DEMUCS_SAMPLERATE = 44100
+DEMUCS_CHANNELS = 2
+# Encoder settings for the stems we keep; also part of the separation cache key
+MP3_CODEC = "libmp3lame"
+MP3_BITRATE = "320k"
+
+# Formats a stem can be kept in by the output plan (see parse_output_plan()), as encoder profiles:
+# the ffmpeg encoder, the bitrate range it takes (kbps) and its default, and the sample rate it
+# needs if it can't take the model's. --benchmark-profiles measures what each costs to encode,
+# store and decode, so the host can pick per machine.
+OUTPUT_PROFILES = {
+    "mp3": {"codec": MP3_CODEC, "bitrates": (8, 320), "bitrate": MP3_BITRATE, "samplerate": None},
+    "ogg": {"codec": "libvorbis", "bitrates": (45, 500), "bitrate": "192k", "samplerate": None},
+    "opus": {"codec": "libopus", "bitrates": (6, 510), "bitrate": "128k", "samplerate": 48000},
+    "wav": {"codec": "pcm_s16le", "bitrates": None, "bitrate": None, "samplerate": None},
+}
+OUTPUT_FORMATS = tuple(OUTPUT_PROFILES)
+# The game only uses the vocals, so that is all we keep unless told otherwise
+DEFAULT_OUTPUT_PLAN = f"{TWO_STEMS}:mp3:{MP3_BITRATE}"
+
+# Bump when anything that changes the cached output changes without being in the key
+SEPARATION_CACHE_VERSION = 1
+DEFAULT_CACHE_MAX_MB = 2048
+
+# Intra-track parallelism (see SegmentPool): segment length and the crossfade between neighbours
+DEFAULT_SEGMENT_SECONDS = 60.0
+SEGMENT_CROSSFADE_SECONDS = 1.0
+# With shifts=0, segmented output must match a single pass to at least this SDR (checked by --benchmark-workers)
+SEGMENT_MATCH_MIN_SDR_DB = 60.0
+BENCHMARK_WORKER_COUNTS = (1, 2, 4, 8)
+
+# Inter-track parallelism (--jobs): each job needs a few cores to be worthwhile and enough RAM
+# for its own model plus a full-length track and its stems
+MIN_THREADS_PER_JOB = 2
+SEPARATION_JOB_RAM_BYTES = 3 * 1024 ** 3
+
+# Task kinds tracked by CpuBudget; libmp3lame is single-threaded, so each encode gets one core,
+# and so does each analysis of a finished track (NumPy's FFTs run on one thread)
+CPU_BUDGET_KINDS = ("separate", "encode", "analyze")
+ENCODER_THREADS = 1
+
+# MP3 encoders (--mp3-encoder): "lame" encodes in this process through the optional lameenc
+# package, so no ffmpeg process is spawned per stem; "ffmpeg" is the fallback when it isn't
+# installed. "auto" picks lame when it can.
+MP3_ENCODERS = ("auto", "lame", "ffmpeg")
+# LAME's default quality, which is also what ffmpeg's libmp3lame runs at
+LAME_QUALITY = 3
+# Frames handed to the in-process encoder at a time, so a stem is never copied whole
+LAME_BLOCK_FRAMES = 10 * 44100
+# What the in-process encoder writes: MPEG-1 Layer III, in header index order
+MP3_BITRATES_KBPS = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+MP3_SAMPLERATES = (44100, 48000, 32000)
+# LAME's encoder delay, recorded in the Info frame so decoders trim it and stems stay in sync
+LAME_ENCODER_DELAY = 576
+ENCODER_BENCHMARK_SECONDS = 30.0
+ENCODER_BENCHMARK_TRACKS = 8
+# Different LAME builds don't make bit-identical choices, so lameenc's MP3s are held to ffmpeg's
+# quality against the source instead: at most this much lower SDR
+ENCODER_MAX_SDR_LOSS_DB = 1.0
+# --benchmark-profiles decodes each output this many times and keeps the fastest
+PROFILE_DECODE_RUNS = 3
+FFMPEG_BENCH_RTIME_RE = re.compile(r"bench: utime=[\d.]+s stime=[\d.]+s rtime=([\d.]+)s")
+
+# Per-track progress manifest kept next to the output folder so interrupted runs can resume
+JOB_MANIFEST_NAME = "job_manifest.json"
+JOB_MANIFEST_VERSION = 1
+MANIFEST_STATES = ("queued", "separated", "encoded", "finalized")
+# How often the parent applies manifest updates forwarded by --jobs worker processes
+MANIFEST_FORWARD_POLL_SECONDS = 0.5
+
+# Watch mode: quiet time before a dropped file counts as fully written, how long to trust a
+# writer that never closed its file, rescan interval, and the length of the warm-up separation
+WATCH_DEBOUNCE_SECONDS = 2.0
+WATCH_CLOSED_SETTLE_SECONDS = 0.3
+WATCH_OPEN_FILE_TIMEOUT_SECONDS = 60.0
+WATCH_POLL_SECONDS = 1.0
+WATCH_WARMUP_SECONDS = 1.0
+# Outputs are encoded here (inside the output folder, so publishing is a same-disk rename)
+OUTPUT_STAGING_DIR = ".staging"
+# inotify event bits from <sys/inotify.h>
+INOTIFY_IN_MODIFY = 0x00000002
+INOTIFY_IN_CLOSE_WRITE = 0x00000008
+INOTIFY_IN_MOVED_TO = 0x00000080
+INOTIFY_IN_CREATE = 0x00000100
+
+# Demucs progress lines, compiled once instead of on every stderr line
+TQDM_PERCENT_RE = re.compile(r"(\d{1,3}(?:\.\d{1,2})?%)\s*\|")
+TQDM_SEGMENT_RE = re.compile(r"(\d+)/(\d+)\s*\[")
+SEGMENT_COUNT_RE = re.compile(r"Segment\s+(\d+)/(\d+)", re.IGNORECASE)
+DIRECT_PERCENT_RE = re.compile(r"(\d{1,3}(?:\.\d{1,2})?%)")
+TQDM_PROGRESS_RE = re.compile(r"(\d{1,3}(?:\.\d+)?)%\|[^|]*\|\s*([\d.]+)/([\d.]+)")
+# Cap on structured progress events per second (--progress-rate)
+DEFAULT_PROGRESS_RATE = 4.0
+
+# ETA predictions from the run history: runs used per fit, runs needed before a fit is trusted,
+# history size that triggers trimming, and (fixed seconds, seconds per audio second) per stage
+# until this host has enough history of its own
+ETA_HISTORY_MAX_RUNS = 200
+ETA_MIN_RUNS_TO_FIT = 3
+ETA_HISTORY_MAX_BYTES = 1024 * 1024
+ETA_PRIOR_STAGE_MODELS = {
+    "decode": (0.2, 0.01),
+    "separate": (8.0, 0.6),
+    "encode": (0.3, 0.03),
+    "finalize": (0.1, 0.0),
+}
+CLI_ETA_STAGES = ("separate", "encode", "finalize")
+BATCH_ETA_STAGES = ("decode", "separate", "encode", "finalize")
+FFMPEG_DURATION_RE = re.compile(r"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)")
+# Container and first audio stream in ffmpeg's header dump, e.g. "Input #0, flac, from '...'"
+# and "Stream #0:0: Audio: flac, 44100 Hz, stereo, s16"
+FFMPEG_INPUT_FORMAT_RE = re.compile(r"Input #0, (.+?), from '")
+FFMPEG_AUDIO_STREAM_RE = re.compile(r"Stream #0:\d+\S*: Audio: (\w+)[^\n]*?, (\d+) Hz, ([^,\n]+)")
+
+# Progressive mode (--preview): length of the early preview and its manifest's file suffix
+PREVIEW_SECONDS = 45.0
+PREVIEW_MANIFEST_SUFFIX = ".preview.json"
+
+# Separation model precisions (--precision), and the synthetic-fixture check (--check-precision)
+# that measures what int8/bfloat16 cost in quality against fp32
+PRECISIONS = ("fp32", "int8", "bf16")
+PRECISION_CHECK_SECONDS = 20.0
+PRECISION_CHECK_SEED = 1234
+PRECISION_MIN_SDR_DB = 20.0
+
+# Separation backends (--backend): the Demucs CLI subprocess is the reference, "torch", "compiled"
+# (AOTInductor) and "onnx" separate in this process. Compiled and ONNX exports are built once and
+# kept under the user cache; --benchmark-backends times each backend on a synthetic fixture of this length
+SEPARATION_BACKENDS = ("cli", "torch", "compiled", "onnx")
+ONNX_EXPORT_OPSET = 17
+MODEL_EXPORT_VERSION = 1
+MODEL_EXPORT_METADATA = "export.json"
+BACKEND_BENCHMARK_SECONDS = 20.0
+BACKEND_MATCH_MIN_SDR_DB = 40.0
+# Worker counts --benchmark-memory measures, with private and with memory-mapped shared weights,
+# and how long a worker waits for the others before giving up
+MEMORY_BENCHMARK_WORKER_COUNTS = (1, 2, 4)
+MEMORY_BENCHMARK_TIMEOUT_SECONDS = 600.0
+# Windowed separation (--windowed) decodes in blocks of this length and keeps one window of audio
+# in memory at a time; --check-windowed separates an hour of synthetic audio and fails if the
+# process's peak RSS goes over the ceiling
+WINDOW_DECODE_BLOCK_SECONDS = 5.0
+WINDOWED_CHECK_SECONDS = 3600.0
+WINDOWED_RSS_CEILING_MB = 3072
+# Silence skipping (--skip-silence): frames quieter than the threshold count as silent, and a
+# silence is left out of separation when at least SILENCE_MIN_SECONDS of it remain once the
+# model's context around the audio on either side is kept
+SILENCE_FRAME_SECONDS = 0.05
+SILENCE_THRESHOLD_DB = -60.0
+SILENCE_MIN_SECONDS = 2.0
+# Vocal pitch contour written next to each vocals output (see write_vocal_pitch()): YIN over
+# the vocals downmixed to mono at PITCH_SAMPLERATE, one frame centred every PITCH_HOP_SECONDS,
+# computed PITCH_FRAMES_PER_BLOCK frames at a time. Frames quieter than PITCH_SILENCE_DB or
+# without a dip below PITCH_YIN_THRESHOLD in the normalised difference are unvoiced.
+PITCH_SAMPLERATE = 16000
+PITCH_HOP_SECONDS = 0.01
+PITCH_WINDOW_SECONDS = 0.032
+PITCH_MIN_HZ = 65.0
+PITCH_MAX_HZ = 1100.0
+PITCH_YIN_THRESHOLD = 0.15
+PITCH_SILENCE_DB = -50.0
+PITCH_FRAMES_PER_BLOCK = 1024
+# "<track> [vocals].pitch" layout, little-endian so it can be memory-mapped as is: the header
+# (magic, version, header size, sample rate, hop and window in samples, frame count), then one
+# float32 f0 in Hz per frame (0 where unvoiced), then one uint8 confidence (0-255) per frame.
+# Frame i is centred on sample i * hop.
+PITCH_FILE_SUFFIX = ".pitch"
+PITCH_FILE_MAGIC = b"YPCH"
+PITCH_FILE_VERSION = 1
+PITCH_FILE_HEADER = struct.Struct("<4sHHIIII")
+# Waveform peak pyramid written next to each track's outputs (see write_track_peaks()): min/max
+# pairs over PEAKS_BASE_SAMPLES samples (all channels) at level 0, PEAKS_LEVEL_FACTOR times
+# coarser at each level above, up to a single peak for the whole track. Level 0 is reduced
+# PEAKS_BLOCK_PEAKS peaks at a time straight from the decoded PCM, the levels above from it.
+PEAKS_BASE_SAMPLES = 256
+PEAKS_LEVEL_FACTOR = 4
+PEAKS_BLOCK_PEAKS = 1024
+# "<track>.peaks" layout, little-endian: the header (magic, version, header size, sample rate,
+# length in samples, PEAKS_BASE_SAMPLES, PEAKS_LEVEL_FACTOR, level count, source count), one
+# uint32 peak count per level, then for each source (the original, then the vocals if kept)
+# and each level from the finest, count int8 (min, max) pairs scaled to +-127 and rounded
+# outwards so a peak is never drawn smaller than it is.
+PEAKS_FILE_SUFFIX = ".peaks"
+PEAKS_FILE_MAGIC = b"YPKS"
+PEAKS_FILE_VERSION = 1
+PEAKS_FILE_HEADER = struct.Struct("<4sHHIIIHBB")
+
+# Tracks allowed to wait between batch pipeline stages; each waiting track holds its audio in RAM
+PIPELINE_QUEUE_DEPTH = 1
+
+def input_candidates(input_dir):
+    """Files in the input directory that could be tracks, sorted by name; hidden files are left alone."""
+    return sorted(path for path in glob.glob(os.path.join(input_dir, "*"))
+                  if os.path.isfile(path) and not os.path.basename(path).startswith("."))
+
+def find_first_audio(input_dir, ffmpeg_exe_path="ffmpeg"):
+    """
+    Finds the first file in the specified directory that ffmpeg can decode audio from, whatever
+    its extension (MP3, FLAC, Opus, M4A, WAV, ...).
+    """
+    for path in input_candidates(input_dir):
+        if probe_audio(path, ffmpeg_exe_path):
+            return path
+        print(f"Skipping '{os.path.basename(path)}': not an audio file ffmpeg can read.")
+    return None
+
+def find_all_audio(input_dir, ffmpeg_exe_path="ffmpeg"):
+    """Finds every file in the specified directory that ffmpeg can decode audio from, sorted by name."""
+    candidates = input_candidates(input_dir)
+    if not candidates:
+        return []
+    with ThreadPoolExecutor(max_workers=min(len(candidates), os.cpu_count() or 1)) as executor:
+        probes = list(executor.map(lambda path: probe_audio(path, ffmpeg_exe_path), candidates))
+    for path, info in zip(candidates, probes):
+        if not info:
+            print(f"Skipping '{os.path.basename(path)}': not an audio file ffmpeg can read.")
+    return [path for path, info in zip(candidates, probes) if info]
+
+def parse_demucs_progress(line):
+    """
+    Parses a line of Demucs output to find progress percentage.
+    Returns percentage as a string (e.g., "75.3%") or None.
+    """
+    if "%" not in line and "/" not in line:
+        return None
+    match_tqdm_percent = TQDM_PERCENT_RE.search(line)
+    if match_tqdm_percent:
+        return match_tqdm_percent.group(1)
+
+    match_tqdm_segment = TQDM_SEGMENT_RE.search(line)
+    if not match_tqdm_segment:
+        match_tqdm_segment = SEGMENT_COUNT_RE.search(line)
+    
+    if match_tqdm_segment:
+        try:
+            done = int(match_tqdm_segment.group(1))
+            total = int(match_tqdm_segment.group(2))
+            if total > 0:
+                percentage = (done / total) * 100
+                return f"{percentage:.1f}%"
+        except ValueError:
+            pass
+            
+    match_direct_percent = DIRECT_PERCENT_RE.search(line)
+    if match_direct_percent:
+        return match_direct_percent.group(1)
+        
     return None
 
-def parse_demucs_progress(line):
+class ProgressChannel:
+    """
+    Machine-readable progress for the host app: one JSON object per line on a file descriptor
+    or TCP socket, instead of "Progress: NN%" text. Each event carries the stage, the fraction
+    of that stage done, audio seconds processed, throughput (audio seconds per wall second) and
+    an ETA for the stage, plus the whole job's remaining time when a JobEta is set. At most `max_rate` events per second are written; stage changes and
+    0%/100% events always go through.
+    """
+
+    def __init__(self, stream, max_rate=DEFAULT_PROGRESS_RATE, closer=None):
+        self.stream = stream
+        self.min_interval = 1.0 / max_rate if max_rate > 0 else 0.0
+        self._closer = closer
+        self._lock = threading.Lock()
+        self._last_emit = 0.0
+        self._opened = time.time()
+        self._current = None  # (track, stage) of the last event
+        self._stage_starts = {}  # (track, stage) -> when it started, for stages still running
+
+    @classmethod
+    def open(cls, fd=None, address=None, max_rate=DEFAULT_PROGRESS_RATE):
+        """Opens a channel on an inherited file descriptor or a "host:port" TCP address."""
+        if fd is not None:
+            return cls(os.fdopen(fd, "w", buffering=1, encoding="utf-8", closefd=False), max_rate)
+        import socket
+        host, _, port = address.rpartition(":")
+        connection = socket.create_connection((host or "127.0.0.1", int(port)))
+        return cls(connection.makefile("w", buffering=1, encoding="utf-8"), max_rate,
+                   closer=connection.close)
+
+    def emit(self, stage, fraction, audio_seconds=None, audio_seconds_total=None, track=None, **extra):
+        """Writes one progress event unless the rate cap says it's too soon after the last one."""
+        now = time.time()
+        fraction = max(0.0, min(1.0, fraction))
+        with self._lock:
+            if self.stream is None:
+                return
+            if track is None and self._current and self._current[1] == stage:
+                # Sub-steps that don't know their track (e.g. SegmentPool) belong to the current one
+                track = self._current[0]
+            key = (track, stage)
+            if key not in self._stage_starts:
+                # Stages first heard of part-way through (like the whole batch) started with the run
+                self._stage_starts[key] = now if fraction == 0.0 else self._opened
+            elif 0.0 < fraction < 1.0 and now - self._last_emit < self.min_interval:
+                return
+            self._current = key
+            self._last_emit = now
+            elapsed = now - (self._stage_starts.pop(key) if fraction >= 1.0 else self._stage_starts[key])
+            event = {"time": round(now, 3), "stage": stage, "fraction": round(fraction, 4)}
+            if track is not None:
+                event["track"] = track
+            throughput = None
+            if audio_seconds is not None:
+                event["audio_seconds"] = round(audio_seconds, 2)
+                if elapsed > 0:
+                    throughput = audio_seconds / elapsed
+                    event["throughput"] = round(throughput, 3)
+            if audio_seconds_total is not None:
+                event["audio_seconds_total"] = round(audio_seconds_total, 2)
+            job_left = _job_eta.remaining(stage, fraction) if _job_eta else None
+            if job_left is not None:
+                event["job_eta_seconds"] = round(job_left, 1)
+            if throughput and audio_seconds_total is not None:
+                event["eta_seconds"] = round(max(0.0, audio_seconds_total - audio_seconds) / throughput, 1)
+            elif fraction > 0:
+                event["eta_seconds"] = round(elapsed * (1 - fraction) / fraction, 1)
+            event.update(extra)
+            try:
+                self.stream.write(json.dumps(event) + "\n")
+            except (OSError, ValueError) as e:
+                # The host stopped listening; carry on without the channel
+                print(f"Warning: Progress channel closed, no more progress events: {e}")
+                self.stream = None
+
+    def close(self):
+        with self._lock:
+            if self.stream is not None:
+                try:
+                    self.stream.close()
+                except OSError:
+                    pass
+                self.stream = None
+            if self._closer:
+                self._closer()
+
+# Structured progress channel for this run, set by main() from --progress-fd/--progress-socket
+_progress = None
+
+def report_progress(stage, fraction, **fields):
+    """Sends a progress event if a ProgressChannel is open; returns whether one was."""
+    if _progress is None:
+        return False
+    _progress.emit(stage, fraction, **fields)
+    return True
+
+def parse_tqdm_progress(line):
+    """
+    Parses Demucs' tqdm bar (" 45%|####   | 105.3/234.0 [00:20<00:25, 5.12seconds/s]") into
+    (fraction, audio seconds done, audio seconds total), or None for any other line.
+    """
+    match = TQDM_PROGRESS_RE.search(line)
+    if not match:
+        return None
+    done, total = float(match.group(2)), float(match.group(3))
+    fraction = done / total if total > 0 else float(match.group(1)) / 100
+    return fraction, done, total
+
+class CpuBudget:
+    """
+    Hands out the machine's cores to Demucs and ffmpeg tasks so they never add up to more
+    than the cores available. A task that can't get its cores waits for them instead of
+    oversubscribing. Built on multiprocessing primitives so worker processes can share one
+    budget with the parent (pass it through their initializer).
+    """
+
+    def __init__(self, total_cores=None):
+        self.total_cores = total_cores or os.cpu_count() or 1
+        self._free_cores = multiprocessing.BoundedSemaphore(self.total_cores)
+        # Taken while collecting a multi-core grant so two tasks can't each hold half of what they need
+        self._grant_lock = multiprocessing.Lock()
+        # Core-seconds per task kind, seconds spent queued, cores in use now and at peak
+        self._stats = multiprocessing.Array("d", len(CPU_BUDGET_KINDS) + 3)
+        self.start_time = time.time()
+
+    @contextlib.contextmanager
+    def reserve(self, cores, kind):
+        """Blocks until `cores` cores are free, holds them for the `with` body, yields the grant."""
+        cores = max(1, min(cores, self.total_cores))
+        wait_start = time.time()
+        with self._grant_lock:
+            for _ in range(cores):
+                self._free_cores.acquire()
+        granted_at = time.time()
+        waited_index = len(CPU_BUDGET_KINDS)
+        with self._stats.get_lock():
+            self._stats[waited_index] += granted_at - wait_start
+            self._stats[waited_index + 1] += cores
+            self._stats[waited_index + 2] = max(self._stats[waited_index + 2], self._stats[waited_index + 1])
+        try:
+            yield cores
+        finally:
+            with self._stats.get_lock():
+                self._stats[CPU_BUDGET_KINDS.index(kind)] += cores * (time.time() - granted_at)
+                self._stats[waited_index + 1] -= cores
+            for _ in range(cores):
+                self._free_cores.release()
+
+    def print_report(self):
+        """Prints how much of the budget each kind of task used over the run so far."""
+        wall_seconds = max(time.time() - self.start_time, 1e-9)
+        with self._stats.get_lock():
+            stats = list(self._stats)
+        busy_core_seconds = sum(stats[:len(CPU_BUDGET_KINDS)])
+        print("\n--- CPU Budget ---")
+        print(f"Cores: {self.total_cores}")
+        for index, kind in enumerate(CPU_BUDGET_KINDS):
+            print(f"  {kind}: {stats[index]:.1f} core-seconds")
+        print(f"Utilization: {busy_core_seconds / (self.total_cores * wall_seconds) * 100:.1f}% "
+              f"of {self.total_cores} core(s) over {wall_seconds:.1f}s")
+        print(f"Peak cores reserved: {stats[len(CPU_BUDGET_KINDS) + 2]:.0f}/{self.total_cores}, "
+              f"time tasks spent queued for cores: {stats[len(CPU_BUDGET_KINDS)]:.1f}s")
+
+# Budget shared by everything this process (and its workers) runs; set by run_batch()/main()
+_cpu_budget = None
+
+def budget_cores():
+    """Cores available to this run: the CPU budget's size, or every core when there is none."""
+    return _cpu_budget.total_cores if _cpu_budget else (os.cpu_count() or 1)
+
+def cpu_reservation(cores, kind):
+    """Reserves cores from the run's CpuBudget, or does nothing when no budget is set up."""
+    if _cpu_budget is None:
+        return contextlib.nullcontext(max(1, min(cores, budget_cores())))
+    return _cpu_budget.reserve(cores, kind)
+
+# MP3 encoder this process uses, from --mp3-encoder; set by main() and passed on to track workers
+_mp3_encoder = None
+
+def resolve_mp3_encoder(choice="auto"):
+    """Turns an --mp3-encoder choice into the encoder to use: "lame" when lameenc is installed, else "ffmpeg"."""
+    if choice == "ffmpeg":
+        return "ffmpeg"
+    try:
+        import lameenc  # noqa: F401
+    except ImportError:
+        if choice == "lame":
+            print("Warning: lameenc is not installed (pip install lameenc); encoding MP3s with ffmpeg instead.")
+        return "ffmpeg"
+    return "lame"
+
+def lame_can_encode(samplerate, channels, bitrate):
+    """Whether lame_encode_blocks() can write this stream; anything else is left to ffmpeg."""
+    if (_mp3_encoder or resolve_mp3_encoder()) != "lame":
+        return False
+    match = re.fullmatch(r"(\d+)k", bitrate)
+    return (samplerate in MP3_SAMPLERATES and channels in (1, 2)
+            and match is not None and int(match.group(1)) in MP3_BITRATES_KBPS[1:])
+
+def float_to_pcm16(samples):
+    """Interleaves (channels, samples) float audio as 16-bit PCM the way ffmpeg converts it: round, then clip."""
+    import numpy as np
+    return np.clip(np.rint(np.asarray(samples).T * 32768.0), -32768, 32767).astype("<i2")
+
+def mp3_frame_size(header):
+    """Length in bytes of the MPEG-1 Layer III frame starting with this 4-byte header."""
+    kbps = MP3_BITRATES_KBPS[header[2] >> 4]
+    samplerate = MP3_SAMPLERATES[(header[2] >> 2) & 3]
+    return 144000 * kbps // samplerate + ((header[2] >> 1) & 1)
+
+def lame_tag_crc(data):
+    """CRC-16 (polynomial 0x8005, reflected) as used by the LAME tag."""
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+def lame_info_frame(header, channels, frame_count, total_bytes, padding):
+    """
+    Builds the Xing "Info" frame with a LAME tag that ffmpeg's muxer (and LAME itself) put in
+    front of a CBR MP3. Decoders use its frame count, encoder delay and padding to drop the
+    silence LAME adds at both ends, so the stem decodes to exactly the samples that went in.
+    `header` is the first audio frame's; the Info frame uses the smallest bitrate it fits in.
+    """
+    side_info_bytes = 17 if channels == 1 else 32
+    frame = bytearray(4 + side_info_bytes)
+    frame += b"Info" + struct.pack(">III", 0x0F, frame_count, total_bytes)
+    # Seek table: a CBR stream's bytes are spread evenly over its duration
+    frame += bytes(index * 256 // 100 for index in range(100)) + struct.pack(">I", 0)
+    frame += b"LAME3.100" + bytes([0x01, 0]) + bytes(8) + bytes([0, min(MP3_BITRATES_KBPS[header[2] >> 4], 255)])
+    frame += ((LAME_ENCODER_DELAY << 12) | padding).to_bytes(3, "big") + bytes(4)
+    frame += struct.pack(">IH", total_bytes, 0)
+    samplerate_index = (header[2] >> 2) & 3
+    bitrate_index = next(index for index in range(1, len(MP3_BITRATES_KBPS))
+                         if 144000 * MP3_BITRATES_KBPS[index] // MP3_SAMPLERATES[samplerate_index] >= len(frame) + 2)
+    frame[:4] = bytes([header[0], header[1], (bitrate_index << 4) | (samplerate_index << 2), header[3]])
+    frame += struct.pack(">H", lame_tag_crc(frame))
+    return bytes(frame) + bytes(mp3_frame_size(frame) - len(frame))
+
+def lame_encode_blocks(blocks, samplerate, channels, mp3_file_path, bitrate=MP3_BITRATE):
+    """
+    Encodes interleaved 16-bit PCM blocks (bytes) to a CBR MP3 in this process with lameenc, at
+    the quality ffmpeg's libmp3lame uses and with the same Info frame, so the file is
+    interchangeable with ffmpeg's. lameenc releases the GIL while encoding, so a thread pool
+    encodes several stems at once. LAME can't finish a stream it never started, so empty audio
+    fails here; callers leave it to ffmpeg. A failed encode leaves no partial file behind.
+    Returns (True, mp3_filename_basename) on success, or (False, error_message_string) on failure.
+    """
+    import lameenc
+
+    encoder = lameenc.Encoder()
+    encoder.set_bit_rate(int(bitrate.rstrip("k")))
+    encoder.set_in_sample_rate(samplerate)
+    # At low bitrates LAME would otherwise resample on its own (e.g. to 32 kHz); ffmpeg pins it too
+    encoder.set_out_sample_rate(samplerate)
+    encoder.set_channels(channels)
+    encoder.set_quality(LAME_QUALITY)
+    encoder.silence()
+    # The Info frame's size only depends on the sample rate and channels, so room is left for it
+    # up front and it is filled in once the frames are counted
+    info_bytes = len(lame_info_frame(bytes([0xFF, 0xFB, MP3_SAMPLERATES.index(samplerate) << 2, 0]), channels, 0, 0, 0))
+    try:
+        with cpu_reservation(ENCODER_THREADS, "encode"), open(mp3_file_path, "w+b") as mp3_file:
+            mp3_file.write(bytes(info_bytes))
+            sample_count = 0
+            for block in blocks:
+                sample_count += len(block) // (2 * channels)
+                mp3_file.write(encoder.encode(block))
+            if not sample_count:
+                raise ValueError("there are no samples to encode")
+            mp3_file.write(encoder.flush())
+            total_bytes = mp3_file.tell()
+            mp3_file.seek(info_bytes)
+            first_header = mp3_file.read(4)
+            # The frame walk and the Info frame assume MPEG-1 Layer III at the input's sample rate
+            if (len(first_header) < 4 or first_header[0] != 0xFF or first_header[1] & 0xFE != 0xFA
+                    or (first_header[2] >> 2) & 3 != MP3_SAMPLERATES.index(samplerate)):
+                raise ValueError(f"LAME wrote an unexpected first frame header {first_header.hex()}")
+            frame_count = 0
+            offset = info_bytes
+            while offset + 4 <= total_bytes:
+                mp3_file.seek(offset)
+                frame_bytes = mp3_frame_size(mp3_file.read(4))
+                if frame_bytes < 4:
+                    raise ValueError(f"unexpected frame header at byte {offset}")
+                offset += frame_bytes
+                frame_count += 1
+            padding = frame_count * 1152 - LAME_ENCODER_DELAY - sample_count
+            mp3_file.seek(0)
+            mp3_file.write(lame_info_frame(first_header, channels, frame_count, total_bytes, padding))
+        return True, os.path.basename(mp3_file_path)
+    except Exception as e:
+        try:
+            os.remove(mp3_file_path)
+        except OSError:
+            pass  # never created
+        return False, f"Error encoding {os.path.basename(mp3_file_path)} with lameenc: {e}"
+
+def ffmpeg_encoder_args(entry):
+    """ffmpeg output arguments that encode to an output plan entry's profile (see OUTPUT_PROFILES)."""
+    profile = OUTPUT_PROFILES[entry["format"]]
+    args = ["-codec:a", profile["codec"]]
+    if entry["bitrate"]:
+        args += ["-b:a", entry["bitrate"]]
+    if profile["samplerate"]:
+        args += ["-ar", str(profile["samplerate"])]
+    return args + ["-threads", str(ENCODER_THREADS)]
+
+def write_pcm16_wav(path, pcm, samplerate):
+    """Writes interleaved (samples, channels) 16-bit PCM as a WAV file."""
+    import wave
+    with wave.open(path, "wb") as wav_file:
+        wav_file.setnchannels(pcm.shape[1])
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(samplerate)
+        wav_file.writeframes(pcm.tobytes())
+
+def encode_wav(wav_file_path, output_path, entry, ffmpeg_path="ffmpeg"):
+    """
+    Encodes a single WAV file to an output plan entry's profile (see OUTPUT_PROFILES), e.g.
+    {"format": "mp3", "bitrate": "320k"}: MP3 in-process with lameenc when that is the MP3 encoder
+    and the WAV is 16-bit PCM, everything else using ffmpeg.
+    Returns (True, output_filename_basename) on success, or (False, error_message_string) on failure.
+    """
+    import wave
+    try:
+        with wave.open(wav_file_path, "rb") as wav_file:
+            if (entry["format"] == "mp3" and wav_file.getsampwidth() == 2 and wav_file.getnframes()
+                    and lame_can_encode(wav_file.getframerate(), wav_file.getnchannels(), entry["bitrate"])):
+                return lame_encode_blocks(iter(lambda: wav_file.readframes(LAME_BLOCK_FRAMES), b""),
+                                          wav_file.getframerate(), wav_file.getnchannels(), output_path,
+                                          entry["bitrate"])
+    except (wave.Error, EOFError, OSError):
+        pass  # Not a plain PCM WAV (e.g. float samples); ffmpeg reads those
+
+    command = [
+        ffmpeg_path,
+        "-i", wav_file_path,
+        *ffmpeg_encoder_args(entry),
+        output_path,
+        "-y",
+        "-loglevel", "error"
+    ]
+    try:
+        with cpu_reservation(ENCODER_THREADS, "encode"):
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = process.communicate()
+
+        if process.returncode == 0:
+            return True, os.path.basename(output_path)
+        else:
+            error_message = f"Error converting {os.path.basename(wav_file_path)} to {entry['format'].upper()}."
+            decoded_stdout = stdout.decode(errors='ignore').strip()
+            decoded_stderr = stderr.decode(errors='ignore').strip()
+            if decoded_stdout:
+                error_message += f"\n  FFmpeg stdout: {decoded_stdout}"
+            if decoded_stderr:
+                error_message += f"\n  FFmpeg stderr: {decoded_stderr}"
+            return False, error_message.strip()
+            
+    except FileNotFoundError:
+        return False, f"Error: '{ffmpeg_path}' command not found. Ensure ffmpeg is installed and in PATH."
+    except Exception as e:
+        return False, f"Unexpected error during ffmpeg conversion of {os.path.basename(wav_file_path)}: {e}"
+
+def encode_pcm(samples, samplerate, output_path, entry, ffmpeg_path="ffmpeg"):
+    """
+    Encodes an in-memory (channels, samples) float tensor to an output plan entry's profile, so no
+    intermediate WAV is ever written to disk: MP3 in-process with lameenc when it can, everything
+    else by piping raw PCM into ffmpeg.
+    Returns (True, output_filename_basename) on success, or (False, error_message_string) on failure.
+    """
+    from demucs.audio import prevent_clip
+
+    if samples.numel():
+        # Its peak search can't reduce over an empty stem, which has nothing to clip anyway
+        samples = prevent_clip(samples, mode="rescale")
+    samples = samples.cpu()
+    if (entry["format"] == "mp3" and samples.shape[-1]
+            and lame_can_encode(samplerate, samples.shape[0], entry["bitrate"])):
+        pcm = samples.numpy()
+        return lame_encode_blocks((float_to_pcm16(pcm[:, start:start + LAME_BLOCK_FRAMES]).tobytes()
+                                   for start in range(0, pcm.shape[-1], LAME_BLOCK_FRAMES)),
+                                  samplerate, pcm.shape[0], output_path, entry["bitrate"])
+    pcm_bytes = samples.t().contiguous().numpy().astype("<f4").tobytes()
+    command = [
+        ffmpeg_path,
+        "-f", "f32le", "-ar", str(samplerate), "-ac", str(samples.shape[0]),
+        "-i", "pipe:0",
+        *ffmpeg_encoder_args(entry),
+        output_path,
+        "-y",
+        "-loglevel", "error"
+    ]
+    try:
+        with cpu_reservation(ENCODER_THREADS, "encode"):
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = process.communicate(input=pcm_bytes)
+
+        if process.returncode == 0:
+            return True, os.path.basename(output_path)
+        error_message = f"Error encoding {os.path.basename(output_path)} from PCM."
+        decoded_stderr = stderr.decode(errors='ignore').strip()
+        if decoded_stderr:
+            error_message += f"\n  FFmpeg stderr: {decoded_stderr}"
+        return False, error_message
+    except FileNotFoundError:
+        return False, f"Error: '{ffmpeg_path}' command not found. Ensure ffmpeg is installed and in PATH."
+    except Exception as e:
+        return False, f"Unexpected error during ffmpeg encoding of {os.path.basename(output_path)}: {e}"
+
+def encode_stems(wav_entries, ffmpeg_exe_path):
+    """
+    Encodes WAV files next to themselves, deleting each WAV once encoded. `wav_entries` maps each
+    WAV path to the output plan entry it is encoded to, e.g. {"format": "opus", "bitrate": "128k"}.
+    Returns (converted_count, failed_count).
+    """
+    num_wav_files = len(wav_entries)
+    target_name = "/".join(sorted({entry["format"] for entry in wav_entries.values()})).upper()
+    tasks = []
+    for wav_file, entry in wav_entries.items():
+        output_file_name = os.path.splitext(os.path.basename(wav_file))[0] + "." + entry["format"]
+        output_path = os.path.join(os.path.dirname(wav_file), output_file_name) # Output in same dir as WAV
+        tasks.append({"wav_path": wav_file, "output_path": output_path, "entry": entry})
+
+    converted_count = 0
+    failed_count = 0
+
+    # One single-threaded encoder per file is all that helps; more workers would only queue for cores
+    num_workers = max(1, min(num_wav_files, budget_cores() // ENCODER_THREADS))
+    encoder_name = "in-process LAME encoder(s)" if (_mp3_encoder or resolve_mp3_encoder()) == "lame" else "ffmpeg process(es)"
+    print(f"\nConverting {num_wav_files} file(s) using up to {num_workers} parallel {encoder_name}...")
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        future_to_task = {
+            executor.submit(encode_wav, task["wav_path"], task["output_path"], task["entry"],
+                            ffmpeg_path=ffmpeg_exe_path): task
+            for task in tasks
+        }
+
+        for i, future in enumerate(as_completed(future_to_task)):
+            task_info = future_to_task[future]
+            wav_path_basename = os.path.basename(task_info["wav_path"])
+            current_progress_prefix = f"  ({i+1}/{num_wav_files})"
+            try:
+                success, result_message = future.result()
+                if success:
+                    output_basename = result_message
+                    print(f"{current_progress_prefix} SUCCESS: {wav_path_basename} -> {output_basename}")
+                    converted_count += 1
+
+                    # --- WAV DELETION --- (Requirement 3)
+                    try:
+                        os.remove(task_info["wav_path"])
+                        print(f"    SUCCESS: Deleted source WAV: {wav_path_basename}")
+                    except OSError as e:
+                        print(f"    WARNING: Could not delete source WAV {wav_path_basename}: {e}")
+                else:
+                    error_details = result_message
+                    print(f"{current_progress_prefix} FAILED converting {wav_path_basename}:")
+                    for line in error_details.splitlines():
+                        print(f"    {line}")
+                    failed_count += 1
+            except Exception as exc:
+                print(f"{current_progress_prefix} FAILED (unexpected exception) converting {wav_path_basename}: {exc}")
+                failed_count += 1
+
+    print(f"\n--- {target_name} Conversion Summary ---")
+    print(f"Total WAV files found: {num_wav_files}")
+    print(f"Successfully converted to {target_name}: {converted_count}")
+    print(f"Failed conversions: {failed_count}")
+
+    if failed_count > 0:
+        print("\nPlease review error messages for failed conversions.")
+    elif converted_count == 0 and num_wav_files > 0:
+         print(f"No WAV files were successfully converted to {target_name}.")
+    elif converted_count > 0:
+         print(f"All found WAV files converted to {target_name} successfully (and originals deleted).")
+
+    return converted_count, failed_count
+
+def parse_output_plan(spec):
+    """
+    Parses an output plan such as "vocals:mp3:320k,no_vocals:wav" into
+    {stem_name: {"format": ..., "bitrate": ...}}, in the order given.
+    Each entry is stem[:format[:bitrate]]; format defaults to mp3 and bitrate to the format's
+    default in OUTPUT_PROFILES (MP3_BITRATE for mp3).
+    Raises ValueError describing the first problem found, before any work is started.
+    """
+    valid_stems = (TWO_STEMS, f"no_{TWO_STEMS}")
+    plan = {}
+    for entry in spec.split(","):
+        parts = [part.strip() for part in entry.strip().split(":")]
+        if not parts[0]:
+            raise ValueError(f"Empty entry in output plan '{spec}'.")
+        if len(parts) > 3:
+            raise ValueError(f"Output plan entry '{entry}' has too many fields, expected stem[:format[:bitrate]].")
+        stem_name = parts[0]
+        output_format = parts[1].lower() if len(parts) > 1 and parts[1] else "mp3"
+        bitrate = parts[2].lower() if len(parts) > 2 and parts[2] else None
+
+        if stem_name not in valid_stems:
+            raise ValueError(f"Unknown stem '{stem_name}' in output plan, expected one of: {', '.join(valid_stems)}.")
+        if stem_name in plan:
+            raise ValueError(f"Stem '{stem_name}' appears more than once in the output plan.")
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown format '{output_format}' for stem '{stem_name}', "
+                             f"expected one of: {', '.join(OUTPUT_FORMATS)}.")
+        profile = OUTPUT_PROFILES[output_format]
+        if profile["bitrates"]:
+            bitrate = bitrate or profile["bitrate"]
+            low, high = profile["bitrates"]
+            match = re.fullmatch(r"(\d+)k", bitrate)
+            if not match or not low <= int(match.group(1)) <= high:
+                raise ValueError(f"Invalid {output_format.upper()} bitrate '{bitrate}' for stem '{stem_name}', "
+                                 f"expected {low}k-{high}k.")
+        elif bitrate:
+            raise ValueError(f"Format '{output_format}' for stem '{stem_name}' does not take a bitrate.")
+        plan[stem_name] = {"format": output_format, "bitrate": bitrate}
+    return plan
+
+def describe_output_plan(plan):
+    """Formats an output plan for log lines, e.g. "vocals -> mp3 320k"."""
+    return ", ".join(
+        f"{stem_name} -> {entry['format']}" + (f" {entry['bitrate']}" if entry["bitrate"] else "")
+        for stem_name, entry in plan.items()
+    )
+
+def track_name_for(input_file):
+    """The {track} part of Demucs' output names: the input's file name without its extension."""
+    return os.path.splitext(os.path.basename(input_file))[0]
+
+def stem_output_path(folder, track_name, stem_name, plan):
+    """Where the planned output for one stem of a track goes, e.g. "Song [vocals].mp3"."""
+    return os.path.join(folder, f"{track_name} [{stem_name}].{plan[stem_name]['format']}")
+
+def finalize_stem_wavs(wav_folder, track_name, plan, ffmpeg_exe_path):
+    """
+    Turns the stem WAVs Demucs left for one track into the planned outputs: stems planned as
+    MP3 (or another encoded format) are encoded, stems planned as WAV are kept, and stems not
+    in the plan are deleted without ever being encoded.
+    Returns (converted_count, failed_count).
+    """
+    wav_entries = {}
+    for stem_name in (TWO_STEMS, f"no_{TWO_STEMS}"):
+        wav_path = os.path.join(wav_folder, f"{track_name} [{stem_name}].wav")
+        if not os.path.exists(wav_path):
+            continue
+        if stem_name not in plan:
+            try:
+                os.remove(wav_path)
+                print(f"Deleted unplanned stem WAV: {os.path.basename(wav_path)}")
+            except OSError as e:
+                print(f"Warning: Could not delete '{os.path.basename(wav_path)}': {e}")
+        elif plan[stem_name]["format"] != "wav":
+            wav_entries[wav_path] = plan[stem_name]
+
+    if not wav_entries:
+        return 0, 0
+    return encode_stems(wav_entries, ffmpeg_exe_path)
+
+def remove_processed_input(input_file):
+    """
+    Deletes an input file once it has been processed successfully and returns True when it is gone.
+    Only the processed file is removed; anything else in the input folder, including failed inputs
+    kept for a retry, stays.
+    """
+    try:
+        os.remove(input_file)
+        print(f"Deleted from input: {os.path.basename(input_file)}")
+        return True
+    except OSError as e:
+        print(f"Warning: Could not delete '{os.path.basename(input_file)}' from input folder: {e}")
+        return False
+
+def get_ffmpeg_exe_path():
+    """Returns the ffmpeg executable to use for conversions on this platform."""
+    if sys.platform == "win32":
+        return os.path.join(abs_ffmpeg_dir, "ffmpeg.exe")
+    return "ffmpeg"
+
+def get_demucs_exe_path():
+    """Returns the Demucs CLI installed in the app's venv."""
+    if sys.platform == "win32":
+        return os.path.join(parent_dir, "venv", "Scripts", "demucs.exe")
+    # On Linux/macOS, it's in venv/bin/demucs
+    return os.path.join(parent_dir, "venv", "bin", "demucs")
+
+def get_default_cache_dir():
+    """Per-user cache location that survives reinstalls of the app itself."""
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.environ.get("APPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "YASG", "separation_cache")
+
+def get_default_export_dir():
+    """Per-user folder for exported models (see export_separation_model()), next to the separation cache."""
+    return os.path.join(os.path.dirname(get_default_cache_dir()), "model_exports")
+
+def get_default_history_path():
+    """Per-user run history file, kept next to the separation cache."""
+    return os.path.join(os.path.dirname(get_default_cache_dir()), "run_history.jsonl")
+
+def host_signature():
+    """Identifies this machine well enough that timings recorded on it predict future runs."""
+    import platform
+    return f"{platform.system()}-{platform.machine()}-{os.cpu_count() or 1}cpu"
+
+def probe_audio(input_file, ffmpeg_exe_path="ffmpeg"):
+    """
+    Identifies an input from ffmpeg's header dump without decoding it, so the format comes
+    from the file's contents rather than its extension. Returns {"format", "codec",
+    "samplerate", "layout", "mono", "seconds"} for its first audio stream ("seconds" is None if
+    the container doesn't say), or None if ffmpeg can't open it or it holds no audio.
+    """
+    try:
+        process = subprocess.run([ffmpeg_exe_path, "-hide_banner", "-i", input_file],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, errors="replace")
+    except OSError:
+        return None
+    stream = FFMPEG_AUDIO_STREAM_RE.search(process.stderr)
+    if not stream:
+        return None
+    container = FFMPEG_INPUT_FORMAT_RE.search(process.stderr)
+    duration = FFMPEG_DURATION_RE.search(process.stderr)
+    seconds = None
+    if duration:
+        hours, minutes, secs = duration.groups()
+        seconds = int(hours) * 3600 + int(minutes) * 60 + float(secs)
+    layout = stream.group(3).strip()
+    return {"format": container.group(1) if container else None, "codec": stream.group(1),
+            "samplerate": int(stream.group(2)), "layout": layout,
+            "mono": layout in ("mono", "1 channels"), "seconds": seconds}
+
+def probe_audio_seconds(input_file, ffmpeg_exe_path="ffmpeg"):
+    """Reads a file's duration from ffmpeg's header dump without decoding it; None if unknown."""
+    info = probe_audio(input_file, ffmpeg_exe_path)
+    return info["seconds"] if info else None
+
+class EtaPredictor:
+    """
+    Predicts how long each stage of a track takes from earlier runs' timings, which are kept
+    with the track length and host in a small JSON-lines history file. For every stage it fits
+    seconds = fixed + per_audio_second * track length over this host's runs of the same `mode`
+    by least squares, falling back to ETA_PRIOR_STAGE_MODELS while there is too little history.
+    """
+
+    def __init__(self, history_path, mode, stages):
+        self.history_path = history_path
+        self.mode = mode
+        self.stages = stages
+        self.host = host_signature()
+        self.runs = self._load_runs()
+        self.models = {stage: self._fit(stage) for stage in stages}
+
+    def _load_runs(self):
+        runs = []
+        try:
+            with open(self.history_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        run = json.loads(line)
+                    except ValueError:
+                        continue
+                    if run.get("host") == self.host and run.get("mode") == self.mode:
+                        runs.append(run)
+        except OSError:
+            pass
+        return runs[-ETA_HISTORY_MAX_RUNS:]
+
+    def _fit(self, stage):
+        points = [(run["audio_seconds"], run["stages"][stage]) for run in self.runs if stage in run.get("stages", {})]
+        if len(points) < ETA_MIN_RUNS_TO_FIT:
+            return ETA_PRIOR_STAGE_MODELS.get(stage, (0.0, 0.0))
+        count = len(points)
+        mean_x = sum(x for x, _ in points) / count
+        mean_y = sum(y for _, y in points) / count
+        variance = sum((x - mean_x) ** 2 for x, _ in points)
+        if variance > 0:
+            slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+            if slope >= 0 and mean_y - slope * mean_x >= 0:
+                return mean_y - slope * mean_x, slope
+        # Tracks of one length, or a fit implying negative times: scale by length alone
+        total_x = sum(x for x, _ in points)
+        return (0.0, mean_y * count / total_x) if total_x > 0 else (mean_y, 0.0)
+
+    def predict(self, audio_seconds):
+        """Returns {stage: predicted seconds} for a track of `audio_seconds`."""
+        return {stage: fixed + per_second * audio_seconds for stage, (fixed, per_second) in self.models.items()}
+
+    def record(self, audio_seconds, stage_seconds):
+        """Appends one finished track's stage timings to the history, trimming it when it grows too long."""
+        run = {"time": round(time.time(), 1), "host": self.host, "mode": self.mode,
+               "audio_seconds": round(audio_seconds, 2),
+               "stages": {stage: round(seconds, 3) for stage, seconds in stage_seconds.items()}}
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.history_path)), exist_ok=True)
+            with open(self.history_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(run) + "\n")
+            if os.path.getsize(self.history_path) > ETA_HISTORY_MAX_BYTES:
+                with open(self.history_path, "r", encoding="utf-8") as f:
+                    lines = f.readlines()
+                with open(self.history_path + ".tmp", "w", encoding="utf-8") as f:
+                    f.writelines(lines[len(lines) // 2:])
+                os.replace(self.history_path + ".tmp", self.history_path)
+        except OSError as e:
+            print(f"Warning: Could not record run timings in '{self.history_path}': {e}")
+        self.runs.append(run)
+
+class JobEta:
+    """
+    Remaining wall time for a whole job made of `stage_predictions` ({stage: seconds}, in run
+    order). Starts from the predictions and, as progress events arrive for a stage, leans more
+    and more on the rate actually observed for it.
+    """
+
+    def __init__(self, stage_predictions):
+        self.predictions = dict(stage_predictions)
+        self.order = list(stage_predictions)
+        self._starts = {}
+        self.start_time = time.time()
+
+    def total(self):
+        return sum(self.predictions.values())
+
+    def remaining(self, stage, fraction):
+        """Seconds left in the job while `stage` is `fraction` done; None for stages it doesn't know."""
+        if stage not in self.predictions:
+            return None
+        now = time.time()
+        elapsed = now - self._starts.setdefault(stage, now)
+        predicted_left = (1 - fraction) * self.predictions[stage]
+        if fraction > 0:
+            # Trust the pace observed so far more the further the stage has got
+            observed_left = elapsed * (1 - fraction) / fraction
+            stage_left = (1 - fraction) * predicted_left + fraction * observed_left
+        else:
+            stage_left = max(0.0, self.predictions[stage] - elapsed)
+        later_stages = self.order[self.order.index(stage) + 1:]
+        return stage_left + sum(self.predictions[later] for later in later_stages)
+
+# ETA for the current job, refined by every progress event; set by main()/run_batch()
+_job_eta = None
+
+def write_json_atomic(path, data):
+    """Writes JSON to a temp file next to `path` and swaps it in, so readers never see half a file."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    if hasattr(os, "O_DIRECTORY"):
+        # Persist the rename itself too, or a power cut can still bring back the old file
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+class SeparationCache:
+    """
+    Content-addressed store of finished vocals MP3s.
+
+    Entries are keyed by a hash of the decoded audio plus everything that changes the output
+    (model, precision, backend, windowing, silence skipping, stems, encoder settings), so the same song re-imported under another
+    name, with different tags or by another user still hits. Least recently used entries are evicted
+    once the cache grows past `max_bytes`.
+    """
+
+    def __init__(self, cache_dir, max_bytes, precision="fp32", backend="torch", windowed=False, skip_silence=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.precision = precision
+        self.backend = backend
+        self.windowed = windowed
+        self.skip_silence = skip_silence
+        self.entries_dir = os.path.join(cache_dir, "entries")
+        self.aliases_dir = os.path.join(cache_dir, "aliases")
+        self.stats_path = os.path.join(cache_dir, "stats.json")
+        os.makedirs(self.entries_dir, exist_ok=True)
+        os.makedirs(self.aliases_dir, exist_ok=True)
+        self.session = {"hits": 0, "misses": 0, "bytes_saved": 0, "seconds_saved": 0.0}
+
+    def _file_hash(self, path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _pcm_audio_hash(audio, samplerate):
+        """
+        Hashes already decoded (channels, samples) float audio exactly as _decoded_audio_hash()
+        hashes ffmpeg's 16-bit output, or returns None when it isn't 44.1 kHz stereo.
+        """
+        if samplerate != 44100 or audio.shape[0] != 2:
+            return None
+        samples = audio.numpy() if hasattr(audio, "numpy") else audio
+        digest = hashlib.sha256()
+        step = 1024 * 1024
+        for start in range(0, samples.shape[-1], step):
+            digest.update(float_to_pcm16(samples[:, start:start + step]).tobytes())
+        return digest.hexdigest()
+
+    def _decoded_audio_hash(self, path, ffmpeg_path):
+        """Hashes the PCM ffmpeg decodes from `path`, so tags and container details don't matter."""
+        command = [
+            ffmpeg_path, "-i", path, "-map", "0:a:0",
+            "-f", "s16le", "-ac", "2", "-ar", "44100",
+            "-loglevel", "error", "-"
+        ]
+        digest = hashlib.sha256()
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        for chunk in iter(lambda: process.stdout.read(1024 * 1024), b""):
+            digest.update(chunk)
+        if process.wait() != 0:
+            return None
+        return digest.hexdigest()
+
+    @staticmethod
+    def supports_plan(plan):
+        """The cache only holds vocals MP3s, so it can serve plans that keep nothing else."""
+        return list(plan) == [TWO_STEMS] and plan[TWO_STEMS]["format"] == "mp3"
+
+    def key_for(self, input_path, ffmpeg_path, bitrate=MP3_BITRATE, audio=None, samplerate=None, decode=True):
+        """
+        Returns the cache key for an input file encoded at `bitrate`, or None if it could not be decoded.
+        Files seen before are resolved through a hash of their raw bytes without decoding. For
+        new files, `audio` already decoded at `samplerate` is hashed instead of decoding the file
+        a second time when it can be; otherwise the file is decoded, unless `decode` is False,
+        in which case new files get None.
+        """
+        try:
+            file_hash = self._file_hash(input_path)
+            alias_path = os.path.join(self.aliases_dir, file_hash)
+            if os.path.exists(alias_path):
+                with open(alias_path, "r") as f:
+                    audio_hash = f.read().strip()
+            else:
+                audio_hash = self._pcm_audio_hash(audio, samplerate) if audio is not None else None
+                if audio_hash is None and decode:
+                    audio_hash = self._decoded_audio_hash(input_path, ffmpeg_path)
+                if audio_hash is None:
+                    return None
+                with open(alias_path, "w") as f:
+                    f.write(audio_hash)
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"Warning: Could not hash '{os.path.basename(input_path)}' for the cache: {e}")
+            return None
+
+        settings = {
+            "version": SEPARATION_CACHE_VERSION,
+            "audio": audio_hash,
+            "model": DEMUCS_MODEL_NAME,
+            "stems": TWO_STEMS,
+            "codec": MP3_CODEC,
+            "bitrate": bitrate,
+        }
+        if self.precision != "fp32":
+            # fp32 keys stay as they were before precisions existed
+            settings["precision"] = self.precision
+        if self.backend not in ("cli", "torch"):
+            # The Demucs CLI and in-process PyTorch run the same model and share keys
+            settings["backend"] = self.backend
+        if lame_can_encode(DEMUCS_SAMPLERATE, DEMUCS_CHANNELS, bitrate):
+            # Keys for ffmpeg's encoder stay as they were before the in-process LAME encoder existed
+            settings["mp3_encoder"] = "lame"
+        if self.windowed:
+            settings["windowed"] = True
+        if self.skip_silence:
+            settings["skip_silence"] = True
+        return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.entries_dir, f"{key}.mp3")
+
+    def restore(self, key, destination_path):
+        """On a hit, copies the cached vocals MP3 to `destination_path` and returns True."""
+        entry_path = self._entry_path(key)
+        if not os.path.exists(entry_path):
+            self.session["misses"] += 1
+            self._record("misses", 1)
+            return False
+
+        tmp_path = destination_path + ".part"
+        shutil.copyfile(entry_path, tmp_path)
+        os.replace(tmp_path, destination_path)
+        os.utime(entry_path)  # mtime doubles as the LRU timestamp
+
+        seconds_saved = 0.0
+        meta_path = entry_path[:-len(".mp3")] + ".json"
+        if os.path.exists(meta_path):
+            try:
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    seconds_saved = json.load(f).get("separation_seconds", 0.0)
+            except (OSError, ValueError):
+                pass
+        bytes_saved = os.path.getsize(entry_path)
+        self.session["hits"] += 1
+        self.session["bytes_saved"] += bytes_saved
+        self.session["seconds_saved"] += seconds_saved
+        self._record("hits", 1, bytes_saved=bytes_saved, seconds_saved=seconds_saved)
+        return True
+
+    def store(self, key, vocals_mp3_path, separation_seconds):
+        """Adds a freshly produced vocals MP3 to the cache, then evicts down to the quota."""
+        entry_path = self._entry_path(key)
+        tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+        try:
+            shutil.copyfile(vocals_mp3_path, tmp_path)
+            os.replace(tmp_path, entry_path)
+            write_json_atomic(entry_path[:-len(".mp3")] + ".json", {
+                "source": os.path.basename(vocals_mp3_path),
+                "separation_seconds": round(separation_seconds, 3),
+                "created": time.time(),
+            })
+        except OSError as e:
+            print(f"Warning: Could not add '{os.path.basename(vocals_mp3_path)}' to the cache: {e}")
+            return
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in `max_bytes`."""
+        entries = []
+        for entry_path in glob.glob(os.path.join(self.entries_dir, "*.mp3")):
+            try:
+                stat = os.stat(entry_path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+        total_bytes = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, entry_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            for path in (entry_path, entry_path[:-len(".mp3")] + ".json"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total_bytes -= size
+            evicted += 1
+        if evicted:
+            print(f"Cache: evicted {evicted} least recently used entr{'y' if evicted == 1 else 'ies'} "
+                  f"to stay under {self.max_bytes / (1024 * 1024):.0f} MB")
+            self._record("evictions", evicted)
+
+    def _load_stats(self):
+        try:
+            with open(self.stats_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _record(self, counter, amount, bytes_saved=0, seconds_saved=0.0):
+        stats = self._load_stats()
+        stats[counter] = stats.get(counter, 0) + amount
+        stats["bytes_saved"] = stats.get("bytes_saved", 0) + bytes_saved
+        stats["seconds_saved"] = round(stats.get("seconds_saved", 0.0) + seconds_saved, 3)
+        try:
+            write_json_atomic(self.stats_path, stats)
+        except OSError:
+            pass
+
+    def print_report(self):
+        """Prints hit/miss/bytes-saved figures for this run and for the cache's lifetime."""
+        stats = self._load_stats()
+        used_bytes = sum(os.path.getsize(p) for p in glob.glob(os.path.join(self.entries_dir, "*.mp3")))
+        print("\n--- Separation Cache ---")
+        print(f"Location: {self.cache_dir}")
+        print(f"Size: {used_bytes / (1024 * 1024):.1f} MB of {self.max_bytes / (1024 * 1024):.0f} MB")
+        print(f"This run: {self.session['hits']} hit(s), {self.session['misses']} miss(es), "
+              f"{self.session['bytes_saved'] / (1024 * 1024):.1f} MB served, "
+              f"~{self.session['seconds_saved']:.0f}s of separation saved")
+        print(f"All time: {stats.get('hits', 0)} hit(s), {stats.get('misses', 0)} miss(es), "
+              f"{stats.get('evictions', 0)} eviction(s), "
+              f"{stats.get('bytes_saved', 0) / (1024 * 1024):.1f} MB served, "
+              f"~{stats.get('seconds_saved', 0.0):.0f}s of separation saved")
+
+class JobManifest:
+    """
+    Persistent record of how far each input track got (MANIFEST_STATES) and which files that
+    stage left behind, so a rerun after Ctrl+C or a crash resumes where it stopped.
+    Every change is written atomically, so the manifest on disk is always a complete snapshot.
+    Safe to update from several threads of one process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.tracks = {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == JOB_MANIFEST_VERSION:
+                self.tracks = data.get("tracks", {})
+        except (OSError, ValueError):
+            pass
+        # Finished tracks whose input is gone can never be resumed again
+        self.tracks = {
+            name: entry for name, entry in self.tracks.items()
+            if entry.get("state") != "finalized" or os.path.exists(entry.get("input", ""))
+        }
+
+    @staticmethod
+    def _fingerprint(input_file):
+        stat = os.stat(input_file)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def resume_state(self, input_file):
+        """
+        Returns the last state recorded for this exact input file, or None when it has to start
+        from scratch (unknown, replaced by a different file, or its stage's outputs went missing).
+        """
+        with self._lock:
+            entry = self.tracks.get(os.path.basename(input_file))
+        if not entry or entry.get("state") == "queued":
+            return None
+        try:
+            if entry.get("fingerprint") != self._fingerprint(input_file):
+                return None
+        except OSError:
+            return None
+        if not all(os.path.exists(path) for path in entry.get("outputs", [])):
+            return None
+        return entry["state"]
+
+    def advance(self, input_file, state, outputs=None, error=None):
+        """Records that `input_file` reached `state`, leaving `outputs` behind, and saves the manifest."""
+        if state not in MANIFEST_STATES:
+            raise ValueError(f"unknown job state '{state}'")
+        with self._lock:
+            entry = self.tracks.setdefault(os.path.basename(input_file), {})
+            entry["input"] = os.path.abspath(input_file)
+            entry["state"] = state
+            if os.path.exists(input_file):
+                entry["fingerprint"] = self._fingerprint(input_file)
+            if outputs is not None:
+                entry["outputs"] = [os.path.abspath(path) for path in outputs]
+            entry["error"] = error
+            entry["updated"] = time.time()
+            self._save()
+
+    def record_error(self, input_file, error):
+        """Notes why a track failed without moving it back, so a rerun retries from its last good state."""
+        with self._lock:
+            entry = self.tracks.setdefault(os.path.basename(input_file), {"state": "queued"})
+            entry["error"] = error
+            entry["updated"] = time.time()
+            self._save()
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            write_json_atomic(self.path, {"version": JOB_MANIFEST_VERSION, "tracks": self.tracks})
+        except OSError as e:
+            print(f"Warning: Could not save job manifest '{self.path}': {e}")
+
+class ManifestForwarder:
+    """
+    Stands in for the parent's JobManifest in a worker process: advance() calls are put on a
+    multiprocessing queue for the parent to apply, so only one process ever writes the manifest.
+    """
+
+    def __init__(self, updates):
+        self.updates = updates
+
+    def advance(self, input_file, state, outputs=None):
+        self.updates.put((input_file, state, outputs))
+
+def planned_output_paths(folder, track_name, plan):
+    """Paths of every output `plan` produces for a track."""
+    return [stem_output_path(folder, track_name, stem_name, plan) for stem_name in plan]
+
+def separated_wav_paths(folder, track_name, plan):
+    """Paths of the raw Demucs WAVs the planned outputs are encoded from."""
+    return [os.path.join(folder, f"{track_name} [{stem_name}].wav") for stem_name in plan]
+
+def cpu_supports_bf16():
+    """True if this CPU does bfloat16 math natively (AVX512-BF16 or AMX), where autocast pays off."""
+    import torch
+    check = getattr(torch.cpu, "_is_avx512_bf16_supported", None)
+    if check is not None:
+        try:
+            if check():
+                return True
+        except RuntimeError:
+            pass
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            flags = f.read()
+        return "avx512_bf16" in flags or "amx_bf16" in flags
+    except OSError:
+        return False
+
+def load_separation_model(model_name=DEMUCS_MODEL_NAME, precision="fp32", backend="torch", mmap_weights=True):
+    """
+    Loads a pretrained Demucs model into this process so it can be reused for many tracks.
+    Imports torch/demucs lazily so the default CLI mode does not pay for them.
+    With precision "int8", the model's Linear and LSTM layers are dynamically quantized; with
+    "bf16", apply_separation_model() runs it under bfloat16 autocast (CPUs without native
+    bfloat16 fall back to fp32, which is faster there).
+    The torch backend memory-maps its weights (see load_mmap_model()) unless `mmap_weights` is
+    False. Backends "onnx" and "compiled" return an ExportedSeparationModel instead (fp32 only); if
+    the model can't be compiled here, "compiled" falls back to "torch". Either way the result
+    is used through apply_separation_model().
+    """
+    import torch
+    from demucs.pretrained import get_model
+    if precision not in PRECISIONS:
+        raise ValueError(f"unknown precision '{precision}', expected one of {', '.join(PRECISIONS)}")
+    if backend in ("onnx", "compiled"):
+        if precision != "fp32":
+            raise ValueError(f"the {backend} backend only runs fp32 models")
+        if backend == "onnx":
+            model = OnnxSeparationModel(export_separation_model(model_name, "onnx"), threads=torch.get_num_threads())
+        else:
+            try:
+                model = CompiledSeparationModel(export_separation_model(model_name, "compiled"))
+            except Exception as e:
+                # Compiling needs a C++ toolchain, which most Windows machines don't have
+                print(f"Warning: Could not compile '{model_name}' ({e}); separating with the torch backend instead.")
+                return load_separation_model(model_name, precision, mmap_weights=mmap_weights)
+        model.separation_precision = precision
+        model.separation_backend = backend
+        return model
+    if backend != "torch":
+        raise ValueError(f"backend '{backend}' does not separate in-process, expected torch, compiled or onnx")
+    model = load_mmap_model(model_name) if mmap_weights else get_model(model_name)
+    model.eval()
+    if precision == "bf16" and not cpu_supports_bf16():
+        print("Warning: This CPU has no native bfloat16 support, using fp32 instead.")
+        precision = "fp32"
+    if precision == "int8":
+        engines = torch.backends.quantized.supported_engines
+        torch.backends.quantized.engine = next(
+            (engine for engine in ("x86", "fbgemm", "qnnpack") if engine in engines), torch.backends.quantized.engine
+        )
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear, torch.nn.LSTM},
+                                                       dtype=torch.qint8, inplace=True)
+    model.separation_precision = precision
+    model.separation_backend = backend
+    return model
+
+def load_mmap_model(model_name=DEMUCS_MODEL_NAME, export_dir=None):
+    """
+    Loads a pretrained Demucs model with its weights memory-mapped read-only from a copy saved
+    under the user cache, so every process separating with it shares one page-cache copy
+    instead of holding a private one. The copy is saved on first use and kept until the torch
+    or demucs version changes. Falls back to a private copy where that doesn't work.
+    """
+    import torch
+    import demucs
+    from demucs.pretrained import get_model
+
+    settings = {"model": model_name, "torch": torch.__version__, "demucs": demucs.__version__}
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    export_root = export_dir or get_default_export_dir()
+    prefix = re.sub(r"[^\w.-]", "_", model_name) + "-weights-"
+    path = os.path.join(export_root, f"{prefix}{digest}.th")
+    if not os.path.exists(path):
+        model = get_model(model_name)
+        try:
+            os.makedirs(export_root, exist_ok=True)
+            partial_path = f"{path}.{os.getpid()}.part"
+            torch.save(model, partial_path)
+            os.replace(partial_path, path)
+        except OSError as e:
+            print(f"Warning: Could not save '{model_name}' for memory-mapping, loading it privately: {e}")
+            return model
+        for name in os.listdir(export_root):
+            if name.startswith(prefix) and name != os.path.basename(path):
+                try:
+                    os.remove(os.path.join(export_root, name))
+                except OSError:
+                    pass
+        del model
+    try:
+        # A whole pickled module, but one this app wrote itself into the user's own cache
+        return torch.load(path, mmap=True, weights_only=False)
+    except (TypeError, RuntimeError, OSError) as e:
+        # torch < 2.1 has no mmap, and a truncated file means a crash mid-save
+        print(f"Warning: Could not memory-map '{model_name}', loading it privately: {e}")
+        return get_model(model_name)
+
+def prepare_separation_model(model_name=DEMUCS_MODEL_NAME, backend="torch"):
+    """
+    Builds what load_separation_model() would build on first use (the memory-mapped weights
+    or the backend's export), so worker processes started next all find it ready instead of
+    each building their own. Meant to run in a throwaway process.
+    """
+    if backend == "torch":
+        load_mmap_model(model_name)
+    else:
+        export_separation_model(model_name, backend)
+
+def _network_without_stft(model):
+    """
+    Wraps an HTDemucs so its forward takes the mix and the mix's spectrogram and returns the
+    frequency branch's raw output and the time branch's waveform, leaving out the complex
+    STFT/iSTFT steps ONNX can't express. HTDemucs.forward is reused as-is, with those steps
+    swapped out on the instance for the duration of the call.
+    """
+    import torch
+
+    class NetworkWithoutStft(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, mix, mag):
+            spectral = []
+            model._spec = lambda _: mag
+            model._magnitude = lambda z: z
+            model._mask = lambda _, estimate: spectral.append(estimate) or estimate
+            model._ispec = lambda _, length: torch.zeros_like(mix)[:, None].expand(-1, len(model.sources), -1, -1)
+            try:
+                wave = model(mix)
+            finally:
+                for name in ("_spec", "_magnitude", "_mask", "_ispec"):
+                    delattr(model, name)
+            return spectral[0], wave
+
+    return NetworkWithoutStft()
+
+def cpu_signature():
+    """
+    Identifies this CPU closely enough to trust code compiled for it: the architecture, the
+    model name and the widest instruction set torch dispatches to.
+    """
+    import platform
+    import torch
+    name = platform.processor()
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            name = next((line.split(":", 1)[1].strip() for line in f if line.startswith("model name")), name)
+    except OSError:
+        pass
+    get_capability = getattr(torch.backends.cpu, "get_cpu_capability", None)
+    return f"{platform.machine()} {name} {get_capability() if get_capability else ''}".strip()
+
+def weights_fingerprint(model):
+    """Cheap digest of a model's weights, enough to notice that its checkpoint changed."""
+    digest = hashlib.sha256()
+    for name, tensor in model.state_dict().items():
+        digest.update(f"{name} {tuple(tensor.shape)} {tensor.double().sum().item():.9e}\n".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+def checkpoint_files(model_name=DEMUCS_MODEL_NAME):
+    """
+    Paths of the checkpoint files demucs' get_model() loads `model_name` from, found without
+    loading them: the HuggingFace hub cache of newer demucs releases, or the torch hub folder of
+    the legacy remote repo. Returns None when any of them isn't downloaded yet or can't be located.
+    """
+    import urllib.parse
+    import yaml
+    import torch
+    from demucs import pretrained
+
+    try:
+        from demucs import hf
+        from huggingface_hub import hf_hub_download
+    except ImportError:
+        hf = None
+    if hf is not None:
+        repo_id = f"{hf.DEFAULT_NAMESPACE}/{hf.hf_repo_name(model_name)}"
+        try:
+            with open(hf_hub_download(repo_id, f"{model_name}.yaml", local_files_only=True)) as f:
+                signatures = yaml.safe_load(f)["models"]
+            return [hf_hub_download(repo_id, f"{signature}.safetensors", local_files_only=True)
+                    for signature in signatures]
+        except Exception:
+            pass  # Not in the hub cache, get_model() falls back to the legacy repo as well
+
+    try:
+        urls = pretrained._parse_remote_files(pretrained.REMOTE_ROOT / "files.txt")
+        bag_path = pretrained.REMOTE_ROOT / f"{model_name}.yaml"
+        if bag_path.exists():
+            with open(bag_path) as f:
+                signatures = yaml.safe_load(f)["models"]
+        else:
+            signatures = [model_name]
+        paths = [os.path.join(torch.hub.get_dir(), "checkpoints",
+                              os.path.basename(urllib.parse.urlparse(urls[signature]).path))
+                 for signature in signatures]
+    except (AttributeError, KeyError, OSError):
+        return None
+    return paths if all(os.path.isfile(path) for path in paths) else None
+
+def export_separation_model(model_name=DEMUCS_MODEL_NAME, kind="onnx", export_dir=None):
+    """
+    Exports a pretrained Demucs model for the "onnx" or "compiled" backend and returns the
+    folder holding it. Each HTDemucs in the model becomes one file of its network without the
+    STFT (see _network_without_stft()): an ONNX model, or an AOTInductor package of native
+    code. Exports are built once and reused until the model name, torch or demucs changes;
+    compiled packages are also rebuilt when the model's checkpoint files or the CPU change. Building
+    one removes the outdated exports of the same model and kind.
+    """
+    import inspect
+    import warnings
+    from fractions import Fraction
+    import torch
+    import demucs
+    from demucs.apply import BagOfModels
+    from demucs.htdemucs import HTDemucs
+    from demucs.pretrained import get_model
+
+    settings = {"kind": kind, "model": model_name, "torch": torch.__version__, "demucs": demucs.__version__,
+                "format": MODEL_EXPORT_VERSION}
+    model = None
+    if kind == "onnx":
+        settings["opset"] = ONNX_EXPORT_OPSET
+    elif kind == "compiled":
+        # Keyed on the checkpoint files' names, sizes and times, so a cached package is found
+        # without loading the weights; only checkpoints not downloaded yet need get_model() first
+        paths = checkpoint_files(model_name)
+        if paths is None:
+            model = get_model(model_name)
+            paths = checkpoint_files(model_name)
+        if paths:
+            settings["weights"] = [f"{os.path.basename(path)} {os.path.getsize(path)} {os.stat(path).st_mtime_ns}"
+                                   for path in paths]
+        else:
+            settings["weights"] = weights_fingerprint(model)
+        settings["cpu"] = cpu_signature()
+    else:
+        raise ValueError(f"unknown export kind '{kind}', expected onnx or compiled")
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    export_root = export_dir or get_default_export_dir()
+    prefix = re.sub(r"[^\w.-]", "_", model_name) + f"-{kind}-"
+    folder = os.path.join(export_root, prefix + digest)
+    metadata_path = os.path.join(folder, MODEL_EXPORT_METADATA)
+    if os.path.exists(metadata_path):
+        return folder
+
+    model = model or get_model(model_name)
+    sub_models = list(model.models) if isinstance(model, BagOfModels) else [model]
+    weights = getattr(model, "weights", [[1.0] * len(model.sources)])
+    if not all(isinstance(sub_model, HTDemucs) and sub_model.cac for sub_model in sub_models):
+        raise ValueError(f"the {kind} backend only supports HTDemucs models, not '{model_name}'")
+    if len({Fraction(sub_model.segment) for sub_model in sub_models}) > 1:
+        raise ValueError(f"the {kind} backend needs every model in '{model_name}' to use the same segment length")
+
+    print(f"{'Exporting' if kind == 'onnx' else 'Compiling'} '{model_name}' for the {kind} backend, once "
+          f"(kept in {folder})...")
+    start = time.time()
+    os.makedirs(folder, exist_ok=True)
+    # torch 2.5+ defaults to the dynamo exporter, which can't trace HTDemucs' padding checks
+    onnx_options = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    entries = []
+    try:
+        for index, sub_model in enumerate(sub_models):
+            sub_model.eval()
+            mix = torch.zeros(1, sub_model.audio_channels, int(sub_model.segment * sub_model.samplerate))
+            mag = sub_model._magnitude(sub_model._spec(mix))
+            network = _network_without_stft(sub_model)
+            # The tracers' warnings are about shape checks, which hold for the one fixed chunk length
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                if kind == "onnx":
+                    file_name = f"model{index}.onnx"
+                    partial_path = os.path.join(folder, f"{file_name}.{os.getpid()}.part")
+                    # Deliberately not under no_grad: there, attention layers take a fused fast path ONNX lacks
+                    torch.onnx.export(network, (mix, mag), partial_path, input_names=["mix", "mag"],
+                                      output_names=["spec", "wave"], opset_version=ONNX_EXPORT_OPSET, **onnx_options)
+                else:
+                    file_name = f"model{index}.pt2"
+                    # AOTInductor insists on the .pt2 extension
+                    partial_path = os.path.join(folder, f"model{index}.{os.getpid()}.part.pt2")
+                    with torch.no_grad():
+                        program = torch.export.export(network, (mix, mag), strict=False)
+                        # Freezing lets inductor prepack the conv/linear weights for this CPU's kernels
+                        torch._inductor.aoti_compile_and_package(program, package_path=partial_path,
+                                                                 inductor_configs={"freezing": True})
+            os.replace(partial_path, os.path.join(folder, file_name))
+            entries.append({"file": file_name, "hop_length": sub_model.hop_length, "nfft": sub_model.nfft})
+    except BaseException:
+        shutil.rmtree(folder, ignore_errors=True)
+        raise
+    # Written last, so a folder without it is an interrupted export and gets redone
+    write_json_atomic(metadata_path, {
+        "settings": settings,
+        "samplerate": model.samplerate,
+        "audio_channels": model.audio_channels,
+        "sources": list(model.sources),
+        "segment": str(Fraction(sub_models[0].segment)),
+        "weights": [list(map(float, model_weights)) for model_weights in weights],
+        "models": entries,
+    })
+    print(f"Built {len(entries)} model(s) in {time.time() - start:.1f}s")
+    for name in os.listdir(export_root):
+        if name.startswith(prefix) and name != os.path.basename(folder):
+            shutil.rmtree(os.path.join(export_root, name), ignore_errors=True)
+    return folder
+
+class ExportedSeparationModel:
+    """
+    A Demucs model exported by export_separation_model(), run without the torch model.
+
+    It offers what apply_model() uses of a torch model (samplerate, sources, audio_channels,
+    segment, valid_length(), to(), eval() and calling it on a chunk), so the rest of the
+    separation code works the same on every backend. The STFT around each exported network
+    runs in torch, and the models of a bag are averaged here with the bag's weights, so
+    apply_model() sees a single model. Subclasses load and run the networks themselves.
+    """
+
+    def __init__(self, folder):
+        import types
+        from fractions import Fraction
+
+        with open(os.path.join(folder, MODEL_EXPORT_METADATA), "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+        self.samplerate = metadata["samplerate"]
+        self.audio_channels = metadata["audio_channels"]
+        self.sources = metadata["sources"]
+        self.segment = Fraction(metadata["segment"])
+        self.weights = metadata["weights"]
+        self.training_length = int(self.segment * self.samplerate)
+        self.files = [os.path.join(folder, entry["file"]) for entry in metadata["models"]]
+        # Just what HTDemucs' STFT helpers read from the model
+        self.stfts = [types.SimpleNamespace(hop_length=entry["hop_length"], nfft=entry["nfft"], cac=True,
+                                            wiener_iters=0) for entry in metadata["models"]]
+
+    def run_network(self, index, mix, mag):
+        """Runs exported network `index`; returns its (spectrogram, waveform) outputs as tensors."""
+        raise NotImplementedError
+
+    def valid_length(self, length):
+        """Like HTDemucs, every chunk is padded to the length the model was trained on."""
+        return self.training_length
+
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
+
+    def __call__(self, mix):
+        import torch
+        from demucs.htdemucs import HTDemucs
+
+        estimates = 0.0
+        for index, (stft, model_weights) in enumerate(zip(self.stfts, self.weights)):
+            z = HTDemucs._spec(stft, mix)
+            spec, wave = self.run_network(index, mix.contiguous(), HTDemucs._magnitude(stft, z).contiguous())
+            zout = HTDemucs._mask(stft, z, spec)
+            estimate = wave + HTDemucs._ispec(stft, zout, self.training_length)
+            estimates = estimates + estimate * torch.tensor(model_weights)[:, None, None]
+        totals = torch.tensor(self.weights).sum(dim=0)
+        return estimates / totals[:, None, None]
+
+class OnnxSeparationModel(ExportedSeparationModel):
+    """Runs the exported networks with ONNX Runtime on the CPU, on `threads` intra-op threads."""
+
+    def __init__(self, folder, threads=None):
+        super().__init__(folder)
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads or budget_cores()
+        options.inter_op_num_threads = 1
+        self.sessions = [onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+                         for path in self.files]
+
+    def run_network(self, index, mix, mag):
+        import torch
+        spec, wave = self.sessions[index].run(None, {"mix": mix.numpy(), "mag": mag.numpy()})
+        return torch.from_numpy(spec), torch.from_numpy(wave)
+
+class CompiledSeparationModel(ExportedSeparationModel):
+    """Runs the exported networks as AOTInductor packages, native code compiled for this CPU."""
+
+    def __init__(self, folder):
+        super().__init__(folder)
+        import torch
+        self.runners = [torch._inductor.aoti_load_package(path) for path in self.files]
+
+    def run_network(self, index, mix, mag):
+        spec, wave = self.runners[index](mix, mag)
+        return spec, wave
+
+def apply_separation_model(model, mix, shifts=1):
+    """
+    apply_model() with the settings the demucs CLI uses, under bfloat16 autocast for models
+    loaded with precision "bf16". `mix` is (batch, channels, samples); returns float32 sources.
+    """
+    import torch
+    from demucs.apply import apply_model
+    if getattr(model, "separation_precision", "fp32") == "bf16":
+        autocast = torch.autocast("cpu", dtype=torch.bfloat16)
+    else:
+        autocast = contextlib.nullcontext()
+    with torch.no_grad(), autocast:
+        return apply_model(model, mix, shifts=shifts, split=True, overlap=0.25).float()
+
+def ffmpeg_decode_command(input_file, samplerate, channels, mono, ffmpeg_exe_path="ffmpeg"):
+    """
+    ffmpeg arguments that decode an input's first audio stream, whatever its format, to
+    interleaved float32 PCM on stdout, with demucs' channel handling: a mono source is copied
+    to every channel, extra channels beyond `channels` are dropped rather than downmixed.
+    """
+    layout = "stereo" if channels == 2 else f"{channels}c"
+    mapping = "|".join(f"c{index}=c{0 if mono else index}" for index in range(channels))
+    return [
+        ffmpeg_exe_path,
+        "-i", input_file,
+        "-map", "0:a:0",
+        "-threads", "1",
+        "-af", f"pan={layout}|{mapping}",
+        "-f", "f32le", "-ar", str(samplerate),
+        "pipe:1",
+        "-loglevel", "error"
+    ]
+
+def decode_track_audio(input_file, samplerate, channels, ffmpeg_exe_path="ffmpeg", info=None):
+    """
+    Decodes any ffmpeg-readable file to a (channels, samples) float32 tensor in one ffmpeg run,
+    using `info` from probe_audio() when the caller already has it.
+    Raises RuntimeError if the file holds no audio or ffmpeg fails.
+    """
+    import numpy as np
+    import torch
+
+    info = info or probe_audio(input_file, ffmpeg_exe_path)
+    if not info:
+        raise RuntimeError(f"{os.path.basename(input_file)} is not an audio file ffmpeg can read")
+    command = ffmpeg_decode_command(input_file, samplerate, channels, info["mono"], ffmpeg_exe_path)
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg could not decode {os.path.basename(input_file)}: "
+                           f"{process.stderr.decode(errors='ignore').strip()}")
+    pcm = np.frombuffer(process.stdout, dtype="<f4")
+    return torch.from_numpy(pcm[:pcm.shape[0] // channels * channels].reshape(-1, channels).T.copy())
+
+def load_track_audio(model, audio_path):
+    """Decodes an audio file to a (channels, samples) float tensor at the model's sample rate."""
+    return decode_track_audio(audio_path, model.samplerate, model.audio_channels, get_ffmpeg_exe_path())
+
+class PcmBuffer:
+    """
+    A track decoded once to interleaved float32 PCM that every reader views instead of copying:
+    audio() is a zero-copy (channels, samples) view, so separation, silence detection, the cache
+    hash and the peak pyramid all read the same memory. A track only this process reads stays
+    in its RAM. share() moves it into a multiprocessing.shared_memory block for --jobs workers;
+    a shared PcmBuffer pickles as the block's name, so each worker maps the block rather than
+    receiving or decoding its own copy. Only the instance that created a block unlinks it on
+    close(). Nothing is ever written to disk.
+    """
+
+    def __init__(self, pcm, samplerate, channels, shm=None, owner=False):
+        self.pcm = pcm
+        self.samplerate = samplerate
+        self.channels = channels
+        self._shm = shm
+        self._owner = owner
+
+    def __reduce__(self):
+        if self._shm is None:
+            return (PcmBuffer, (self.pcm, self.samplerate, self.channels))
+        return (PcmBuffer.attach, (self._shm.name, self.pcm.shape[0], self.samplerate, self.channels))
+
+    @classmethod
+    def attach(cls, name, frames, samplerate, channels):
+        """Maps a block another process made with share(), without copying it."""
+        import numpy as np
+        from multiprocessing import shared_memory
+
+        shm = shared_memory.SharedMemory(name=name)
+        return cls(_shared_block_array(shm, frames, channels), samplerate, channels, shm=shm)
+
+    @classmethod
+    def decode(cls, input_file, samplerate, channels, ffmpeg_exe_path="ffmpeg", info=None):
+        """
+        Decodes `input_file` like decode_track_audio(), keeping ffmpeg's interleaved output as
+        it is instead of transposing it into a second copy.
+        Raises RuntimeError if the file holds no audio or ffmpeg fails.
+        """
+        import tempfile
+        import numpy as np
+
+        info = info or probe_audio(input_file, ffmpeg_exe_path)
+        if not info:
+            raise RuntimeError(f"{os.path.basename(input_file)} is not an audio file ffmpeg can read")
+        command = ffmpeg_decode_command(input_file, samplerate, channels, info["mono"], ffmpeg_exe_path)
+        with tempfile.TemporaryFile() as stderr_file:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file)
+            # A bytearray, so the samples are writable without being copied out of bytes
+            data = bytearray()
+            try:
+                for chunk in iter(lambda: process.stdout.read(1024 * 1024), b""):
+                    data += chunk
+                process.wait()
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                process.stdout.close()
+            if process.returncode != 0:
+                stderr_file.seek(0)
+                raise RuntimeError(f"ffmpeg could not decode {os.path.basename(input_file)}: "
+                                   f"{stderr_file.read().decode(errors='ignore').strip()}")
+        frames = len(data) // (4 * channels)
+        del data[frames * 4 * channels:]
+        return cls(np.frombuffer(data, dtype="<f4").reshape(frames, channels), samplerate, channels)
+
+    def share(self):
+        """
+        Returns this track moved into a new shared memory block for worker processes to map,
+        and releases this buffer. An empty track has nothing to share and is returned as is.
+        """
+        from multiprocessing import shared_memory
+
+        if self._shm is not None or not self.pcm.nbytes:
+            return self
+        shm = shared_memory.SharedMemory(create=True, size=self.pcm.nbytes)
+        pcm = _shared_block_array(shm, *self.pcm.shape)
+        pcm[...] = self.pcm
+        self.close()
+        return PcmBuffer(pcm, self.samplerate, self.channels, shm=shm, owner=True)
+
+    @property
+    def seconds(self):
+        return self.pcm.shape[0] / self.samplerate
+
+    @property
+    def nbytes(self):
+        return self.pcm.nbytes
+
+    def audio(self):
+        """The whole track as a (channels, samples) float32 tensor sharing the buffer's memory."""
+        import torch
+        return torch.from_numpy(self.pcm).T
+
+    def close(self):
+        """
+        Releases the samples; a shared block is unmapped, and unlinked if this instance created it.
+        Every view from audio() should be dropped first. A block something still views is never
+        unmapped under it: it is reported and unmapped by a later close() once the views are gone.
+        """
+        self.pcm = None
+        shm, self._shm = self._shm, None
+        if shm is None:
+            return
+        if self._owner:
+            # Unlinking works while mapped; the memory goes once the last mapping does
+            shm.unlink()
+        _pending_shared_blocks.append(shm)
+        for block in list(_pending_shared_blocks):
+            try:
+                block.close()
+                _pending_shared_blocks.remove(block)
+            except BufferError:
+                if block is shm:
+                    print(f"Warning: Shared PCM block '{shm.name}' is still viewed by this process; "
+                          f"unmapping it later.")
+
+# Shared PCM blocks whose close() found views still alive, retried by every later close()
+_pending_shared_blocks = []
+
+def _shared_block_array(shm, frames, channels):
+    """
+    A (frames, channels) float32 array over a shared memory block. np.frombuffer() holds a buffer
+    export, so the block refuses to close (BufferError) while any view of it is alive instead of
+    being unmapped under it.
+    """
+    import numpy as np
+    return np.frombuffer(shm.buf, dtype="<f4", count=frames * channels).reshape(frames, channels)
+
+def find_sound_spans(wav, samplerate, chunk_samples, shift_samples):
+    """
+    Finds the parts of a (channels, samples) track worth separating, from the energy of
+    SILENCE_FRAME_SECONDS frames computed in one vectorised pass; frames below
+    SILENCE_THRESHOLD_DB are silent.
+    Each stretch of audio is widened by the margins of segment_margins() and starts on
+    apply_model()'s chunk grid, like plan_segments() lays out segments, so every audible sample
+    is separated from the same chunks as in a single pass. Gaps left shorter than
+    SILENCE_MIN_SECONDS are separated anyway.
+    Returns the (start, end) sample spans to separate, in order.
+    """
+    import numpy as np
+
+    audio = wav.numpy() if hasattr(wav, "numpy") else wav
+    length = audio.shape[-1]
+    frame = max(1, int(SILENCE_FRAME_SECONDS * samplerate))
+    frames = -(-length // frame)
+    power = np.zeros(frames * frame, dtype=np.float32)
+    # einsum sums the channels without materialising a squared copy of the whole track
+    power[:length] = np.einsum("cs,cs->s", audio, audio) / audio.shape[0]
+    frame_db = 10 * np.log10(power.reshape(frames, frame).mean(1) + 1e-20)
+    sound = np.concatenate([[False], frame_db >= SILENCE_THRESHOLD_DB, [False]])
+    edges = np.flatnonzero(np.diff(sound.astype(np.int8))) * frame
+
+    stride, head, tail = segment_margins(chunk_samples, shift_samples)
+    spans = []
+    for sound_start, sound_end in zip(edges[0::2], edges[1::2]):
+        start = max(0, (int(sound_start) - head) // stride * stride)
+        end = min(length, int(sound_end) + tail)
+        if spans and start - spans[-1][1] < SILENCE_MIN_SECONDS * samplerate:
+            spans[-1] = (spans[-1][0], max(spans[-1][1], end))
+        else:
+            spans.append((start, end))
+    return spans
+
+def separate_sound_spans(separate, normalized, spans, source_count):
+    """
+    Runs `separate` (normalised (channels, samples) tensor -> (sources, channels, samples)
+    tensor) over each span of `normalized` only and splices the results in at their exact
+    offsets, leaving the normalised output silent everywhere else.
+    """
+    import torch
+
+    sources = torch.zeros((source_count,) + tuple(normalized.shape))
+    for start, end in spans:
+        sources[..., start:end] = separate(normalized[:, start:end])
+    return sources
+
+def separate_track_audio(model, wav, two_stems=TWO_STEMS, stems_wanted=None, segment_pool=None, shifts=1,
+                         threads=None, skip_silence=False, stats=None):
+    """
+    Runs an already loaded model over a decoded track, mirroring `demucs --two-stems`, on
+    `threads` cores reserved from the CPU budget (all of them by default).
+    With a `segment_pool`, the track is split across its worker processes instead.
+    With `skip_silence`, long silences (see find_sound_spans()) are not separated; the
+    seconds saved are added to `stats["silence_seconds_skipped"]` when a dict is given.
+    Returns a dict of {stem_name: (channels, samples) tensor} with the stem and its complement,
+    limited to `stems_wanted` when given so unwanted stems are never materialised.
+    """
+    import torch
+
+    def separate(audio):
+        if segment_pool:
+            return segment_pool.separate(audio, shifts=shifts)
+        with cpu_reservation(threads or budget_cores(), "separate") as cores:
+            torch.set_num_threads(cores)
+            return apply_separation_model(model, audio[None], shifts=shifts)[0]
+
+    # Same normalisation the demucs CLI applies before/after the model
+    ref = wav.mean(0)
+    mean = ref.mean()
+    std = ref.std() + 1e-8
+    # One planar buffer, written in place, whatever the layout of `wav` (e.g. a PcmBuffer view)
+    normalized = torch.empty(tuple(wav.shape))
+    torch.sub(wav, mean, out=normalized).div_(std)
+    if skip_silence:
+        spans = find_sound_spans(wav, model.samplerate, model_chunk_samples(model), int(0.5 * model.samplerate))
+        skipped_seconds = (wav.shape[-1] - sum(end - start for start, end in spans)) / model.samplerate
+        if skipped_seconds > 0:
+            print(f"Skipping {skipped_seconds:.1f}s of silence ({len(spans)} span(s) left to separate)")
+        if stats is not None:
+            stats["silence_seconds_skipped"] = stats.get("silence_seconds_skipped", 0.0) + skipped_seconds
+        sources = separate_sound_spans(separate, normalized, spans, len(model.sources))
+    else:
+        sources = separate(normalized)
+    return select_stems(model, sources * std + mean, two_stems, stems_wanted)
+
+def select_stems(model, sources, two_stems=TWO_STEMS, stems_wanted=None):
+    """Turns the model's (sources, channels, samples) output into {stem_name: tensor} like `--two-stems`."""
+    stems = dict(zip(model.sources, sources))
+    selected = stems.pop(two_stems)
+    result = {}
+    if stems_wanted is None or two_stems in stems_wanted:
+        result[two_stems] = selected
+    if stems_wanted is None or f"no_{two_stems}" in stems_wanted:
+        result[f"no_{two_stems}"] = sum(stems.values())
+    return result
+
+# Model held by each SegmentPool or --jobs worker process, loaded once by _init_separation_worker()
+_worker_model = None
+
+_worker_threads = None
+
+# Where a track worker reports job manifest progress, a ManifestForwarder to the parent's manifest
+_worker_manifest = None
+
+def _init_separation_worker(model_name, threads_per_worker, cpu_budget=None, precision="fp32", backend="torch",
+                            mp3_encoder=None, manifest_updates=None):
+    """
+    Process pool initializer: joins the parent's CPU budget, caps torch's intra-op threads and
+    loads the model once per worker, with the parent's precision, backend and MP3 encoder.
+    Job manifest updates go to the parent through `manifest_updates` (see ManifestForwarder).
+    """
+    global _worker_model, _worker_threads, _worker_manifest, _cpu_budget, _mp3_encoder
+    import torch
+    _cpu_budget = cpu_budget
+    _mp3_encoder = mp3_encoder
+    _worker_manifest = ManifestForwarder(manifest_updates) if manifest_updates is not None else None
+    _worker_threads = threads_per_worker
+    torch.set_num_threads(threads_per_worker)
+    _worker_model = load_separation_model(model_name, precision, backend)
+
+def _separate_segment(segment, shifts):
+    """Runs the worker's model over one normalised (channels, samples) float32 segment."""
+    import torch
+    with cpu_reservation(_worker_threads, "separate") as cores:
+        torch.set_num_threads(cores)
+        sources = apply_separation_model(_worker_model, torch.from_numpy(segment)[None], shifts=shifts)[0]
+    return sources.numpy()
+
+def model_chunk_samples(model):
+    """Length of the chunks apply_model() cuts a track into for this model, in samples."""
+    sub_models = getattr(model, "models", [model])
+    return int(model.samplerate * max(float(sub_model.segment) for sub_model in sub_models))
+
+def segment_margins(chunk_samples, shift_samples):
+    """
+    Returns (stride, head, tail) for segments separated on their own: apply_model()'s chunk
+    stride, and how many samples at a segment's start and end differ from a single pass.
+    """
+    stride = int((1 - 0.25) * chunk_samples)  # apply_model's stride at overlap=0.25
+    # A segment's first `head` samples miss the chunk that started before it, and its last
+    # `tail` samples see chunks that run past its end into zero padding
+    head = chunk_samples - stride + shift_samples
+    tail = chunk_samples + shift_samples
+    return stride, head, tail
+
+def plan_segments(length, segment_samples, chunk_samples, shift_samples, crossfade_samples):
+    """
+    Splits `length` samples into overlapping (start, end) segments for separate model runs.
+    Returns (bounds, fades), where fades[k] is the (start, end) crossfade between segment k
+    and k+1.
+
+    Segment starts sit on apply_model()'s internal chunk grid, and neighbours overlap by enough
+    that every crossfade sample was computed by both from complete chunks with real audio on
+    either side (including the random shift). There both segments produce what a single pass
+    would have, so the stitched result matches it instead of merely approximating it.
+    """
+    stride, head, tail = segment_margins(chunk_samples, shift_samples)
+    advance = (segment_samples - head - tail - crossfade_samples) // stride * stride
+    if advance < stride:
+        minimum_samples = head + tail + crossfade_samples + stride
+        raise ValueError(f"Segments must be at least {minimum_samples} samples long for this model.")
+
+    bounds = [(0, min(segment_samples, length))]
+    while bounds[-1][1] < length:
+        start = bounds[-1][0] + advance
+        bounds.append((start, min(start + segment_samples, length)))
+    fades = [(bounds[k + 1][0] + head, bounds[k][1] - tail) for k in range(len(bounds) - 1)]
+    return bounds, fades
+
+def plan_preview_segments(length, preview_samples, chunk_samples, shift_samples, crossfade_samples):
+    """
+    Two-segment variant of plan_segments() for progressive separation: a short first segment
+    whose first `preview_samples` already match a single pass, then the rest of the track,
+    starting on the chunk grid early enough to crossfade inside the preview.
+    Returns (bounds, fades) for stitch_segments(); a single segment if the track is that short.
+    """
+    stride, head, tail = segment_margins(chunk_samples, shift_samples)
+    rest_start = (preview_samples - crossfade_samples - head) // stride * stride
+    if rest_start <= 0:
+        minimum_samples = head + crossfade_samples + stride
+        raise ValueError(f"Previews must be at least {minimum_samples} samples long for this model.")
+    if preview_samples + tail >= length:
+        return [(0, length)], []
+    fade_start = rest_start + head
+    return [(0, preview_samples + tail), (rest_start, length)], [(fade_start, fade_start + crossfade_samples)]
+
+def segment_weight(index, bounds, fades):
+    """
+    Weight of segment `index` over its samples when overlap-adding: 0 before the fade-in it shares
+    with the previous segment, 1 in between, 0 after the fade-out into the next one. The linear
+    fade-in and fade-out of a boundary sum to exactly 1.
+    """
+    import numpy as np
+
+    start, end = bounds[index]
+    weight = np.ones(end - start, dtype=np.float32)
+    if index > 0:
+        fade_start, fade_end = fades[index - 1]
+        weight[:fade_start - start] = 0.0
+        weight[fade_start - start:fade_end - start] = (np.arange(fade_end - fade_start, dtype=np.float32) + 0.5) / (fade_end - fade_start)
+    if index < len(bounds) - 1:
+        fade_start, fade_end = fades[index]
+        weight[fade_start - start:fade_end - start] = 1.0 - (np.arange(fade_end - fade_start, dtype=np.float32) + 0.5) / (fade_end - fade_start)
+        weight[fade_end - start:] = 0.0
+    return weight
+
+def stitch_segments(segment_outputs, bounds, fades, length):
+    """
+    Joins per-segment model outputs of shape (sources, channels, samples) back into one array,
+    crossfading with the same linear fades as segment_weight(). Each fade is computed as
+    previous + fade-in * (next - previous) rather than as a weighted sum, so wherever
+    neighbouring segments agree the result is exactly their output, with no rounding.
+    """
+    import numpy as np
+
+    sources, channels = segment_outputs[0].shape[:2]
+    stitched = np.zeros((sources, channels, length), dtype=np.float32)
+    for index, ((start, end), output) in enumerate(zip(bounds, segment_outputs)):
+        if index == 0:
+            stitched[..., start:end] = output
+            continue
+        fade_start, fade_end = fades[index - 1]
+        fade_in = (np.arange(fade_end - fade_start, dtype=np.float32) + 0.5) / (fade_end - fade_start)
+        previous = stitched[..., fade_start:fade_end]
+        previous += (output[..., fade_start - start:fade_end - start] - previous) * fade_in
+        stitched[..., fade_end:end] = output[..., fade_end - start:]
+    return stitched
+
+def segment_plan_settings(model, segment_seconds):
+    """
+    (segment, chunk, shift, crossfade) lengths in samples for plan_segments() with this model.
+    Raises ValueError right away if `segment_seconds` is too short for the model.
+    """
+    segment_samples = int(segment_seconds * model.samplerate)
+    chunk_samples = model_chunk_samples(model)
+    shift_samples = int(0.5 * model.samplerate)  # apply_model's max random shift
+    crossfade_samples = int(SEGMENT_CROSSFADE_SECONDS * model.samplerate)
+    plan_segments(segment_samples + 1, segment_samples, chunk_samples, shift_samples, crossfade_samples)
+    return segment_samples, chunk_samples, shift_samples, crossfade_samples
+
+class SegmentPool:
+    """
+    Separates one track across several worker processes by cutting it into overlapping
+    segments and crossfading the results back together (see plan_segments()).
+
+    Each worker loads the model once and gets an equal share of the cores for torch, so
+    the pool uses the whole machine without oversubscribing it.
+    """
+
+    def __init__(self, model, workers, segment_seconds=DEFAULT_SEGMENT_SECONDS, model_name=DEMUCS_MODEL_NAME):
+        self.workers = workers
+        self.samplerate = model.samplerate
+        # Fails on a too-short segment length now rather than on the first track
+        (self.segment_samples, self.chunk_samples,
+         self.shift_samples, self.crossfade_samples) = segment_plan_settings(model, segment_seconds)
+        self.threads_per_worker = max(1, budget_cores() // workers)
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_separation_worker,
+            initargs=(model_name, self.threads_per_worker, _cpu_budget,
+                      getattr(model, "separation_precision", "fp32"), getattr(model, "separation_backend", "torch")),
+        )
+
+    def separate(self, normalized_wav, shifts=1):
+        """Separates a normalised (channels, samples) tensor; returns a (sources, channels, samples) tensor."""
+        import torch
+
+        length = normalized_wav.shape[-1]
+        bounds, fades = plan_segments(length, self.segment_samples, self.chunk_samples,
+                                      self.shift_samples, self.crossfade_samples)
+        audio = normalized_wav.contiguous().numpy()
+        futures = [self.executor.submit(_separate_segment, audio[:, start:end], shifts) for start, end in bounds]
+        outputs = []
+        for (_, end), future in zip(bounds, futures):
+            outputs.append(future.result())
+            report_progress("separate", len(outputs) / len(futures), audio_seconds=end / self.samplerate,
+                            audio_seconds_total=length / self.samplerate)
+        return torch.from_numpy(stitch_segments(outputs, bounds, fades, length))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+def write_planned_stems(stems, samplerate, folder, track_name, plan, ffmpeg_exe_path):
+    """
+    Writes in-memory stems straight to their planned outputs, in parallel: MP3 and other encoded
+    stems go into their own encoder, WAV stems are saved directly.
+    Returns (converted_count, failed_count), matching encode_stems().
+    """
+    from demucs.audio import save_audio
+
+    def write_stem(stem_name, stem_audio):
+        output_path = stem_output_path(folder, track_name, stem_name, plan)
+        if plan[stem_name]["format"] != "wav":
+            return encode_pcm(stem_audio, samplerate, output_path, plan[stem_name], ffmpeg_exe_path)
+        save_audio(stem_audio, output_path, samplerate=samplerate)
+        return True, os.path.basename(output_path)
+
+    converted_count = 0
+    failed_count = 0
+    with ThreadPoolExecutor(max_workers=len(stems)) as executor:
+        future_to_stem = {
+            executor.submit(write_stem, stem_name, stem_audio): stem_name
+            for stem_name, stem_audio in stems.items()
+        }
+        for future in as_completed(future_to_stem):
+            try:
+                success, result_message = future.result()
+            except Exception as exc:
+                success, result_message = False, str(exc)
+            if success:
+                print(f"  SUCCESS: streamed [{future_to_stem[future]}] -> {result_message}")
+                converted_count += 1
+            else:
+                print(f"  FAILED streaming [{future_to_stem[future]}]:")
+                for line in result_message.splitlines():
+                    print(f"    {line}")
+                failed_count += 1
+    return converted_count, failed_count
+
+def new_track_result(input_file):
+    """The per-track result dict filled in by separate_batch_track() and the batch pipeline."""
+    return {"track": os.path.basename(input_file), "audio_seconds": 0.0, "ok": False, "error": None,
+            "disk_bytes_written": 0, "wav_bytes_avoided": 0, "silence_seconds_skipped": 0.0}
+
+def encode_track_stems(stems, samplerate, input_file, wav_folder, ffmpeg_exe_path, plan, stream, result,
+                       manifest=None):
+    """
+    Turns separated stems into the outputs in `plan` in `wav_folder`, streamed into the encoder
+    or through WAV files, and records bytes written and success in `result`.
+    Once the WAVs are on disk the track is marked "separated" in `manifest`, so an interrupted
+    run can pick up from them without separating again.
+    """
+    from demucs.audio import save_audio
+
+    track_name = track_name_for(input_file)
+    if stream:
+        converted_count, failed_count = write_planned_stems(stems, samplerate, wav_folder,
+                                                            track_name, plan, ffmpeg_exe_path)
+        # What save_audio's 16-bit WAVs would have cost (44-byte header + PCM)
+        result["wav_bytes_avoided"] = sum(
+            44 + audio.numel() * 2 for stem_name, audio in stems.items() if plan[stem_name]["format"] != "wav"
+        )
+    else:
+        for stem_name, stem_audio in stems.items():
+            wav_path = os.path.join(wav_folder, f"{track_name} [{stem_name}].wav")
+            save_audio(stem_audio, wav_path, samplerate=samplerate)
+            if plan[stem_name]["format"] != "wav":
+                result["disk_bytes_written"] += os.path.getsize(wav_path)
+        if manifest:
+            manifest.advance(input_file, "separated", outputs=separated_wav_paths(wav_folder, track_name, plan))
+        converted_count, failed_count = finalize_stem_wavs(wav_folder, track_name, plan, ffmpeg_exe_path)
+
+    for stem_name in stems:
+        output_path = stem_output_path(wav_folder, track_name, stem_name, plan)
+        if os.path.exists(output_path):
+            result["disk_bytes_written"] += os.path.getsize(output_path)
+    if failed_count:
+        result["error"] = f"{failed_count} output conversion(s) failed"
+    else:
+        result["ok"] = True
+
+def separate_batch_track(model, input_file, wav_folder, ffmpeg_exe_path, plan, stream=False, segment_pool=None,
+                         threads=None, window_seconds=None, skip_silence=False, pcm=None, manifest=None):
+    """
+    Separates one track with an already loaded model (or across `segment_pool`) and leaves only
+    the outputs in `plan` in `wav_folder`.
+    With `stream`, stems are piped straight into the encoder instead of going through WAV files.
+    With `window_seconds`, the track is separated window by window in constant memory instead
+    (see separate_track_windowed()). With `skip_silence`, long silences are not separated.
+    `pcm` is the track already decoded to a PcmBuffer, if the caller has it; otherwise it is
+    decoded to one for the length of the call. Once the stem WAVs are written the track is marked
+    "separated" in `manifest`.
+    Returns a result dict with the track name, audio length, bytes written to disk, success flag,
+    error message and the seconds its "decode", "separate" and "encode" stages took.
+    """
+    result = new_track_result(input_file)
+    result["stage_seconds"] = {}
+    busy_start = time.time()
+    own_pcm = None
+    try:
+        if window_seconds:
+            separate_track_windowed(model, input_file, wav_folder, ffmpeg_exe_path, plan, result,
+                                    window_seconds, threads=threads, skip_silence=skip_silence)
+            result["stage_seconds"]["separate"] = time.time() - busy_start
+        else:
+            if pcm is None or (pcm.samplerate, pcm.channels) != (model.samplerate, model.audio_channels):
+                pcm = own_pcm = PcmBuffer.decode(input_file, model.samplerate, model.audio_channels,
+                                                 ffmpeg_exe_path)
+                result["stage_seconds"]["decode"] = time.time() - busy_start
+            result["audio_seconds"] = pcm.seconds
+            stage_start = time.time()
+            stems = separate_track_audio(model, pcm.audio(), stems_wanted=plan, segment_pool=segment_pool,
+                                         threads=threads, skip_silence=skip_silence, stats=result)
+            result["stage_seconds"]["separate"] = time.time() - stage_start
+            stage_start = time.time()
+            encode_track_stems(stems, model.samplerate, input_file, wav_folder, ffmpeg_exe_path, plan, stream, result,
+                               manifest=manifest)
+            result["stage_seconds"]["encode"] = time.time() - stage_start
+    except Exception as e:
+        result["error"] = str(e)
+    finally:
+        if own_pcm is not None:
+            own_pcm.close()
+    # Time actually spent on this track, excluding any wait in a worker pool's queue
+    result["busy_seconds"] = time.time() - busy_start
+    return result
+
+def decode_audio_blocks(input_file, samplerate, channels, block_samples, ffmpeg_exe_path="ffmpeg"):
+    """
+    Decodes an audio file like load_track_audio() does, but yields it as (channels, samples)
+    float32 arrays of at most `block_samples` while ffmpeg is still decoding, so the whole track
+    never has to fit in memory. Raises RuntimeError if ffmpeg fails.
+    """
+    import tempfile
+    import numpy as np
+
+    info = probe_audio(input_file, ffmpeg_exe_path)
+    if not info:
+        raise RuntimeError(f"{os.path.basename(input_file)} is not an audio file ffmpeg can read")
+    command = ffmpeg_decode_command(input_file, samplerate, channels, info["mono"], ffmpeg_exe_path)
+    with tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file)
+        try:
+            frame_bytes = 4 * channels
+            while True:
+                data = process.stdout.read(block_samples * frame_bytes)
+                if len(data) < frame_bytes:
+                    break
+                block = np.frombuffer(data[:len(data) // frame_bytes * frame_bytes], dtype="<f4")
+                yield np.ascontiguousarray(block.reshape(-1, channels).T)
+            process.wait()
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+        if process.returncode != 0:
+            stderr_file.seek(0)
+            message = stderr_file.read().decode(errors="ignore").strip()
+            raise RuntimeError(f"ffmpeg could not decode {os.path.basename(input_file)}: {message}")
+
+def encode_raw_pcm(raw_path, samplerate, channels, output_path, entry, ffmpeg_path="ffmpeg", gain=1.0):
+    """
+    Encodes a raw interleaved float32 PCM file to the output plan `entry`'s format, scaled by
+    `gain`: MP3 at the entry's bitrate (in-process with lameenc when it can), the entry's other
+    encoder profile, or a 16-bit WAV like save_audio() writes.
+    Returns (True, output_filename_basename) on success, or (False, error_message_string) on failure.
+    """
+    import numpy as np
+
+    if (entry["format"] == "mp3" and os.path.getsize(raw_path)
+            and lame_can_encode(samplerate, channels, entry["bitrate"])):
+        def raw_blocks():
+            with open(raw_path, "rb") as raw_file:
+                while True:
+                    block = np.fromfile(raw_file, dtype="<f4", count=LAME_BLOCK_FRAMES * channels)
+                    if not block.size:
+                        return
+                    yield float_to_pcm16(block.reshape(-1, channels).T * gain).tobytes()
+        return lame_encode_blocks(raw_blocks(), samplerate, channels, output_path, entry["bitrate"])
+
+    command = [
+        ffmpeg_path,
+        "-f", "f32le", "-ar", str(samplerate), "-ac", str(channels),
+        "-i", raw_path,
+    ]
+    if gain != 1.0:
+        command += ["-af", f"volume={gain:.9f}"]
+    command += [
+        *ffmpeg_encoder_args(entry),
+        output_path,
+        "-y",
+        "-loglevel", "error"
+    ]
+    try:
+        with cpu_reservation(ENCODER_THREADS, "encode"):
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = process.communicate()
+
+        if process.returncode == 0:
+            return True, os.path.basename(output_path)
+        error_message = f"Error encoding {os.path.basename(output_path)}."
+        decoded_stderr = stderr.decode(errors='ignore').strip()
+        if decoded_stderr:
+            error_message += f"\n  FFmpeg stderr: {decoded_stderr}"
+        return False, error_message
+    except FileNotFoundError:
+        return False, f"Error: '{ffmpeg_path}' command not found. Ensure ffmpeg is installed and in PATH."
+    except Exception as e:
+        return False, f"Unexpected error during ffmpeg encoding of {os.path.basename(output_path)}: {e}"
+
+def separate_track_windowed(model, input_file, wav_folder, ffmpeg_exe_path, plan, result,
+                            window_seconds=DEFAULT_SEGMENT_SECONDS, threads=None, shifts=1, skip_silence=False):
+    """
+    Separates one track window by window so memory stays the same whatever its length. The
+    track is decoded once, block by block, into a raw float32 file while the length, mean and
+    deviation the whole-track normalisation needs are measured. Each window of `window_seconds`
+    is then read back and separated on its own (laid out by plan_segments(), so the result
+    matches a single pass), and finished samples are appended to a raw file per planned stem as
+    soon as no later window overlaps them. Those are encoded to the planned outputs in
+    `wav_folder`, rescaled like prevent_clip() would with each stem's peak, and all raw files
+    are removed. With `skip_silence`, long silences inside each window are not separated.
+    Fills in `result` like encode_track_stems().
+    """
+    import math
+    import tempfile
+    import numpy as np
+    import torch
+
+    samplerate = model.samplerate
+    channels = model.audio_channels
+    block_samples = int(WINDOW_DECODE_BLOCK_SECONDS * samplerate)
+    segment_samples, chunk_samples, shift_samples, crossfade_samples = segment_plan_settings(model, window_seconds)
+
+    track_name = track_name_for(input_file)
+    raw_folder = tempfile.mkdtemp(prefix=".windowed-", dir=wav_folder)
+    try:
+        # Same normalisation as separate_track_audio(), accumulated in float64 over the whole track
+        input_path = os.path.join(raw_folder, "input.f32")
+        length = 0
+        total = 0.0
+        total_squares = 0.0
+        with open(input_path, "wb") as input_raw:
+            for block in decode_audio_blocks(input_file, samplerate, channels, block_samples, ffmpeg_exe_path):
+                input_raw.write(block.T.astype("<f4").tobytes())
+                ref = block.mean(0, dtype=np.float64)
+                length += ref.shape[0]
+                total += float(ref.sum())
+                total_squares += float(np.dot(ref, ref))
+        if length == 0:
+            raise RuntimeError(f"No audio decoded from {os.path.basename(input_file)}")
+        result["audio_seconds"] = length / samplerate
+        mean = total / length
+        std = math.sqrt(max(total_squares - length * mean * mean, 0.0) / max(length - 1, 1)) + 1e-8
+
+        bounds, fades = plan_segments(length, segment_samples, chunk_samples, shift_samples, crossfade_samples)
+        stems_wanted = list(plan)
+        raw_paths = {stem_name: os.path.join(raw_folder, f"{stem_name}.f32") for stem_name in stems_wanted}
+        raw_files = {stem_name: open(path, "wb") for stem_name, path in raw_paths.items()}
+        peaks = dict.fromkeys(stems_wanted, 0.0)
+        carried = {}
+        # Plain reads rather than a memory map, so pages already used don't stay in this process's RSS
+        input_raw = open(input_path, "rb")
+        try:
+            for index, (start, end) in enumerate(bounds):
+                input_raw.seek(start * channels * 4)
+                audio = np.fromfile(input_raw, dtype="<f4", count=(end - start) * channels)
+                audio = np.ascontiguousarray(audio.reshape(-1, channels).T)
+                window = torch.from_numpy((audio - np.float32(mean)) / np.float32(std))
+                if skip_silence:
+                    spans = find_sound_spans(audio, samplerate, chunk_samples, shift_samples)
+                    result["silence_seconds_skipped"] = result.get("silence_seconds_skipped", 0.0) + (
+                        end - start - sum(span_end - span_start for span_start, span_end in spans)) / samplerate
+                else:
+                    spans = [(0, end - start)]
+                with cpu_reservation(threads or budget_cores(), "separate") as cores:
+                    torch.set_num_threads(cores)
+                    sources = separate_sound_spans(
+                        lambda audio: apply_separation_model(model, audio[None], shifts=shifts)[0],
+                        window, spans, len(model.sources))
+                stems = select_stems(model, sources * std + mean, stems_wanted=plan)
+                weight = segment_weight(index, bounds, fades)
+                # Nothing from the next window lands before its start, so everything up to it is final
+                done = (bounds[index + 1][0] if index + 1 < len(bounds) else end) - start
+                for stem_name, stem_audio in stems.items():
+                    weighted = stem_audio.numpy() * weight
+                    if stem_name in carried:
+                        weighted[:, :carried[stem_name].shape[1]] += carried[stem_name]
+                    finished = weighted[:, :done]
+                    carried[stem_name] = weighted[:, done:].copy()
+                    if finished.size:
+                        peaks[stem_name] = max(peaks[stem_name], float(np.abs(finished).max()))
+                    raw_files[stem_name].write(np.ascontiguousarray(finished.T).astype("<f4").tobytes())
+                report_progress("separate", (index + 1) / len(bounds), audio_seconds=(start + done) / samplerate,
+                                audio_seconds_total=length / samplerate)
+        finally:
+            input_raw.close()
+            for raw_file in raw_files.values():
+                raw_file.close()
+        if result.get("silence_seconds_skipped"):
+            print(f"Skipped {result['silence_seconds_skipped']:.1f}s of silence")
+
+        converted_count = 0
+        failed_count = 0
+        with ThreadPoolExecutor(max_workers=len(raw_paths)) as executor:
+            future_to_stem = {
+                executor.submit(encode_raw_pcm, raw_paths[stem_name], samplerate, channels,
+                                stem_output_path(wav_folder, track_name, stem_name, plan), plan[stem_name],
+                                ffmpeg_exe_path, 1.0 / max(1.01 * peaks[stem_name], 1.0)): stem_name
+                for stem_name in stems_wanted
+            }
+            for future in as_completed(future_to_stem):
+                success, result_message = future.result()
+                if success:
+                    print(f"  SUCCESS: streamed [{future_to_stem[future]}] -> {result_message}")
+                    converted_count += 1
+                else:
+                    print(f"  FAILED streaming [{future_to_stem[future]}]:")
+                    for line in result_message.splitlines():
+                        print(f"    {line}")
+                    failed_count += 1
+        result["disk_bytes_written"] += os.path.getsize(input_path)
+        for stem_name in stems_wanted:
+            result["disk_bytes_written"] += os.path.getsize(raw_paths[stem_name])
+            output_path = stem_output_path(wav_folder, track_name, stem_name, plan)
+            if os.path.exists(output_path):
+                result["disk_bytes_written"] += os.path.getsize(output_path)
+    finally:
+        shutil.rmtree(raw_folder, ignore_errors=True)
+    if failed_count:
+        result["error"] = f"{failed_count} conversion(s) failed"
+    else:
+        result["ok"] = True
+
+def run_windowed_check(plan, window_seconds=DEFAULT_SEGMENT_SECONDS):
+    """
+    Separates a short synthetic track and then an hour of synthetic audio with --windowed in
+    this process, and fails if the peak RSS goes over WINDOWED_RSS_CEILING_MB. Also prints how
+    much the peak grew between the two, which should be next to nothing since memory no longer
+    depends on track length. Returns True if the peak stayed under the ceiling.
+    """
+    import tempfile
+
+    megabyte = 1024 * 1024
+    ffmpeg_exe_path = get_ffmpeg_exe_path()
+    print(f"--- Windowed memory check: {window_seconds:.0f}s windows, {WINDOWED_CHECK_SECONDS / 60:.0f} min input, "
+          f"{budget_cores()} core(s) ---")
+    try:
+        model = load_separation_model()
+    except Exception as e:
+        print(f"Error: Could not load Demucs model '{DEMUCS_MODEL_NAME}': {e}")
+        return False
+    try:
+        segment_plan_settings(model, window_seconds)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return False
+
+    print(f"\n{'Input (s)':>10} {'Wall (s)':>10} {'RTF':>7} {'Peak RSS (MB)':>14}")
+    peaks = []
+    with tempfile.TemporaryDirectory() as folder:
+        for seconds in (3 * window_seconds, WINDOWED_CHECK_SECONDS):
+            # A tone over pink noise, generated and encoded by ffmpeg so the fixture never sits in RAM
+            fixture = os.path.join(folder, f"check-{seconds:.0f}.mp3")
+            command = [
+                ffmpeg_exe_path,
+                "-f", "lavfi", "-i", f"sine=frequency=220:sample_rate={model.samplerate}:duration={seconds}",
+                "-f", "lavfi", "-i", f"anoisesrc=color=pink:amplitude=0.1:seed=1234:sample_rate={model.samplerate}"
+                                     f":duration={seconds}",
+                "-filter_complex", "amix=inputs=2,aformat=channel_layouts=stereo",
+                "-codec:a", MP3_CODEC, "-b:a", "128k",
+                fixture,
+                "-y",
+                "-loglevel", "error"
+            ]
+            process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if process.returncode != 0:
+                print(f"Error: Could not generate the synthetic input: {process.stderr.decode(errors='ignore').strip()}")
+                return False
+            result = new_track_result(fixture)
+            start = time.time()
+            try:
+                separate_track_windowed(model, fixture, folder, ffmpeg_exe_path, plan, result, window_seconds)
+            except Exception as e:
+                result["error"] = str(e)
+            wall_seconds = time.time() - start
+            if not result["ok"]:
+                print(f"Error: Windowed separation of the {seconds:.0f}s input failed: {result['error']}")
+                return False
+            peaks.append(peak_rss_bytes() or process_memory_bytes()["rss"])
+            print(f"{seconds:>10.0f} {wall_seconds:>10.1f} {wall_seconds / seconds:>7.3f} {peaks[-1] / megabyte:>14.0f}")
+            for stem_name in plan:
+                os.remove(stem_output_path(folder, track_name_for(fixture), stem_name, plan))
+            os.remove(fixture)
+
+    within_ceiling = peaks[-1] <= WINDOWED_RSS_CEILING_MB * megabyte
+    print(f"\nPeak RSS grew by {(peaks[-1] - peaks[0]) / megabyte:.0f} MB from the short input to the long one; "
+          f"ceiling {WINDOWED_RSS_CEILING_MB} MB: {'OK' if within_ceiling else 'EXCEEDED'}.")
+    return within_ceiling
+
+def signal_to_distortion_db(reference, estimate):
+    """SDR of `estimate` against `reference` in dB (higher is closer; identical arrays give inf)."""
+    import numpy as np
+    reference = np.asarray(reference, dtype=np.float64)
+    error = reference - np.asarray(estimate, dtype=np.float64)
+    error_energy = float(np.sum(error ** 2))
+    if error_energy == 0.0:
+        return float("inf")
+    return 10.0 * np.log10(float(np.sum(reference ** 2)) / error_energy + 1e-20)
+
+def run_worker_benchmark(input_folder, segment_seconds):
+    """
+    Separates the first input track single-pass and then with a SegmentPool of 1, 2, 4 and 8
+    workers, printing wall time, speedup and how closely each result matches the single pass.
+    Uses shifts=0 so the only difference measured is the segmentation itself. Nothing is
+    written to output/ and the input is left in place.
+    """
+    input_file = find_first_audio(input_folder, get_ffmpeg_exe_path())
+    if not input_file:
+        print(f"Error: No audio file found in the '{input_folder}' directory.")
+        return False
+
+    if sys.platform == "win32":
+        os.environ["PATH"] = abs_ffmpeg_dir + os.pathsep + os.environ.get("PATH", "")
+    model = load_separation_model()
+    wav = load_track_audio(model, input_file)
+    audio_seconds = wav.shape[-1] / model.samplerate
+    print(f"--- Segment scaling benchmark: {os.path.basename(input_file)} ({audio_seconds:.1f}s audio, "
+          f"{os.cpu_count()} cores, {segment_seconds:.0f}s segments) ---")
+
+    start = time.time()
+    reference = separate_track_audio(model, wav, shifts=0)[TWO_STEMS].numpy()
+    single_pass_seconds = time.time() - start
+    print(f"Single pass (reference): {single_pass_seconds:.2f}s")
+
+    print(f"\n{'Workers':>8} {'Wall (s)':>10} {'Speedup':>8} {'SDR vs single pass':>20}")
+    try:
+        plan_segments(1, int(segment_seconds * model.samplerate), model_chunk_samples(model),
+                      int(0.5 * model.samplerate), int(SEGMENT_CROSSFADE_SECONDS * model.samplerate))
+    except ValueError as e:
+        print(f"Error: {e}")
+        return False
+    all_within_tolerance = True
+    for workers in BENCHMARK_WORKER_COUNTS:
+        pool = SegmentPool(model, workers, segment_seconds=segment_seconds)
+        try:
+            # Warm the workers up so model loading isn't billed to the separation
+            list(pool.executor.map(int, range(workers)))
+            start = time.time()
+            vocals = separate_track_audio(model, wav, segment_pool=pool, shifts=0)[TWO_STEMS].numpy()
+            wall_seconds = time.time() - start
+        finally:
+            pool.close()
+        sdr = signal_to_distortion_db(reference, vocals)
+        within_tolerance = sdr >= SEGMENT_MATCH_MIN_SDR_DB
+        all_within_tolerance = all_within_tolerance and within_tolerance
+        print(f"{workers:>8} {wall_seconds:>10.2f} {single_pass_seconds / wall_seconds:>7.2f}x "
+              f"{sdr:>16.1f} dB{'' if within_tolerance else '  (below tolerance)'}")
+
+    print(f"\nTolerance: segmented output must be within {SEGMENT_MATCH_MIN_SDR_DB:.0f} dB SDR of the single pass.")
+    return all_within_tolerance
+
+def make_synthetic_fixture(samplerate, seconds=PRECISION_CHECK_SECONDS):
+    """
+    Deterministic stereo stand-in for a song, so quality checks need no audio files: a
+    vibrato "voice" with harmonics and phrasing, a bass line and decaying noise hits.
+    Returns a (2, samples) float32 tensor.
+    """
+    import numpy as np
+    import torch
+
+    rng = np.random.default_rng(PRECISION_CHECK_SEED)
+    t = np.arange(int(samplerate * seconds)) / samplerate
+    pitch = 220.0 * (1 + 0.02 * np.sin(2 * np.pi * 5 * t)) * np.where((t // 2) % 2 == 0, 1.0, 1.25)
+    phase = 2 * np.pi * np.cumsum(pitch) / samplerate
+    voice = sum(np.sin(harmonic * phase) / harmonic for harmonic in range(1, 6))
+    voice *= (0.5 + 0.5 * np.sin(2 * np.pi * 0.25 * t)) ** 2
+    bass = np.sin(2 * np.pi * 55.0 * t) * np.where((t // 1) % 2 == 0, 1.0, 0.75)
+    hits = rng.standard_normal(t.shape) * np.exp(-(t % 0.5) * 30.0)
+    left = 0.3 * voice + 0.3 * bass + 0.2 * hits
+    right = 0.3 * voice + 0.25 * bass + 0.25 * hits
+    return torch.from_numpy(np.stack([left, right]).astype(np.float32))
+
+def run_precision_check(model_name=DEMUCS_MODEL_NAME):
+    """
+    Separates a synthetic fixture at every precision and prints speed and SDR against the fp32
+    output, so the quality given up for a faster CPU mode is measured rather than guessed.
+    Uses shifts=0 so precision is the only difference. Returns True if every mode this CPU
+    supports stays within PRECISION_MIN_SDR_DB of fp32.
+    """
+    reference = None
+    fp32_seconds = None
+    all_within_tolerance = True
+    print(f"--- Precision check: {PRECISION_CHECK_SECONDS:.0f}s synthetic fixture, {budget_cores()} core(s) ---")
+    print(f"\n{'Precision':>10} {'Wall (s)':>10} {'RTF':>7} {'Speedup':>8} {'SDR vs fp32':>13}")
+    for precision in PRECISIONS:
+        model = load_separation_model(model_name, precision)
+        if model.separation_precision != precision:
+            print(f"{precision:>10}  skipped, not supported on this CPU")
+            continue
+        wav = make_synthetic_fixture(model.samplerate)
+        # One short pass first so lazy allocations aren't billed to the timed run
+        separate_track_audio(model, wav[:, :model.samplerate], shifts=0)
+        start = time.time()
+        vocals = separate_track_audio(model, wav, shifts=0)[TWO_STEMS].numpy()
+        wall_seconds = time.time() - start
+        if reference is None:
+            reference, fp32_seconds = vocals, wall_seconds
+            print(f"{precision:>10} {wall_seconds:>10.2f} {wall_seconds / PRECISION_CHECK_SECONDS:>7.3f} "
+                  f"{'1.00x':>8} {'(reference)':>13}")
+            continue
+        sdr = signal_to_distortion_db(reference, vocals)
+        within_tolerance = sdr >= PRECISION_MIN_SDR_DB
+        all_within_tolerance = all_within_tolerance and within_tolerance
+        print(f"{precision:>10} {wall_seconds:>10.2f} {wall_seconds / PRECISION_CHECK_SECONDS:>7.3f} "
+              f"{fp32_seconds / wall_seconds:>7.2f}x {sdr:>10.1f} dB{'' if within_tolerance else '  (below tolerance)'}")
+
+    print(f"\nTolerance: vocals must be within {PRECISION_MIN_SDR_DB:.0f} dB SDR of fp32.")
+    return all_within_tolerance
+
+def peak_rss_bytes(children=False):
+    """
+    Peak resident memory of this process, or with `children` of its largest finished child
+    process, in bytes. None where the platform doesn't say (children on Windows).
+    """
+    if sys.platform == "win32":
+        if children:
+            return None
+        import ctypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [
+                ("cb", ctypes.c_ulong), ("PageFaultCount", ctypes.c_ulong),
+                ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(PROCESS_MEMORY_COUNTERS)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+        return counters.PeakWorkingSetSize
+    import resource
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return usage if sys.platform == "darwin" else usage * 1024
+
+def process_memory_bytes():
+    """
+    This process's memory right now as {"rss", "pss", "private"} in bytes. PSS splits each
+    shared page between the processes mapping it, so adding PSS up gives the real total. Only
+    Linux reports PSS and private memory; elsewhere all three are the peak RSS.
+    """
+    try:
+        with open("/proc/self/smaps_rollup", "r") as f:
+            fields = {line.split(":")[0]: int(line.split()[1]) * 1024 for line in f if line.rstrip().endswith(" kB")}
+        return {"rss": fields["Rss"], "pss": fields["Pss"],
+                "private": fields["Private_Clean"] + fields["Private_Dirty"]}
+    except (OSError, KeyError, ValueError):
+        rss = peak_rss_bytes() or 0
+        return {"rss": rss, "pss": rss, "private": rss}
+
+# Barrier the workers of run_memory_benchmark() meet at, set by _init_memory_probe_worker()
+_memory_probe_barrier = None
+
+def _init_memory_probe_worker(threads, mmap_weights, barrier):
+    """Process pool initializer for run_memory_benchmark(): loads the model like a separation worker does."""
+    global _worker_model, _worker_threads, _memory_probe_barrier
+    import torch
+    _worker_threads = threads
+    torch.set_num_threads(threads)
+    _worker_model = load_separation_model(mmap_weights=mmap_weights)
+    _memory_probe_barrier = barrier
+
+def _probe_worker_memory():
+    """Separates a second of the synthetic fixture, waits until every worker has, then reports memory."""
+    wav = make_synthetic_fixture(_worker_model.samplerate, 1.0)
+    separate_track_audio(_worker_model, wav, threads=_worker_threads, shifts=0)
+    if sys.platform.startswith("linux"):
+        # Hand freed activations back to the OS so what's left is what a worker holds between tracks
+        import ctypes
+        try:
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+    # Holding every task here until all have arrived puts each one on its own worker
+    _memory_probe_barrier.wait(timeout=MEMORY_BENCHMARK_TIMEOUT_SECONDS)
+    return process_memory_bytes()
+
+def run_memory_benchmark():
+    """
+    Starts pools of 1, 2 and 4 separation workers, first with each worker loading a private
+    copy of the weights and then with all of them memory-mapping one shared copy (see
+    load_mmap_model()), and prints per-worker and total RSS and PSS once every worker has
+    separated some audio. Returns True if every pool ran.
+    """
+    megabyte = 1024 * 1024
+    print(f"--- Worker memory benchmark: '{DEMUCS_MODEL_NAME}', {budget_cores()} core(s) ---")
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        try:
+            executor.submit(prepare_separation_model).result()
+        except Exception as e:
+            print(f"Error: Could not load Demucs model '{DEMUCS_MODEL_NAME}': {e}")
+            return False
+
+    print(f"\n{'Workers':>8} {'Weights':>8} {'RSS/worker (MB)':>16} {'PSS/worker (MB)':>16} "
+          f"{'Total RSS (MB)':>15} {'Total PSS (MB)':>15}")
+    all_ok = True
+    for workers in MEMORY_BENCHMARK_WORKER_COUNTS:
+        for mmap_weights in (False, True):
+            threads = max(1, budget_cores() // workers)
+            try:
+                with ProcessPoolExecutor(max_workers=workers, initializer=_init_memory_probe_worker,
+                                         initargs=(threads, mmap_weights, multiprocessing.Barrier(workers))) as executor:
+                    reports = [future.result() for future in
+                               [executor.submit(_probe_worker_memory) for _ in range(workers)]]
+            except Exception as e:
+                print(f"{workers:>8} {'shared' if mmap_weights else 'private':>8}  failed: {e}")
+                all_ok = False
+                continue
+            rss = sum(report["rss"] for report in reports)
+            pss = sum(report["pss"] for report in reports)
+            print(f"{workers:>8} {'shared' if mmap_weights else 'private':>8} {rss / workers / megabyte:>16.0f} "
+                  f"{pss / workers / megabyte:>16.0f} {rss / megabyte:>15.0f} {pss / megabyte:>15.0f}")
+
+    print("\nRSS counts shared pages again in every worker; PSS splits them between the workers sharing "
+          "them, so total PSS is what the pool really uses.")
+    return all_ok
+
+def _benchmark_backend(backend, demucs_exe_path=None):
+    """
+    Runs in a fresh process for run_backend_benchmark(): separates the synthetic fixture with
+    one backend and returns (startup seconds, separation seconds, peak RSS bytes, vocals).
+    Startup covers everything before the first audio can be separated, including model loading.
+    """
+    import numpy as np
+    if backend != "cli":
+        start = time.time()
+        model = load_separation_model(backend=backend)
+        if model.separation_backend != backend:
+            raise RuntimeError("it can't be built on this machine")
+        wav = make_synthetic_fixture(model.samplerate, BACKEND_BENCHMARK_SECONDS)
+        separate_track_audio(model, wav[:, :model.samplerate], shifts=0)
+        startup_seconds = time.time() - start
+        start = time.time()
+        vocals = separate_track_audio(model, wav, shifts=0)[TWO_STEMS].numpy()
+        return startup_seconds, time.time() - start, peak_rss_bytes(), vocals
+
+    import tempfile
+    import wave
+    samplerate = 44100  # every pretrained Demucs model runs at 44.1 kHz
+    pcm = (make_synthetic_fixture(samplerate, BACKEND_BENCHMARK_SECONDS).numpy().T * 32767).astype("<i2")
+    with tempfile.TemporaryDirectory() as folder:
+        fixture_path = os.path.join(folder, "fixture.wav")
+        with wave.open(fixture_path, "wb") as fixture:
+            fixture.setnchannels(2)
+            fixture.setsampwidth(2)
+            fixture.setframerate(samplerate)
+            fixture.writeframes(pcm.tobytes())
+        start = time.time()
+        process = subprocess.Popen([demucs_exe_path, f"--two-stems={TWO_STEMS}", "--other-method=none", "--shifts=0",
+                                    fixture_path, "-o", folder, "--filename", "{track} [{stem}].{ext}"],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        startup_seconds = None
+        # The progress bar appears once the model is loaded and the audio decoded
+        for line in iter(process.stderr.readline, ""):
+            if startup_seconds is None and parse_tqdm_progress(line.strip()):
+                startup_seconds = time.time() - start
+        if process.wait() != 0:
+            raise RuntimeError(f"demucs exited with code {process.returncode}")
+        total_seconds = time.time() - start
+        startup_seconds = total_seconds if startup_seconds is None else startup_seconds
+        with wave.open(os.path.join(folder, DEMUCS_MODEL_NAME, f"fixture [{TWO_STEMS}].wav"), "rb") as output:
+            frames = output.readframes(output.getnframes())
+        vocals = np.frombuffer(frames, dtype="<i2").reshape(-1, 2).T / 32768.0
+    return startup_seconds, total_seconds - startup_seconds, peak_rss_bytes(children=True), vocals
+
+def run_backend_benchmark():
+    """
+    Separates a synthetic fixture with each separation backend, each in a fresh process, and
+    prints startup time, real-time factor, peak RSS and SDR against the in-process torch output.
+    Uses shifts=0 so the backend is the only difference. Returns True if every backend ran and
+    matched torch within BACKEND_MATCH_MIN_SDR_DB.
+    """
+    print(f"--- Backend benchmark: {BACKEND_BENCHMARK_SECONDS:.0f}s synthetic fixture, {budget_cores()} core(s) ---")
+    # Build the exports up front so their one-off cost isn't billed as startup
+    for kind in ("compiled", "onnx"):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            try:
+                executor.submit(prepare_separation_model, DEMUCS_MODEL_NAME, kind).result()
+            except Exception as e:
+                print(f"Warning: Building the {kind} model failed: {e}")
+
+    results = {}
+    all_ok = True
+    demucs_exe_path = get_demucs_exe_path()
+    for backend in ("torch", "compiled", "onnx", "cli"):
+        if backend == "cli" and not os.path.isfile(demucs_exe_path):
+            print(f"Note: Skipping the cli backend, no demucs executable at {demucs_exe_path}")
+            all_ok = False
+            continue
+        # A fresh process per backend, so each one's startup and peak memory are its own
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            try:
+                results[backend] = executor.submit(_benchmark_backend, backend, demucs_exe_path).result()
+            except Exception as e:
+                print(f"Error: The {backend} backend failed: {e}")
+                all_ok = False
+
+    print(f"\n{'Backend':>8} {'Startup (s)':>12} {'Separate (s)':>13} {'RTF':>7} {'Peak RSS (MB)':>14} {'SDR vs torch':>13}")
+    reference = results.get("torch", (None, None, None, None))[3]
+    for backend, (startup_seconds, separate_seconds, peak_rss, vocals) in results.items():
+        rss_text = f"{peak_rss / (1024 * 1024):.0f}" if peak_rss else "n/a"
+        if backend == "torch":
+            match_text = "(reference)"
+        elif reference is None:
+            match_text = "n/a"
+        else:
+            length = min(reference.shape[-1], vocals.shape[-1])
+            sdr = signal_to_distortion_db(reference[..., :length], vocals[..., :length])
+            all_ok = all_ok and sdr >= BACKEND_MATCH_MIN_SDR_DB
+            match_text = f"{sdr:.1f} dB{'' if sdr >= BACKEND_MATCH_MIN_SDR_DB else ' (!)'}"
+        print(f"{backend:>8} {startup_seconds:>12.2f} {separate_seconds:>13.2f} "
+              f"{separate_seconds / BACKEND_BENCHMARK_SECONDS:>7.3f} {rss_text:>14} {match_text:>13}")
+
+    print(f"\nTolerance: each backend must be within {BACKEND_MATCH_MIN_SDR_DB:.0f} dB SDR of torch (the CLI's "
+          "output is 16-bit WAV).")
+    return all_ok
+
+def run_encoder_benchmark():
+    """
+    Encodes ENCODER_BENCHMARK_TRACKS short synthetic tracks from WAV to MP3 with each MP3 encoder,
+    through the same thread pool runs use, and prints wall and CPU time per track (CPU time
+    includes ffmpeg's processes). Returns True if both encoders ran and lameenc's MP3s decode
+    to as many samples as ffmpeg's, no more than ENCODER_MAX_SDR_LOSS_DB further from the source.
+    """
+    global _mp3_encoder
+    import tempfile
+
+    samplerate = 44100
+    mp3_entry = {"format": "mp3", "bitrate": MP3_BITRATE}
+    ffmpeg_exe_path = get_ffmpeg_exe_path()
+    print(f"--- MP3 encoder benchmark: {ENCODER_BENCHMARK_TRACKS} x {ENCODER_BENCHMARK_SECONDS:.0f}s tracks "
+          f"at {MP3_BITRATE}, {budget_cores()} core(s) ---")
+    encoders = ["ffmpeg"] + (["lame"] if resolve_mp3_encoder("lame") == "lame" else [])
+    pcm = float_to_pcm16(make_synthetic_fixture(samplerate, ENCODER_BENCHMARK_SECONDS).numpy())
+    results = {}
+    all_ok = len(encoders) == len(MP3_ENCODERS) - 1
+    previous_encoder = _mp3_encoder
+    with tempfile.TemporaryDirectory() as folder:
+        wav_paths = []
+        for index in range(ENCODER_BENCHMARK_TRACKS):
+            wav_paths.append(os.path.join(folder, f"track{index}.wav"))
+            write_pcm16_wav(wav_paths[-1], pcm, samplerate)
+        try:
+            for encoder in encoders:
+                _mp3_encoder = encoder
+                mp3_paths = [f"{os.path.splitext(wav_path)[0]}.{encoder}.mp3" for wav_path in wav_paths]
+                start_times = os.times()
+                start = time.time()
+                with ThreadPoolExecutor(max_workers=max(1, budget_cores() // ENCODER_THREADS)) as executor:
+                    outcomes = list(executor.map(lambda paths: encode_wav(*paths, mp3_entry, ffmpeg_path=ffmpeg_exe_path),
+                                                 zip(wav_paths, mp3_paths)))
+                wall_seconds = time.time() - start
+                # User and system time of this process and of the children it waited for
+                cpu_seconds = sum(os.times()[:4]) - sum(start_times[:4])
+                failures = [message for success, message in outcomes if not success]
+                if failures:
+                    print(f"Error: The {encoder} encoder failed: {failures[0]}")
+                    all_ok = False
+                    continue
+                decoded = decode_track_audio(mp3_paths[0], samplerate, 2, ffmpeg_exe_path).numpy()
+                results[encoder] = (wall_seconds, cpu_seconds, decoded)
+        finally:
+            _mp3_encoder = previous_encoder
+
+    print(f"\n{'Encoder':>8} {'Wall/track (s)':>15} {'CPU/track (s)':>14} {'Speed-up':>9} {'SDR vs source':>14}")
+    source = pcm.T / 32768.0
+    reference = results.get("ffmpeg")
+    reference_sdr = signal_to_distortion_db(source, reference[2]) if reference else None
+    for encoder, (wall_seconds, cpu_seconds, decoded) in results.items():
+        # Windows doesn't report the CPU time of child processes
+        cpu_text = "n/a" if encoder == "ffmpeg" and sys.platform == "win32" else f"{cpu_seconds / ENCODER_BENCHMARK_TRACKS:.3f}"
+        speedup_text = f"{reference[0] / wall_seconds:.2f}x" if reference else "n/a"
+        if decoded.shape != source.shape:
+            # The encoder delay and padding weren't trimmed, so this stem would drift from the song
+            match_text = f"{decoded.shape[-1] - source.shape[-1]:+d} samples (!)"
+            all_ok = False
+        else:
+            sdr = signal_to_distortion_db(source, decoded)
+            within = reference_sdr is None or sdr >= reference_sdr - ENCODER_MAX_SDR_LOSS_DB
+            all_ok = all_ok and within
+            match_text = f"{sdr:.1f} dB{'' if within else ' (!)'}"
+        print(f"{encoder:>8} {wall_seconds / ENCODER_BENCHMARK_TRACKS:>15.3f} {cpu_text:>14} "
+              f"{speedup_text:>9} {match_text:>14}")
+
+    print(f"\nTolerance: every MP3 must decode to exactly the source's length, and lameenc's within "
+          f"{ENCODER_MAX_SDR_LOSS_DB:g} dB of ffmpeg's SDR.")
+    return all_ok
+
+def run_profile_benchmark():
+    """
+    Encodes a synthetic fixture from WAV with every output profile at its default bitrate and
+    prints encode time, file size, decode time and SDR against the source. Decode time is
+    ffmpeg's own (-benchmark), without process startup, as the best of PROFILE_DECODE_RUNS.
+    Returns True if every profile encoded and decoded.
+    """
+    import tempfile
+    import numpy as np
+
+    samplerate = 44100
+    ffmpeg_exe_path = get_ffmpeg_exe_path()
+    print(f"--- Output profile benchmark: {ENCODER_BENCHMARK_SECONDS:.0f}s synthetic fixture, "
+          f"MP3 via {_mp3_encoder or resolve_mp3_encoder()} ---")
+    pcm = float_to_pcm16(make_synthetic_fixture(samplerate, ENCODER_BENCHMARK_SECONDS).numpy())
+    source = pcm.T / 32768.0
+    all_ok = True
+    rows = []
+    with tempfile.TemporaryDirectory() as folder:
+        wav_path = os.path.join(folder, "fixture.wav")
+        write_pcm16_wav(wav_path, pcm, samplerate)
+        for output_format, profile in OUTPUT_PROFILES.items():
+            output_path = os.path.join(folder, f"fixture.out.{output_format}")
+            start = time.time()
+            success, message = encode_wav(wav_path, output_path, {"format": output_format, "bitrate": profile["bitrate"]},
+                                          ffmpeg_exe_path)
+            encode_seconds = time.time() - start
+            if not success:
+                print(f"Error: The {output_format} profile failed: {message}")
+                all_ok = False
+                continue
+            decode_times = []
+            for _ in range(PROFILE_DECODE_RUNS):
+                process = subprocess.run([ffmpeg_exe_path, "-benchmark", "-i", output_path, "-f", "null", "-"],
+                                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors="replace")
+                match = FFMPEG_BENCH_RTIME_RE.search(process.stderr)
+                if process.returncode == 0 and match:
+                    decode_times.append(float(match.group(1)))
+            if not decode_times:
+                print(f"Error: ffmpeg could not decode the {output_format} output.")
+                all_ok = False
+                continue
+            decoded = decode_track_audio(output_path, samplerate, 2, ffmpeg_exe_path).numpy()
+            # Opus is resampled to 48 kHz and back, which may leave a few samples either way
+            length = min(decoded.shape[-1], source.shape[-1])
+            sdr = signal_to_distortion_db(source[:, :length], decoded[:, :length])
+            rows.append((output_format, profile["bitrate"] or "-", encode_seconds, os.path.getsize(output_path),
+                         min(decode_times), sdr))
+
+    print(f"\n{'Profile':>8} {'Bitrate':>8} {'Encode (s)':>11} {'Size (KB)':>10} {'KB/min':>8} "
+          f"{'Decode (ms)':>12} {'SDR vs source':>14}")
+    for output_format, bitrate, encode_seconds, size, decode_seconds, sdr in rows:
+        sdr_text = "lossless" if np.isinf(sdr) or sdr > 90 else f"{sdr:.1f} dB"
+        print(f"{output_format:>8} {bitrate:>8} {encode_seconds:>11.3f} {size / 1024:>10.0f} "
+              f"{size / 1024 / (ENCODER_BENCHMARK_SECONDS / 60):>8.0f} {decode_seconds * 1000:>12.1f} {sdr_text:>14}")
+    if rows:
+        print(f"\nFastest to decode: {min(rows, key=lambda row: row[4])[0]}, "
+              f"smallest: {min(rows, key=lambda row: row[3])[0]}, "
+              f"fastest to encode: {min(rows, key=lambda row: row[2])[0]}. Pick one with --keep, e.g. 'vocals:ogg'.")
+    return all_ok
+
+def get_available_memory_bytes():
+    """Memory currently available to new processes, or None if it can't be determined."""
+    if sys.platform == "win32":
+        import ctypes
+
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [
+                ("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong),
+                ("ullTotalPhys", ctypes.c_ulonglong), ("ullAvailPhys", ctypes.c_ulonglong),
+                ("ullTotalPageFile", ctypes.c_ulonglong), ("ullAvailPageFile", ctypes.c_ulonglong),
+                ("ullTotalVirtual", ctypes.c_ulonglong), ("ullAvailVirtual", ctypes.c_ulonglong),
+                ("ullAvailExtendedVirtual", ctypes.c_ulonglong),
+            ]
+
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+        return None
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def choose_track_jobs(track_count):
+    """
+    Picks how many tracks to separate at once: enough to use every core with at least
+    MIN_THREADS_PER_JOB torch threads each, but never more than available RAM allows.
+    """
+    cores = budget_cores()
+    jobs = max(1, cores // MIN_THREADS_PER_JOB)
+    available_bytes = get_available_memory_bytes()
+    if available_bytes is not None:
+        jobs = min(jobs, max(1, available_bytes // SEPARATION_JOB_RAM_BYTES))
+    return max(1, min(jobs, track_count))
+
+def _separate_track_in_worker(input_file, wav_folder, ffmpeg_exe_path, plan, stream, window_seconds=None,
+                              skip_silence=False, pcm=None):
+    """
+    --jobs worker task: separates a whole track with the worker's own model, from the parent's
+    shared PcmBuffer when it sends one (mapped here, not copied).
+    """
+    try:
+        return separate_batch_track(_worker_model, input_file, wav_folder, ffmpeg_exe_path, plan, stream=stream,
+                                    threads=_worker_threads, window_seconds=window_seconds,
+                                    skip_silence=skip_silence, pcm=pcm, manifest=_worker_manifest)
+    finally:
+        if pcm is not None:
+            pcm.close()  # unmap now; the parent created the block and unlinks it
+
+_PIPELINE_DONE = object()
+
+def run_pipeline(items, stages, queue_depth=PIPELINE_QUEUE_DEPTH):
+    """
+    Pushes `items` through `stages`, a list of (name, function) pairs, with one thread per stage
+    and a bounded queue between neighbours, so each stage works on a different item at once.
+    Stage functions take an item and return it for the next stage and should handle their own
+    errors; if one raises anyway, the stage drains its queue so nothing deadlocks and the error
+    is re-raised once the pipeline has stopped.
+    Returns {stage name: {"busy", "starved", "blocked", "items"}} in seconds: time spent working,
+    waiting for input, and waiting for room in the next queue.
+    """
+    queues = [queue.Queue(maxsize=queue_depth) for _ in stages[1:]]
+    timings = {name: {"busy": 0.0, "starved": 0.0, "blocked": 0.0, "items": 0} for name, _ in stages}
+    errors = []
+
+    def run_stage(index):
+        name, work = stages[index]
+        inbox = queues[index - 1] if index > 0 else None
+        outbox = queues[index] if index < len(queues) else None
+        source = iter(items) if inbox is None else None
+        failed = False
+        while True:
+            wait_start = time.time()
+            item = next(source, _PIPELINE_DONE) if inbox is None else inbox.get()
+            timings[name]["starved"] += time.time() - wait_start
+            if item is _PIPELINE_DONE:
+                break
+            if failed:
+                continue
+            work_start = time.time()
+            try:
+                item = work(item)
+            except Exception as e:
+                errors.append(e)
+                failed = True
+                continue
+            finally:
+                timings[name]["busy"] += time.time() - work_start
+                timings[name]["items"] += 1
+            if outbox is not None:
+                wait_start = time.time()
+                outbox.put(item)
+                timings[name]["blocked"] += time.time() - wait_start
+        if outbox is not None:
+            outbox.put(_PIPELINE_DONE)
+
+    threads = [threading.Thread(target=run_stage, args=(index,), name=f"pipeline-{name}", daemon=True)
+               for index, (name, _) in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return timings
+
+def print_pipeline_report(timings, wall_seconds):
+    """Prints each stage's busy and waiting time so the bottleneck stage stands out."""
+    print("\n--- Pipeline Stages ---")
+    for name, stage in timings.items():
+        busy_percent = stage["busy"] / wall_seconds * 100 if wall_seconds > 0 else 0.0
+        print(f"  {name:<9} busy {stage['busy']:7.1f}s ({busy_percent:5.1f}%), "
+              f"waiting for input {stage['starved']:7.1f}s, waiting on next stage {stage['blocked']:7.1f}s "
+              f"({stage['items']} track(s))")
+    bottleneck = max(timings, key=lambda name: timings[name]["busy"])
+    print(f"Bottleneck: {bottleneck}")
+
+class BatchRun:
+    """
+    What run_batch()'s separation paths share for one batch: where its outputs go, how a track is
+    finished (cache, pitch contour, peak pyramid, manifest, input cleanup) and the results so far.
+    """
+
+    def __init__(self, output_folder, plan, manifest, cache, ffmpeg_exe_path, tracks_total, pitch=True, peaks=True):
+        self.output_folder = output_folder
+        self.plan = plan
+        self.manifest = manifest
+        self.cache = cache
+        self.ffmpeg_exe_path = ffmpeg_exe_path
+        self.tracks_total = tracks_total
+        self.pitch = pitch
+        self.peaks = peaks
+        self.results = []
+
+    def restore_cached(self, input_file, cache_key):
+        """On a cache hit, restores the track's vocals MP3 into the output folder and returns True."""
+        vocals_mp3 = stem_output_path(self.output_folder, track_name_for(input_file), TWO_STEMS, self.plan)
+        if not (self.cache and cache_key and self.cache.restore(cache_key, vocals_mp3)):
+            return False
+        print(f"Cache hit: restored {os.path.basename(vocals_mp3)} without separating")
+        return True
+
+    def finish_track(self, input_file, result, track_start, cache_key=None, original_peaks=None):
+        """
+        Finishes one track: stores a fresh separation in the cache, writes its pitch contour and
+        peak pyramid, advances the manifest, removes the input if it succeeded and reports progress.
+        If one of those steps fails, the track is recorded as failed and its input kept for a retry.
+        """
+        track_name = track_name_for(input_file)
+        try:
+            if result["ok"] and cache_key and not result.get("cached"):
+                vocals_mp3 = stem_output_path(self.output_folder, track_name, TWO_STEMS, self.plan)
+                self.cache.store(cache_key, vocals_mp3, result.get("busy_seconds", time.time() - track_start))
+            if result["ok"] and self.pitch:
+                write_vocal_pitch(self.output_folder, track_name, self.plan, self.ffmpeg_exe_path)
+            if result["ok"] and self.peaks:
+                write_track_peaks(self.output_folder, track_name, self.plan, input_file, self.ffmpeg_exe_path,
+                                  original=original_peaks)
+        except Exception as e:
+            result.update(ok=False, error=f"finishing failed: {e}")
+        result["wall_seconds"] = time.time() - track_start
+        self.results.append(result)
+        if result["ok"]:
+            outputs = planned_output_paths(self.output_folder, track_name, self.plan)
+            self.manifest.advance(input_file, "encoded", outputs=outputs)
+            # Only successfully separated inputs are removed, failures stay for a retry
+            if remove_processed_input(input_file):
+                self.manifest.advance(input_file, "finalized", outputs=outputs)
+        else:
+            self.manifest.record_error(input_file, result["error"])
+        done = len(self.results)
+        processed_audio = sum(r["audio_seconds"] for r in self.results)
+        if not report_progress("batch", done / self.tracks_total, audio_seconds=processed_audio,
+                               tracks_done=done, tracks_total=self.tracks_total):
+            print(f"Progress: {done / self.tracks_total * 100:.1f}%")
+        sys.stdout.flush()
+
+def separate_batch_in_workers(batch, pending, jobs, eta_predictor, stream=False,
+                              segment_seconds=DEFAULT_SEGMENT_SECONDS, precision="fp32", backend="torch",
+                              windowed=False, skip_silence=False):
+    """
+    run_batch() with more than one job: separates the `pending` (input_file, cache_key) tracks
+    concurrently, one whole track per worker process, each with its own model and a share of the
+    cores. Tracks are decoded here, a few ahead of the workers, into a shared PcmBuffer that the
+    cache key is hashed from and the worker maps. Workers forward their manifest progress here
+    (see ManifestForwarder). Finished tracks go through `batch`, and their stage timings feed
+    `eta_predictor`.
+    Returns False if the model could not be loaded.
+    """
+    # Build the shared weights or export once here rather than in every worker at the same time
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        try:
+            executor.submit(prepare_separation_model, DEMUCS_MODEL_NAME, backend).result()
+        except Exception as e:
+            if backend != "compiled":
+                print(f"Error: Could not load Demucs model '{DEMUCS_MODEL_NAME}': {e}")
+                return False
+            print(f"Warning: Could not compile '{DEMUCS_MODEL_NAME}' ({e}); separating with the torch backend instead.")
+            backend = "torch"
+    threads_per_job = max(1, budget_cores() // jobs)
+    print(f"\n--- Separating {len(pending)} track(s) with {jobs} parallel worker(s), "
+          f"{threads_per_job} torch thread(s) each ---")
+    manifest_updates = multiprocessing.Queue()
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_separation_worker,
+                             initargs=(DEMUCS_MODEL_NAME, threads_per_job, _cpu_budget, precision,
+                                       backend, _mp3_encoder, manifest_updates)) as executor:
+        future_to_track = {}
+        pending_tracks = iter(pending)
+
+        def apply_manifest_updates():
+            in_flight = {track[0] for track in future_to_track.values()}
+            while True:
+                try:
+                    input_file, state, outputs = manifest_updates.get_nowait()
+                except queue.Empty:
+                    return
+                # An update arriving after its track's result is already behind the finished state
+                if input_file in in_flight:
+                    batch.manifest.advance(input_file, state, outputs=outputs)
+
+        def submit_next():
+            # Decoded here rather than in the worker, so the cache key comes from the same
+            # buffer the worker maps; only a few tracks ahead of the workers are held in memory
+            for input_file, cache_key in pending_tracks:
+                track_start = time.time()
+                pcm = None
+                original_peaks = None
+                stage_seconds = {}
+                if not windowed:
+                    try:
+                        pcm = PcmBuffer.decode(input_file, DEMUCS_SAMPLERATE, DEMUCS_CHANNELS,
+                                               batch.ffmpeg_exe_path)
+                        stage_seconds["decode"] = time.time() - track_start
+                    except Exception as e:
+                        result = new_track_result(input_file)
+                        result["error"] = str(e)
+                        batch.finish_track(input_file, result, track_start)
+                        continue
+                    if batch.peaks:
+                        original_peaks = peak_pyramid(pcm.pcm)
+                    if batch.cache and cache_key is None:
+                        cache_key = batch.cache.key_for(input_file, batch.ffmpeg_exe_path,
+                                                        batch.plan[TWO_STEMS]["bitrate"], audio=pcm.audio(),
+                                                        samplerate=pcm.samplerate)
+                        if batch.restore_cached(input_file, cache_key):
+                            pcm.close()
+                            batch.finish_track(input_file, {"track": os.path.basename(input_file),
+                                                            "audio_seconds": 0.0, "ok": True, "error": None,
+                                                            "cached": True}, track_start,
+                                               original_peaks=original_peaks)
+                            continue
+                if pcm is not None:
+                    pcm = pcm.share()
+                future = executor.submit(_separate_track_in_worker, input_file, batch.output_folder,
+                                         batch.ffmpeg_exe_path, batch.plan, stream,
+                                         segment_seconds if windowed else None, skip_silence, pcm)
+                future_to_track[future] = (input_file, cache_key, track_start, pcm, original_peaks, stage_seconds)
+                return
+
+        for _ in range(jobs + PIPELINE_QUEUE_DEPTH):
+            submit_next()
+        while future_to_track:
+            done, _ = wait(future_to_track, timeout=MANIFEST_FORWARD_POLL_SECONDS, return_when=FIRST_COMPLETED)
+            # Applied before the finished tracks below, whose "encoded" state comes after these
+            apply_manifest_updates()
+            for future in done:
+                input_file, cache_key, track_start, pcm, original_peaks, stage_seconds = future_to_track.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {"track": os.path.basename(input_file), "audio_seconds": 0.0, "ok": False,
+                              "error": f"worker failed: {e}"}
+                if pcm is not None:
+                    pcm.close()
+                finalize_start = time.time()
+                try:
+                    batch.finish_track(input_file, result, track_start, cache_key, original_peaks)
+                except Exception as e:
+                    result.update(ok=False, error=str(e))
+                    print(f"Error: Could not finish {result['track']}: {e}")
+                stage_seconds.update(result.get("stage_seconds", {}), finalize=time.time() - finalize_start)
+                if result["ok"] and not result.get("cached"):
+                    eta_predictor.record(result["audio_seconds"], stage_seconds)
+                submit_next()
+    return True
+
+def separate_batch_pipelined(batch, pending, eta_predictor, stream=False, workers=1,
+                             segment_seconds=DEFAULT_SEGMENT_SECONDS, precision="fp32", backend="torch",
+                             windowed=False, skip_silence=False):
     """
-    Parses a line of Demucs output to find progress percentage.
-    Returns percentage as a string (e.g., "75.3%") or None.
+    run_batch() with one job: loads the model once in this process and moves the `pending`
+    (input_file, cache_key) tracks through decode, separate, encode and finalize stages running
+    side by side (or, `windowed`, through separate_track_windowed() and finalize). With more than
+    one of `workers`, each track's segments are separated in parallel by a SegmentPool. Finished
+    tracks go through `batch`, and their stage timings feed `eta_predictor`.
+    Returns (model_load_seconds, stage_timings, pipeline_seconds), or None if the model could not be loaded.
     """
-    match_tqdm_percent = re.search(r"(\d{1,3}(?:\.\d{1,2})?%)\s*\|", line)
-    if match_tqdm_percent:
-        return match_tqdm_percent.group(1)
+    segment_pool = None
+    try:
+        load_start = time.time()
+        try:
+            model = load_separation_model(precision=precision, backend=backend)
+        except Exception as e:
+            print(f"Error: Could not load Demucs model '{DEMUCS_MODEL_NAME}': {e}")
+            return None
+        model_load_seconds = time.time() - load_start
+        print(f"Loaded model '{DEMUCS_MODEL_NAME}' in {model_load_seconds:.2f}s")
+        if windowed:
+            try:
+                segment_plan_settings(model, segment_seconds)
+            except ValueError as e:
+                print(f"Error: {e}")
+                return None
+            print(f"Separating in {segment_seconds:.0f}s windows")
+        if workers > 1:
+            try:
+                segment_pool = SegmentPool(model, workers, segment_seconds=segment_seconds)
+            except ValueError as e:
+                print(f"Error: {e}")
+                return None
+            print(f"Separating {segment_seconds:.0f}s segments across {workers} worker processes "
+                  f"({segment_pool.threads_per_worker} torch thread(s) each)")
 
-    match_tqdm_segment = re.search(r"(\d+)/(\d+)\s*\[", line)
-    if not match_tqdm_segment:
-        match_tqdm_segment = re.search(r"Segment\s+(\d+)/(\d+)", line, re.IGNORECASE)
-    
-    if match_tqdm_segment:
+        # Leave the encoders a core so the previous track's encode overlaps this one's separation
+        separation_threads = max(1, budget_cores() - ENCODER_THREADS)
+
+        def timed(stage, stage_work):
+            def run(job):
+                if job["result"]["error"] is None and not job["result"].get("cached"):
+                    track = job["result"]["track"]
+                    report_progress(stage, 0.0, track=track)
+                    stage_start = time.time()
+                    try:
+                        stage_work(job)
+                    except Exception as e:
+                        job["result"]["error"] = str(e)
+                    job["result"]["busy_seconds"] += time.time() - stage_start
+                    job["stage_seconds"][stage] = time.time() - stage_start
+                    report_progress(stage, 1.0, track=track, audio_seconds=job["result"]["audio_seconds"])
+                return job
+            return run
+
+        def decode(job):
+            job["pcm"] = PcmBuffer.decode(job["input_file"], model.samplerate, model.audio_channels,
+                                          batch.ffmpeg_exe_path)
+            job["result"]["audio_seconds"] = job["pcm"].seconds
+            if batch.peaks:
+                job["original_peaks"] = peak_pyramid(job["pcm"].pcm)
+            if batch.cache and job["cache_key"] is None:
+                job["cache_key"] = batch.cache.key_for(job["input_file"], batch.ffmpeg_exe_path,
+                                                       batch.plan[TWO_STEMS]["bitrate"], audio=job["pcm"].audio(),
+                                                       samplerate=model.samplerate)
+                if batch.restore_cached(job["input_file"], job["cache_key"]):
+                    job.pop("pcm").close()
+                    job["result"].update(ok=True, cached=True)
+
+        def separate(job):
+            print(f"\n--- ({job['index']+1}/{len(pending)}) Separating {os.path.basename(job['input_file'])} ---")
+            pcm = job.pop("pcm")
+            try:
+                job["stems"] = separate_track_audio(model, pcm.audio(), stems_wanted=batch.plan,
+                                                    segment_pool=segment_pool, threads=separation_threads,
+                                                    skip_silence=skip_silence, stats=job["result"])
+            finally:
+                pcm.close()
+
+        def encode(job):
+            encode_track_stems(job.pop("stems"), model.samplerate, job["input_file"], batch.output_folder,
+                               batch.ffmpeg_exe_path, batch.plan, stream, job["result"], manifest=batch.manifest)
+
+        def separate_windowed(job):
+            print(f"\n--- ({job['index']+1}/{len(pending)}) Separating {os.path.basename(job['input_file'])} ---")
+            separate_track_windowed(model, job["input_file"], batch.output_folder, batch.ffmpeg_exe_path,
+                                    batch.plan, job["result"], segment_seconds, skip_silence=skip_silence)
+
+        def finalize(job):
+            if "pcm" in job:
+                job.pop("pcm").close()  # a stage failed before separation used it
+            job.pop("stems", None)
+            finalize_start = time.time()
+            # Caught here like in timed(), so one track cannot stop the stage for all the ones queued behind it
+            try:
+                batch.finish_track(job["input_file"], job["result"], job["track_start"], job["cache_key"],
+                                   job.pop("original_peaks", None))
+            except Exception as e:
+                job["result"].update(ok=False, error=str(e))
+                print(f"Error: Could not finish {job['result']['track']}: {e}")
+            job["stage_seconds"]["finalize"] = time.time() - finalize_start
+            if job["result"]["ok"] and not job["result"].get("cached"):
+                eta_predictor.record(job["result"]["audio_seconds"], job["stage_seconds"])
+            return job
+
+        def jobs_to_run():
+            for index, (input_file, cache_key) in enumerate(pending):
+                result = new_track_result(input_file)
+                result["busy_seconds"] = 0.0
+                yield {"index": index, "input_file": input_file, "cache_key": cache_key,
+                       "track_start": time.time(), "result": result, "stage_seconds": {}}
+
+        pipeline_start = time.time()
+        if windowed:
+            stages = [("separate", timed("separate", separate_windowed)), ("finalize", finalize)]
+        else:
+            stages = [
+                ("decode", timed("decode", decode)),
+                ("separate", timed("separate", separate)),
+                ("encode", timed("encode", encode)),
+                ("finalize", finalize),
+            ]
+        stage_timings = run_pipeline(jobs_to_run(), stages)
+        return model_load_seconds, stage_timings, time.time() - pipeline_start
+    finally:
+        if segment_pool:
+            segment_pool.close()
+
+def run_batch(input_folder, output_directory, plan, cache=None, stream=False, workers=1,
+              segment_seconds=DEFAULT_SEGMENT_SECONDS, jobs=1, precision="fp32", backend="torch", windowed=False,
+              skip_silence=False, pitch=True, peaks=True):
+    """
+    Separates every audio file in the input folder inside this process, loading the Demucs model
+    only once. Inputs are recognised by probing them with ffmpeg, so any format it decodes works.
+    Each track goes through the same WAV -> MP3 -> cleanup steps as the single-track CLI mode,
+    or with `stream` straight from memory into the encoder. Tracks move through decode, separate,
+    encode and finalize stages running side by side, so one track separates while the previous
+    one is being encoded and cleaned up.
+    Only the stems in `plan` are produced. Tracks found in `cache` are restored from it without
+    being separated; the model is only loaded once a track actually misses. With more than one
+    worker, each track is split into segments separated in parallel by a SegmentPool. With more
+    than one job, whole tracks are instead separated concurrently, one per worker process, each
+    with its own model and a share of the cores (0 picks the job count from cores and RAM).
+    Separation and encoding all draw their cores from one CpuBudget, so together they never
+    run more threads than the machine has. Each track is decoded exactly once, to a PcmBuffer
+    that the cache hash, silence detection and separation (in a worker too) all map. Progress is
+    recorded in a JobManifest, so rerunning after an interruption skips every stage a track
+    already completed. The two ways of separating are separate_batch_pipelined() and
+    separate_batch_in_workers(); both finish tracks through one BatchRun.
+    Before separating, the job's duration is estimated from the run history (EtaPredictor) and
+    each pipelined track's stage timings are added to it.
+    With `windowed`, each track is decoded, separated and encoded in `segment_seconds` windows
+    by one stage (see separate_track_windowed()), so memory stays flat however long it is.
+    With `skip_silence`, long silences are spliced in instead of separated (see find_sound_spans()).
+    With `pitch`, each finished track's vocals also get a pitch contour (see write_vocal_pitch()),
+    and with `peaks` the track a waveform peak pyramid, the original's reduced from its PcmBuffer
+    (see write_track_peaks()).
+    Returns True if every track succeeded.
+    """
+    global _cpu_budget, _job_eta
+    input_files = find_all_audio(input_folder, get_ffmpeg_exe_path())
+    if not input_files:
+        print(f"Error: No audio file found in the '{input_folder}' directory.")
+        return False
+
+    if sys.platform == "win32":
+        # demucs' in-process loader calls ffmpeg/ffprobe by name
+        os.environ["PATH"] = abs_ffmpeg_dir + os.pathsep + os.environ.get("PATH", "")
+
+    demucs_output_wav_folder = os.path.join(output_directory, DEMUCS_MODEL_NAME)
+    os.makedirs(demucs_output_wav_folder, exist_ok=True)
+    ffmpeg_exe_path = get_ffmpeg_exe_path()
+
+    print(f"--- Batch mode: {len(input_files)} track(s) in '{input_folder}' ---")
+    print(f"Output plan: {describe_output_plan(plan)}")
+    _cpu_budget = CpuBudget()
+    manifest = JobManifest(os.path.join(output_directory, JOB_MANIFEST_NAME))
+    batch = BatchRun(demucs_output_wav_folder, plan, manifest, cache, ffmpeg_exe_path, len(input_files),
+                     pitch=pitch, peaks=peaks)
+    batch_start = time.time()
+    model_load_seconds = None
+    stage_timings = None
+
+    # Tracks an interrupted run already got past separation (or finished) never go back to Demucs
+    pending_files = []
+    for input_file in input_files:
+        track_start = time.time()
+        state = manifest.resume_state(input_file)
+        if state in ("encoded", "finalized"):
+            print(f"Resuming: {os.path.basename(input_file)} was already {state}, only cleaning up")
+            batch.finish_track(input_file, {"track": os.path.basename(input_file), "audio_seconds": 0.0,
+                                            "ok": True, "error": None, "resumed": True}, track_start)
+        elif state == "separated":
+            print(f"Resuming: encoding {os.path.basename(input_file)} from its separated WAVs")
+            result = new_track_result(input_file)
+            result["resumed"] = True
+            converted_count, failed_count = finalize_stem_wavs(demucs_output_wav_folder, track_name_for(input_file),
+                                                               plan, ffmpeg_exe_path)
+            if failed_count:
+                result["error"] = f"{failed_count} output conversion(s) failed"
+            else:
+                result["ok"] = True
+            batch.finish_track(input_file, result, track_start)
+        else:
+            manifest.advance(input_file, "queued")
+            pending_files.append(input_file)
+
+    if jobs == 0:
+        jobs = choose_track_jobs(len(pending_files))
+    # New tracks are hashed from the PcmBuffer they are decoded to for separation anyway (in the
+    # decode stage, or just before going to a worker), so they are only decoded once; windows
+    # decode on their own
+    decode_for_key = windowed
+
+    # Cache hits are cheap, so resolve them all before deciding how much separation work is left
+    pending = []
+    for input_file in pending_files:
+        track_start = time.time()
+        cache_key = None
+        if cache:
+            cache_key = cache.key_for(input_file, ffmpeg_exe_path, plan[TWO_STEMS]["bitrate"], decode=decode_for_key)
+            if batch.restore_cached(input_file, cache_key):
+                batch.finish_track(input_file, {"track": os.path.basename(input_file), "audio_seconds": 0.0,
+                                                "ok": True, "error": None, "cached": True}, track_start)
+                continue
+        pending.append((input_file, cache_key))
+
+    jobs = max(1, min(jobs, len(pending)))
+
+    # Backends separate at different speeds, and so do tracks sharing the cores with other jobs,
+    # so each keeps its own history
+    eta_mode = "batch" if backend == "torch" else f"batch-{backend}"
+    if jobs > 1:
+        eta_mode += "-jobs"
+    eta_stages = BATCH_ETA_STAGES
+    if windowed:
+        eta_mode += "-windowed"
+        eta_stages = ("separate", "finalize")
+    eta_predictor = EtaPredictor(get_default_history_path(), eta_mode, eta_stages)
+    if pending:
+        with ThreadPoolExecutor(max_workers=min(len(pending), budget_cores())) as executor:
+            track_durations = list(executor.map(lambda item: probe_audio_seconds(item[0], ffmpeg_exe_path), pending))
+        known_durations = [duration for duration in track_durations if duration]
+        if known_durations:
+            typical_duration = sum(known_durations) / len(known_durations)
+            predictions = [eta_predictor.predict(duration or typical_duration) for duration in track_durations]
+            if jobs > 1:
+                predicted_seconds = sum(sum(prediction.values()) for prediction in predictions) / jobs
+            else:
+                # Pipelined stages overlap, so once the pipeline is full the slowest stage sets the pace
+                predicted_seconds = (sum(max(prediction.values()) for prediction in predictions)
+                                     + sum(predictions[0].values()) - max(predictions[0].values()))
+            _job_eta = JobEta({"batch": predicted_seconds})
+            print(f"Estimated time for {len(pending)} track(s) to separate: {predicted_seconds:.0f}s")
+            report_progress("estimate", 1.0, audio_seconds_total=sum(known_durations),
+                            job_eta_seconds=round(predicted_seconds, 1))
+
+    if pending and jobs > 1:
+        if not separate_batch_in_workers(batch, pending, jobs, eta_predictor, stream=stream,
+                                         segment_seconds=segment_seconds, precision=precision, backend=backend,
+                                         windowed=windowed, skip_silence=skip_silence):
+            return False
+    elif pending:
+        timings = separate_batch_pipelined(batch, pending, eta_predictor, stream=stream, workers=workers,
+                                           segment_seconds=segment_seconds, precision=precision, backend=backend,
+                                           windowed=windowed, skip_silence=skip_silence)
+        if timings is None:
+            return False
+        model_load_seconds, stage_timings, pipeline_seconds = timings
+
+    total_seconds = time.time() - batch_start
+    results = batch.results
+    succeeded = [r for r in results if r["ok"]]
+    audio_seconds = sum(r["audio_seconds"] for r in succeeded)
+
+    print("\n--- Batch Summary ---")
+    for r in results:
+        status = "OK    " if r["ok"] else "FAILED"
+        line = f"  {status} {r['track']}: {r['audio_seconds']:.1f}s audio in {r['wall_seconds']:.1f}s"
+        if r.get("cached"):
+            line += " (from cache)"
+        if r.get("resumed"):
+            line += " (resumed)"
+        if r["error"]:
+            line += f" ({r['error']})"
+        print(line)
+    print(f"Tracks succeeded: {len(succeeded)}/{len(results)}")
+    if model_load_seconds is not None:
+        print(f"Model load time: {model_load_seconds:.2f}s (paid once)")
+    elif jobs > 1:
+        print(f"Model loaded once per worker ({jobs} workers)")
+    print(f"Total wall time: {total_seconds:.2f}s")
+    if _job_eta:
+        print(f"Estimated beforehand: {_job_eta.total():.0f}s for the tracks that needed separating")
+    if total_seconds > 0:
+        print(f"Throughput: {len(succeeded) / (total_seconds / 60):.2f} tracks/min "
+              f"({len(succeeded) / (total_seconds / 3600):.1f} tracks/hour), "
+              f"{audio_seconds / total_seconds:.2f} audio seconds per wall second")
+    disk_bytes_written = sum(r.get("disk_bytes_written", 0) for r in results)
+    wav_bytes_avoided = sum(r.get("wav_bytes_avoided", 0) for r in results)
+    print(f"Disk written by separation/encoding: {disk_bytes_written / (1024 * 1024):.1f} MB")
+    if skip_silence:
+        silence_seconds = sum(r.get("silence_seconds_skipped", 0.0) for r in succeeded)
+        print(f"Silence skipped: {silence_seconds:.1f}s of audio not separated "
+              f"({silence_seconds / audio_seconds * 100 if audio_seconds else 0.0:.1f}% of the audio)")
+    if stream:
+        print(f"Intermediate WAVs avoided by streaming: {wav_bytes_avoided / (1024 * 1024):.1f} MB "
+              f"(the WAV path would have written {(disk_bytes_written + wav_bytes_avoided) / (1024 * 1024):.1f} MB)")
+    if stage_timings:
+        print_pipeline_report(stage_timings, pipeline_seconds)
+    _cpu_budget.print_report()
+    if cache:
+        cache.print_report()
+    return len(succeeded) == len(results)
+
+class FolderWatcher:
+    """
+    Reports files dropped into a folder once they are completely written. On Linux it sleeps on
+    inotify (IN_CLOSE_WRITE/IN_MOVED_TO), elsewhere it polls sizes and mtimes every
+    WATCH_POLL_SECONDS. Either way a file is only ready after WATCH_DEBOUNCE_SECONDS without
+    further changes, so bursts of events for one copy collapse into a single report. With
+    inotify a file its writer has closed only needs WATCH_CLOSED_SETTLE_SECONDS, while one that
+    is still open keeps waiting.
+    Files already in the folder when watching starts are reported too.
+    """
+
+    def __init__(self, folder, debounce_seconds=WATCH_DEBOUNCE_SECONDS):
+        self.folder = folder
+        self.debounce_seconds = debounce_seconds
+        self._changes = {}  # path -> {"first_seen", "last_change", "signature", "open"}
+        self._reported = {}  # path -> (size, mtime_ns) it had when reported
+        self._inotify_fd = self._open_inotify()
+        self.mode = "inotify" if self._inotify_fd is not None else "polling"
+        self._scan()
+
+    def _open_inotify(self):
+        if not sys.platform.startswith("linux"):
+            return None
+        import ctypes
+        import ctypes.util
         try:
-            done = int(match_tqdm_segment.group(1))
-            total = int(match_tqdm_segment.group(2))
-            if total > 0:
-                percentage = (done / total) * 100
-                return f"{percentage:.1f}%"
-        except ValueError:
-            pass
-            
-    match_direct_percent = re.search(r"(\d{1,3}(?:\.\d{1,2})?%)", line)
-    if match_direct_percent:
-        return match_direct_percent.group(1)
-        
-    return None
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return None
+            mask = INOTIFY_IN_MODIFY | INOTIFY_IN_CLOSE_WRITE | INOTIFY_IN_MOVED_TO | INOTIFY_IN_CREATE
+            if libc.inotify_add_watch(fd, os.fsencode(self.folder), mask) < 0:
+                os.close(fd)
+                return None
+            return fd
+        except (OSError, AttributeError):
+            return None
+
+    def _note_change(self, path, opened=None):
+        """Records a change seen by inotify (`opened` tells whether the writer still has it open) or a scan."""
+        if os.path.basename(path).startswith("."):
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._changes.pop(path, None)
+            return
+        signature = (stat.st_size, stat.st_mtime_ns)
+        if self._reported.get(path) == signature:
+            return
+        now = time.time()
+        # "open" stays None until inotify says whether a writer holds the file
+        entry = self._changes.setdefault(path, {"first_seen": now, "last_change": now, "signature": signature,
+                                                "open": None})
+        if entry["signature"] != signature or opened is not None:
+            entry["last_change"] = now
+        entry["signature"] = signature
+        if opened is not None:
+            entry["open"] = opened
+
+    def _scan(self):
+        for path in glob.glob(os.path.join(self.folder, "*")):
+            if os.path.isfile(path):
+                self._note_change(path)
+
+    def _read_inotify_events(self, timeout):
+        import select
+        readable, _, _ = select.select([self._inotify_fd], [], [], timeout)
+        if not readable:
+            return
+        try:
+            buffer = os.read(self._inotify_fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + 16 <= len(buffer):
+            _, mask, _, name_length = struct.unpack_from("iIII", buffer, offset)
+            name = buffer[offset + 16:offset + 16 + name_length].rstrip(b"\0")
+            offset += 16 + name_length
+            if name:
+                path = os.path.join(self.folder, os.fsdecode(name))
+                self._note_change(path, opened=not mask & (INOTIFY_IN_CLOSE_WRITE | INOTIFY_IN_MOVED_TO))
+
+    def wait_ready(self, timeout=WATCH_POLL_SECONDS):
+        """
+        Waits up to `timeout` seconds for changes, then returns [(path, first seen)] for the files
+        that have settled, oldest first.
+        """
+        if self._changes:
+            # Something is settling, come back soon enough to report it on time
+            timeout = min(timeout, WATCH_CLOSED_SETTLE_SECONDS)
+        if self._inotify_fd is not None:
+            self._read_inotify_events(timeout)
+        else:
+            time.sleep(timeout)
+        # Also catches writers whose close event we never saw, and every change when polling
+        self._scan()
+        now = time.time()
+        ready = []
+        for path, entry in list(self._changes.items()):
+            quiet_seconds = now - entry["last_change"]
+            if entry["open"]:
+                # A writer that went silent for long enough is assumed gone even if we missed its close
+                settle_seconds = WATCH_OPEN_FILE_TIMEOUT_SECONDS
+            elif entry["open"] is False:
+                settle_seconds = WATCH_CLOSED_SETTLE_SECONDS
+            else:
+                settle_seconds = self.debounce_seconds
+            if quiet_seconds >= settle_seconds:
+                del self._changes[path]
+                self._reported[path] = entry["signature"]
+                ready.append((path, entry["first_seen"]))
+        self._reported = {path: signature for path, signature in self._reported.items() if os.path.exists(path)}
+        return sorted(ready, key=lambda item: item[1])
+
+    def close(self):
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
 
-def convert_wav_to_mp3(wav_file_path, mp3_file_path, ffmpeg_path="ffmpeg"):
+def decode_mono_audio(input_file, samplerate, ffmpeg_exe_path="ffmpeg"):
     """
-    Converts a single WAV file to MP3 using ffmpeg at 320kbps.
-    Returns (True, mp3_filename_basename) on success, or (False, error_message_string) on failure.
+    Decodes a file's first audio stream downmixed to mono at `samplerate` into a float32 array.
+    Raises RuntimeError if ffmpeg fails.
     """
+    import numpy as np
+
     command = [
-        ffmpeg_path,
-        "-i", wav_file_path,
-        "-codec:a", "libmp3lame",
-        "-b:a", "320k",
-        mp3_file_path,
-        "-y",
+        ffmpeg_exe_path, "-i", input_file, "-map", "0:a:0", "-threads", "1",
+        "-ac", "1", "-ar", str(samplerate), "-f", "f32le", "pipe:1",
         "-loglevel", "error"
     ]
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg could not decode {os.path.basename(input_file)}: "
+                           f"{process.stderr.decode(errors='ignore').strip()}")
+    return np.frombuffer(process.stdout[:len(process.stdout) // 4 * 4], dtype="<f4")
+
+def yin_pitch_contour(samples, samplerate=PITCH_SAMPLERATE):
+    """
+    Tracks the fundamental of mono float `samples` with YIN, vectorised over blocks of frames:
+    the difference function comes from FFT cross-correlations and running sums of squares, and
+    each frame takes the first dip of the cumulative mean normalised difference below
+    PITCH_YIN_THRESHOLD, refined by parabolic interpolation.
+    Returns (f0_hz, confidence, hop, window): float32 arrays with one value per frame, f0 being
+    0 where a frame is unvoiced or silent and confidence 1 minus the normalised difference at
+    the chosen lag (0 when silent), plus the hop and window in samples.
+    """
+    import numpy as np
+
+    hop = int(round(PITCH_HOP_SECONDS * samplerate))
+    window = int(round(PITCH_WINDOW_SECONDS * samplerate))
+    min_lag = max(2, int(samplerate / PITCH_MAX_HZ))
+    max_lag = int(np.ceil(samplerate / PITCH_MIN_HZ))
+    # One extra lag so the last candidate can be compared with its neighbour
+    span = window + max_lag + 1
+    frame_count = len(samples) // hop + 1
+    padded = np.zeros(frame_count * hop + span, dtype=np.float64)
+    padded[window // 2:window // 2 + len(samples)] = samples
+    all_frames = np.lib.stride_tricks.sliding_window_view(padded, span)[::hop][:frame_count]
+    fft_size = 1 << (span - 1).bit_length()
+    lags = np.arange(max_lag + 2)
+    silence_power = 10 ** (PITCH_SILENCE_DB / 10)
+
+    f0 = np.zeros(frame_count, dtype=np.float32)
+    confidence = np.zeros(frame_count, dtype=np.float32)
+    for start in range(0, frame_count, PITCH_FRAMES_PER_BLOCK):
+        frames = all_frames[start:start + PITCH_FRAMES_PER_BLOCK]
+        rows = np.arange(len(frames))
+        # d(lag) = sum over the window of (x[j] - x[j + lag])^2 = energy + lagged energy - 2 * correlation
+        correlation = np.fft.irfft(np.conj(np.fft.rfft(frames[:, :window], fft_size))
+                                   * np.fft.rfft(frames, fft_size), fft_size)[:, :max_lag + 2]
+        squares = np.zeros((len(frames), span + 1))
+        np.cumsum(np.square(frames), axis=1, out=squares[:, 1:])
+        energy = squares[:, window]
+        difference = energy[:, None] + (squares[:, window + lags] - squares[:, lags]) - 2 * correlation
+        np.maximum(difference, 0.0, out=difference)
+        normalized = np.ones_like(difference)
+        normalized[:, 1:] = difference[:, 1:] * lags[1:] / np.maximum(np.cumsum(difference[:, 1:], axis=1), 1e-12)
+
+        candidates = normalized[:, min_lag:max_lag + 1]
+        dips = (candidates < PITCH_YIN_THRESHOLD) & (candidates <= normalized[:, min_lag + 1:max_lag + 2])
+        voiced = dips.any(axis=1)
+        best = np.where(voiced, dips.argmax(axis=1), candidates.argmin(axis=1)) + min_lag
+        # Interpolated on the raw difference, which the normalisation would skew towards longer lags
+        before, at, after = difference[rows, best - 1], difference[rows, best], difference[rows, best + 1]
+        curvature = before - 2 * at + after
+        offset = np.where(curvature > 0, (before - after) / (2 * np.where(curvature > 0, curvature, 1.0)), 0.0)
+        period = best + np.clip(offset, -1.0, 1.0)
+        loud = energy / window >= silence_power
+        f0[start:start + len(frames)] = np.where(voiced & loud, samplerate / period, 0.0)
+        confidence[start:start + len(frames)] = np.where(loud, np.clip(1.0 - normalized[rows, best], 0.0, 1.0), 0.0)
+    return f0, confidence, hop, window
+
+def pitch_contour_path(folder, track_name):
+    """Where a track's pitch contour goes, next to its vocals output: "Song [vocals].pitch"."""
+    return os.path.join(folder, f"{track_name} [{TWO_STEMS}]{PITCH_FILE_SUFFIX}")
+
+def write_pitch_contour(path, f0, confidence, samplerate, hop, window):
+    """Writes a contour from yin_pitch_contour() in the PITCH_FILE_HEADER layout, swapped in atomically."""
+    import numpy as np
+
+    header = PITCH_FILE_HEADER.pack(PITCH_FILE_MAGIC, PITCH_FILE_VERSION, PITCH_FILE_HEADER.size,
+                                    samplerate, hop, window, len(f0))
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(np.asarray(f0, dtype="<f4").tobytes())
+        f.write(np.rint(np.clip(confidence, 0.0, 1.0) * 255).astype(np.uint8).tobytes())
+    os.replace(tmp_path, path)
+
+def read_pitch_contour(path):
+    """
+    Maps a .pitch file without reading it. Returns (header dict, f0 array, confidence array),
+    the arrays being read-only memmaps and confidences the stored 0-255 bytes.
+    Raises ValueError if the file is not a pitch contour this version understands.
+    """
+    import numpy as np
+
+    with open(path, "rb") as f:
+        raw_header = f.read(PITCH_FILE_HEADER.size)
+    if len(raw_header) < PITCH_FILE_HEADER.size:
+        raise ValueError(f"{os.path.basename(path)} is too short to be a pitch contour")
+    magic, version, header_size, samplerate, hop, window, frame_count = PITCH_FILE_HEADER.unpack(raw_header)
+    if magic != PITCH_FILE_MAGIC or version != PITCH_FILE_VERSION:
+        raise ValueError(f"{os.path.basename(path)} is not a version {PITCH_FILE_VERSION} pitch contour")
+    header = {"samplerate": samplerate, "hop": hop, "window": window, "frames": frame_count}
+    if not frame_count:
+        return header, np.zeros(0, dtype="<f4"), np.zeros(0, dtype=np.uint8)
+    f0 = np.memmap(path, dtype="<f4", mode="r", offset=header_size, shape=(frame_count,))
+    confidence = np.memmap(path, dtype=np.uint8, mode="r", offset=header_size + 4 * frame_count,
+                           shape=(frame_count,))
+    return header, f0, confidence
+
+def write_vocal_pitch(folder, track_name, plan, ffmpeg_exe_path="ffmpeg"):
+    """
+    Post-separation stage: writes the pitch contour of a track's finished vocals output in
+    `folder` next to it (see yin_pitch_contour()). It works from the published file, so cache
+    hits, resumed tracks and the demucs CLI path get a contour too. A failure only warns, the
+    track itself is fine. Returns the contour's path, or None if there was no vocals output.
+    """
+    if TWO_STEMS not in plan:
+        return None
+    vocals_path = stem_output_path(folder, track_name, TWO_STEMS, plan)
+    if not os.path.exists(vocals_path):
+        return None
+    path = pitch_contour_path(folder, track_name)
     try:
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
+        samples = decode_mono_audio(vocals_path, PITCH_SAMPLERATE, ffmpeg_exe_path)
+        with cpu_reservation(1, "analyze"):
+            f0, confidence, hop, window = yin_pitch_contour(samples, PITCH_SAMPLERATE)
+        write_pitch_contour(path, f0, confidence, PITCH_SAMPLERATE, hop, window)
+    except (OSError, RuntimeError) as e:
+        print(f"Warning: Could not write the pitch contour for '{track_name}': {e}")
+        return None
+    voiced_percent = (f0 > 0).mean() * 100 if len(f0) else 0.0
+    print(f"Pitch contour: {os.path.basename(path)} ({len(f0)} frames, {voiced_percent:.0f}% voiced)")
+    return path
 
-        if process.returncode == 0:
-            return True, os.path.basename(mp3_file_path)
-        else:
-            error_message = f"Error converting {os.path.basename(wav_file_path)} to MP3."
-            decoded_stdout = stdout.decode(errors='ignore').strip()
-            decoded_stderr = stderr.decode(errors='ignore').strip()
-            if decoded_stdout:
-                error_message += f"\n  FFmpeg stdout: {decoded_stdout}"
-            if decoded_stderr:
-                error_message += f"\n  FFmpeg stderr: {decoded_stderr}"
-            return False, error_message.strip()
-            
-    except FileNotFoundError:
-        return False, f"Error: '{ffmpeg_path}' command not found. Ensure ffmpeg is installed and in PATH."
-    except Exception as e:
-        return False, f"Unexpected error during ffmpeg conversion of {os.path.basename(wav_file_path)}: {e}"
+def peak_pyramid(frames, length=None):
+    """
+    Builds the peak pyramid of (samples, channels) float audio, e.g. a PcmBuffer's `pcm`, read
+    in its own interleaved layout so each level 0 peak is one min and one max over a contiguous
+    run of PEAKS_BASE_SAMPLES frames. With `length`, the audio is cut or padded with
+    silence to that many samples, so two sources get the same peak counts.
+    Returns (length, levels): a list of (count, 2) int8 arrays, finest first, ending with one peak.
+    """
+    import numpy as np
 
-def main():
+    length = frames.shape[0] if length is None else length
+    samples = min(length, frames.shape[0])
+    flat = frames[:samples].reshape(-1)
+    block = PEAKS_BASE_SAMPLES * frames.shape[1]
+    count = -(-length // PEAKS_BASE_SAMPLES)
+    lows = np.zeros(count, dtype=np.float32)
+    highs = np.zeros(count, dtype=np.float32)
+    full_peaks = samples // PEAKS_BASE_SAMPLES
+    for start in range(0, full_peaks, PEAKS_BLOCK_PEAKS):
+        end = min(start + PEAKS_BLOCK_PEAKS, full_peaks)
+        chunk = flat[start * block:end * block].reshape(end - start, block)
+        lows[start:end] = chunk.min(axis=1)
+        highs[start:end] = chunk.max(axis=1)
+    if samples % PEAKS_BASE_SAMPLES:
+        tail = flat[full_peaks * block:]
+        lows[full_peaks] = tail.min()
+        highs[full_peaks] = tail.max()
+        if samples < length:
+            # The rest of this peak is padding, i.e. silence, like every peak after it already is
+            lows[full_peaks] = min(lows[full_peaks], 0.0)
+            highs[full_peaks] = max(highs[full_peaks], 0.0)
 
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    parent_dir = os.path.dirname(script_dir)
-    output_directory = os.path.join(parent_dir, "output")
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    input_folder = os.path.join(script_dir, "input")
+    levels = []
+    while True:
+        levels.append(np.stack([
+            np.floor(np.clip(lows, -1.0, 1.0) * 127),
+            np.ceil(np.clip(highs, -1.0, 1.0) * 127),
+        ], axis=1).astype(np.int8))
+        if len(lows) <= 1:
+            return length, levels
+        padding = -len(lows) % PEAKS_LEVEL_FACTOR
+        lows = np.concatenate([lows, np.full(padding, np.inf, dtype=np.float32)])
+        highs = np.concatenate([highs, np.full(padding, -np.inf, dtype=np.float32)])
+        lows = lows.reshape(-1, PEAKS_LEVEL_FACTOR).min(axis=1)
+        highs = highs.reshape(-1, PEAKS_LEVEL_FACTOR).max(axis=1)
 
-    if not os.path.isdir(input_folder):
-        print(f"Error: 'input' folder not found at {input_folder}")
-        sys.exit(1)
+def file_peak_pyramid(path, ffmpeg_exe_path="ffmpeg", length=None):
+    """Decodes an audio file to a temporary PcmBuffer and returns peak_pyramid() of it."""
+    pcm = PcmBuffer.decode(path, DEMUCS_SAMPLERATE, DEMUCS_CHANNELS, ffmpeg_exe_path)
+    try:
+        return peak_pyramid(pcm.pcm, length)
+    finally:
+        pcm.close()
 
-    input_mp3_file = find_first_mp3(input_folder)
-    if not input_mp3_file:
-        print(f"Error: No .mp3 file found in the '{input_folder}' directory.")
-        sys.exit(1)
+def track_peaks_path(folder, track_name):
+    """Where a track's peak pyramid goes, next to its outputs: "Song.peaks"."""
+    return os.path.join(folder, f"{track_name}{PEAKS_FILE_SUFFIX}")
 
-    print(f"Found input MP3: {input_mp3_file}")
-    print(f"Output directory: {output_directory}")
+def write_peak_pyramids(path, length, sources, samplerate=DEMUCS_SAMPLERATE):
+    """
+    Writes pyramids of `length` samples (levels lists from peak_pyramid(), all with the same
+    counts) in the PEAKS_FILE_HEADER layout, swapped in atomically.
+    """
+    import numpy as np
+
+    counts = [len(level) for level in sources[0]]
+    header = PEAKS_FILE_HEADER.pack(PEAKS_FILE_MAGIC, PEAKS_FILE_VERSION, PEAKS_FILE_HEADER.size + 4 * len(counts),
+                                    samplerate, length, PEAKS_BASE_SAMPLES, PEAKS_LEVEL_FACTOR, len(counts),
+                                    len(sources))
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(np.asarray(counts, dtype="<u4").tobytes())
+        for levels in sources:
+            for level in levels:
+                f.write(level.tobytes())
+    os.replace(tmp_path, path)
+
+def read_peak_pyramids(path):
+    """
+    Maps a .peaks file without reading it. Returns (header dict, sources): for each source, the
+    list of its levels as read-only (count, 2) int8 memmaps, finest first.
+    Raises ValueError if the file is not a peak pyramid this version understands.
+    """
+    import numpy as np
+
+    with open(path, "rb") as f:
+        raw_header = f.read(PEAKS_FILE_HEADER.size)
+        if len(raw_header) < PEAKS_FILE_HEADER.size:
+            raise ValueError(f"{os.path.basename(path)} is too short to be a peak pyramid")
+        (magic, version, header_size, samplerate, length, base_samples, level_factor, level_count,
+         source_count) = PEAKS_FILE_HEADER.unpack(raw_header)
+        if magic != PEAKS_FILE_MAGIC or version != PEAKS_FILE_VERSION:
+            raise ValueError(f"{os.path.basename(path)} is not a version {PEAKS_FILE_VERSION} peak pyramid")
+        counts = np.frombuffer(f.read(4 * level_count), dtype="<u4").tolist()
+    header = {"samplerate": samplerate, "length": length, "base_samples": base_samples,
+              "level_factor": level_factor, "levels": level_count, "sources": source_count}
+    sources = []
+    offset = header_size
+    for _ in range(source_count):
+        levels = []
+        for count in counts:
+            if count:
+                levels.append(np.memmap(path, dtype=np.int8, mode="r", offset=offset, shape=(count, 2)))
+            else:
+                levels.append(np.zeros((0, 2), dtype=np.int8))
+            offset += 2 * count
+        sources.append(levels)
+    return header, sources
+
+def write_track_peaks(folder, track_name, plan, input_file, ffmpeg_exe_path="ffmpeg", original=None):
+    """
+    Writes "<track>.peaks" in `folder`: the peak pyramids (see peak_pyramid()) of the original
+    audio and, when the plan keeps them, the finished vocals next to it. `original` is the
+    original's (length, levels) if the caller already reduced the track's PcmBuffer; otherwise
+    `input_file` is decoded for it, so this has to run before the input is deleted. A failure
+    only warns, the track itself is fine. Returns the file's path, or None if it failed.
+    """
+    path = track_peaks_path(folder, track_name)
+    try:
+        with cpu_reservation(1, "analyze"):
+            length, original_levels = original or file_peak_pyramid(input_file, ffmpeg_exe_path)
+            sources = [original_levels]
+            vocals_path = stem_output_path(folder, track_name, TWO_STEMS, plan) if TWO_STEMS in plan else None
+            if vocals_path and os.path.exists(vocals_path):
+                sources.append(file_peak_pyramid(vocals_path, ffmpeg_exe_path, length)[1])
+        write_peak_pyramids(path, length, sources)
+    except (OSError, RuntimeError) as e:
+        print(f"Warning: Could not write the waveform peaks for '{track_name}': {e}")
+        return None
+    print(f"Waveform peaks: {os.path.basename(path)} ({len(sources)} source(s), {len(original_levels)} levels)")
+    return path
+
+def publish_outputs(staging_folder, output_folder, track_name, plan):
+    """
+    Moves a track's finished outputs from the staging folder into `output_folder` with
+    os.replace(), so anything reading the output folder only ever sees complete files.
+    """
+    published = []
+    for stem_name in plan:
+        staged_path = stem_output_path(staging_folder, track_name, stem_name, plan)
+        if os.path.exists(staged_path):
+            final_path = stem_output_path(output_folder, track_name, stem_name, plan)
+            os.replace(staged_path, final_path)
+            published.append(final_path)
+    return published
+
+def run_watch(input_folder, output_directory, plan, cache=None, stream=False, workers=1,
+              segment_seconds=DEFAULT_SEGMENT_SECONDS, precision="fp32", backend="torch", windowed=False,
+              skip_silence=False, pitch=True, peaks=True):
+    """
+    Long-running mode: loads the Demucs model once, warms it up, then separates every audio file
+    that lands in the input folder as soon as it is completely written (see FolderWatcher) and
+    probing shows ffmpeg can decode it. Outputs
+    are produced in a staging folder and published into output/htdemucs atomically, and each
+    input is deleted once its outputs are published. With `windowed`, tracks are separated in
+    `segment_seconds` windows in constant memory, and with `skip_silence` long silences are not
+    separated. With `pitch`, published vocals get a pitch contour next to them, and with `peaks`
+    each track a waveform peak pyramid.
+    Runs until interrupted with Ctrl+C.
+    """
+    global _cpu_budget
+    import torch
 
-    # Use demucs from venv
     if sys.platform == "win32":
-        demucs_exe_path = os.path.join(parent_dir, "venv", "Scripts", "demucs.exe")
-    else:
-        # On Linux/macOS, it's in venv/bin/demucs
-        demucs_exe_path = os.path.join(parent_dir, "venv", "bin", "demucs")
+        # demucs' in-process loader calls ffmpeg/ffprobe by name
+        os.environ["PATH"] = abs_ffmpeg_dir + os.pathsep + os.environ.get("PATH", "")
 
-    if not os.path.isfile(demucs_exe_path):
-        print(f"Error: demucs executable not found at {demucs_exe_path}")
-        print("Please ensure Demucs is installed in the venv.")
-        sys.exit(1)
+    demucs_output_wav_folder = os.path.join(output_directory, DEMUCS_MODEL_NAME)
+    staging_folder = os.path.join(output_directory, OUTPUT_STAGING_DIR)
+    os.makedirs(demucs_output_wav_folder, exist_ok=True)
+    os.makedirs(staging_folder, exist_ok=True)
+    ffmpeg_exe_path = get_ffmpeg_exe_path()
+    _cpu_budget = CpuBudget()
+    manifest = JobManifest(os.path.join(output_directory, JOB_MANIFEST_NAME))
 
-    demucs_command = [
-        demucs_exe_path,
-        "--two-stems=vocals",
-        input_mp3_file,
-        "-o", output_directory,
-        "--filename", "{track} [{stem}].{ext}"
-    ]
-    # Prepare the environment for the subprocess
-    custom_env = os.environ.copy()
+    print(f"--- Watch mode: '{input_folder}' ---")
+    print(f"Output plan: {describe_output_plan(plan)}")
+    start = time.time()
+    try:
+        model = load_separation_model(precision=precision, backend=backend)
+    except Exception as e:
+        print(f"Error: Could not load Demucs model '{DEMUCS_MODEL_NAME}': {e}")
+        return False
+    segment_pool = None
+    try:
+        if workers > 1:
+            segment_pool = SegmentPool(model, workers, segment_seconds=segment_seconds)
+        elif windowed:
+            segment_plan_settings(model, segment_seconds)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return False
+    # One tiny separation allocates everything lazily initialised, so the first real track doesn't pay for it
+    separate_track_audio(model, torch.zeros(2, int(model.samplerate * WATCH_WARMUP_SECONDS)), stems_wanted=plan)
+    print(f"Model '{DEMUCS_MODEL_NAME}' loaded and warmed up in {time.time() - start:.2f}s")
+
+    watcher = FolderWatcher(input_folder)
+    print(f"Watching for new audio files using {watcher.mode} (Ctrl+C to stop)...")
+    sys.stdout.flush()
+    processed = 0
+    try:
+        while True:
+            for input_file, first_seen in watcher.wait_ready():
+                if not os.path.exists(input_file):
+                    continue
+                if not probe_audio(input_file, ffmpeg_exe_path):
+                    print(f"Skipping '{os.path.basename(input_file)}': not an audio file ffmpeg can read.")
+                    continue
+                track_name = track_name_for(input_file)
+                print(f"\n--- Separating {os.path.basename(input_file)} ---")
+                track_start = time.time()
+                cache_key = None
+                restored = False
+                pcm = None
+                original_peaks = None
+                if not windowed:
+                    # Decoded once for the cache hash, separation and the peak pyramid alike
+                    try:
+                        pcm = PcmBuffer.decode(input_file, model.samplerate, model.audio_channels, ffmpeg_exe_path)
+                    except Exception:
+                        pcm = None  # separate_batch_track() reports the decode error
+                    if pcm is not None and peaks:
+                        original_peaks = peak_pyramid(pcm.pcm)
+                if cache:
+                    cache_key = cache.key_for(input_file, ffmpeg_exe_path, plan[TWO_STEMS]["bitrate"],
+                                              audio=pcm.audio() if pcm is not None else None,
+                                              samplerate=model.samplerate, decode=windowed)
+                    staged_vocals = stem_output_path(staging_folder, track_name, TWO_STEMS, plan)
+                    restored = bool(cache_key) and cache.restore(cache_key, staged_vocals)
+                if restored:
+                    result = {"ok": True, "error": None, "busy_seconds": 0.0}
+                else:
+                    manifest.advance(input_file, "queued")
+                    result = separate_batch_track(model, input_file, staging_folder, ffmpeg_exe_path, plan,
+                                                  stream=stream, segment_pool=segment_pool,
+                                                  window_seconds=segment_seconds if windowed else None,
+                                                  skip_silence=skip_silence, pcm=pcm)
+                if pcm is not None:
+                    pcm.close()
+                if not result["ok"]:
+                    manifest.record_error(input_file, result["error"])
+                    print(f"FAILED {os.path.basename(input_file)}: {result['error']} (input kept)")
+                    continue
+                if cache_key and not restored:
+                    cache.store(cache_key, stem_output_path(staging_folder, track_name, TWO_STEMS, plan),
+                                result["busy_seconds"])
+                outputs = publish_outputs(staging_folder, demucs_output_wav_folder, track_name, plan)
+                if pitch:
+                    write_vocal_pitch(demucs_output_wav_folder, track_name, plan, ffmpeg_exe_path)
+                if peaks:
+                    write_track_peaks(demucs_output_wav_folder, track_name, plan, input_file, ffmpeg_exe_path,
+                                      original=original_peaks)
+                manifest.advance(input_file, "encoded", outputs=outputs)
+                if remove_processed_input(input_file):
+                    manifest.advance(input_file, "finalized", outputs=outputs)
+                processed += 1
+                print(f"Published {', '.join(os.path.basename(path) for path in outputs)}")
+                report_progress("done", 1.0, track=os.path.basename(input_file),
+                                drop_to_result_seconds=round(time.time() - first_seen, 2))
+                print(f"Drop to result: {time.time() - first_seen:.1f}s "
+                      f"(separation and encoding {time.time() - track_start:.1f}s)")
+                if result.get("silence_seconds_skipped"):
+                    print(f"Silence skipped: {result['silence_seconds_skipped']:.1f}s of audio not separated")
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        print(f"\nStopped watching after {processed} track(s).")
+    finally:
+        watcher.close()
+        if segment_pool:
+            segment_pool.close()
+        if cache:
+            cache.print_report()
+    return True
+
+def preview_output_path(folder, track_name, stem_name, plan):
+    """Where a stem's preview goes: its final path with ".preview" before the extension."""
+    final_root, extension = os.path.splitext(stem_output_path(folder, track_name, stem_name, plan))
+    return f"{final_root}.preview{extension}"
+
+def write_preview_manifest(folder, track_name, state, files, preview_seconds, duration_seconds):
+    """Tells the host which files to play for a progressively separated track and whether they are final."""
+    write_json_atomic(os.path.join(folder, f"{track_name}{PREVIEW_MANIFEST_SUFFIX}"), {
+        "track": track_name,
+        "state": state,
+        "preview_seconds": round(preview_seconds, 2),
+        "duration_seconds": round(duration_seconds, 2),
+        "files": files,
+    })
+
+def separate_with_preview(model, input_file, output_folder, plan, preview_seconds, ffmpeg_exe_path):
+    """
+    Progressive separation of one track: the first `preview_seconds` are separated and encoded
+    on their own and published as "<stem>.preview" files plus a "<track>.preview.json" manifest,
+    then the rest is separated and stitched on (see plan_preview_segments()) and the full
+    outputs are swapped in atomically, the manifest switched to them and the previews removed.
+    Returns the paths of the full outputs.
+    """
+    import torch
+
+    track_name = track_name_for(input_file)
+    staging_folder = os.path.join(os.path.dirname(output_folder), OUTPUT_STAGING_DIR)
+    os.makedirs(staging_folder, exist_ok=True)
+    pcm = PcmBuffer.decode(input_file, model.samplerate, model.audio_channels, ffmpeg_exe_path)
+    try:
+        wav = pcm.audio()
+        length = wav.shape[-1]
+        # Normalise with the whole track's statistics so the preview matches the final output
+        ref = wav.mean(0)
+        mean = ref.mean()
+        std = ref.std() + 1e-8
+        normalized = torch.empty(tuple(wav.shape))
+        torch.sub(wav, mean, out=normalized).div_(std)
+        del wav, ref
+    finally:
+        pcm.close()
+    samplerate = model.samplerate
+    preview_samples = min(length, int(preview_seconds * samplerate))
+    bounds, fades = plan_preview_segments(length, preview_samples, model_chunk_samples(model), int(0.5 * samplerate),
+                                          int(SEGMENT_CROSSFADE_SECONDS * samplerate))
+
+    def separate_segment(start, end):
+        with cpu_reservation(budget_cores(), "separate") as cores:
+            torch.set_num_threads(cores)
+            return apply_separation_model(model, normalized[None, :, start:end])[0].numpy()
+
+    outputs = [separate_segment(*bounds[0])]
+    if len(bounds) > 1:
+        preview_start = time.time()
+        preview_stems = select_stems(model, torch.from_numpy(outputs[0][..., :preview_samples]) * std + mean,
+                                     stems_wanted=plan)
+        converted_count, failed_count = write_planned_stems(preview_stems, samplerate, staging_folder,
+                                                            track_name, plan, ffmpeg_exe_path)
+        if failed_count:
+            raise RuntimeError(f"{failed_count} preview encode(s) failed")
+        preview_files = {}
+        for stem_name in preview_stems:
+            preview_path = preview_output_path(output_folder, track_name, stem_name, plan)
+            os.replace(stem_output_path(staging_folder, track_name, stem_name, plan), preview_path)
+            preview_files[stem_name] = preview_path
+        write_preview_manifest(output_folder, track_name, "preview", preview_files,
+                               preview_samples / samplerate, length / samplerate)
+        print(f"Preview ready: first {preview_samples / samplerate:.0f}s in "
+              f"{', '.join(os.path.basename(path) for path in preview_files.values())} "
+              f"(encoded in {time.time() - preview_start:.1f}s)")
+        report_progress("preview", 1.0, track=os.path.basename(input_file), files=preview_files)
+        sys.stdout.flush()
+        outputs.append(separate_segment(*bounds[1]))
+
+    sources = torch.from_numpy(stitch_segments(outputs, bounds, fades, length))
+    stems = select_stems(model, sources * std + mean, stems_wanted=plan)
+    converted_count, failed_count = write_planned_stems(stems, samplerate, staging_folder, track_name, plan,
+                                                        ffmpeg_exe_path)
+    if failed_count:
+        raise RuntimeError(f"{failed_count} output conversion(s) failed")
+    outputs = publish_outputs(staging_folder, output_folder, track_name, plan)
+    write_preview_manifest(output_folder, track_name, "complete",
+                           {stem_name: stem_output_path(output_folder, track_name, stem_name, plan) for stem_name in stems},
+                           length / samplerate, length / samplerate)
+    for stem_name in stems:
+        preview_path = preview_output_path(output_folder, track_name, stem_name, plan)
+        if os.path.exists(preview_path):
+            os.remove(preview_path)
+    return outputs
+
+def run_progressive(input_file, output_folder, plan, preview_seconds, manifest, cache=None,
+                    cache_key=None, precision="fp32", backend="torch", pitch=True, peaks=True):
+    """
+    Single-track mode with --preview: separates in this process with separate_with_preview(),
+    writes the vocals' pitch contour with `pitch` and the track's peak pyramid with `peaks`, then
+    removes the processed input like the Demucs CLI path. Returns True on success.
+    """
+    global _cpu_budget
     if sys.platform == "win32":
-        # Force absolute path so TorchCodec doesn't guess
-        custom_env["TORCHCODEC_FFMPEG_DIR"] = abs_ffmpeg_dir
-        # Put it at the front of PATH so 'ffmpeg' is found here first
-        custom_env["PATH"] = abs_ffmpeg_dir + os.pathsep + custom_env.get("PATH", "")
+        # demucs' in-process loader calls ffmpeg/ffprobe by name
+        os.environ["PATH"] = abs_ffmpeg_dir + os.pathsep + os.environ.get("PATH", "")
+    _cpu_budget = CpuBudget()
+    start = time.time()
+    print(f"\n--- Progressive separation: {preview_seconds:.0f}s preview first ---")
+    try:
+        model = load_separation_model(precision=precision, backend=backend)
+        outputs = separate_with_preview(model, input_file, output_folder, plan, preview_seconds,
+                                        get_ffmpeg_exe_path())
+    except Exception as e:
+        manifest.record_error(input_file, str(e))
+        print(f"Error: Progressive separation failed: {e}")
+        return False
+    manifest.advance(input_file, "encoded", outputs=outputs)
+    vocals_mp3_path = stem_output_path(output_folder, track_name_for(input_file), TWO_STEMS, plan)
+    if cache and cache_key and os.path.exists(vocals_mp3_path):
+        cache.store(cache_key, vocals_mp3_path, time.time() - start)
+    if pitch:
+        write_vocal_pitch(output_folder, track_name_for(input_file), plan, get_ffmpeg_exe_path())
+    if peaks:
+        write_track_peaks(output_folder, track_name_for(input_file), plan, input_file, get_ffmpeg_exe_path())
+    if remove_processed_input(input_file):
+        manifest.advance(input_file, "finalized", outputs=outputs)
+    if not report_progress("done", 1.0, track=os.path.basename(input_file)):
+        print("Progress: 100%")
+    print(f"Full track published in {time.time() - start:.1f}s")
+    return True
 
+def run_demucs_cli(demucs_command, env, track=None):
+    """
+    Runs the Demucs CLI, relaying its progress bar as "Progress: NN%" lines (or as events on the
+    progress channel, when one is open) and the rest of its output as-is.
+    Returns True if it exited successfully.
+    """
+    demucs_succeeded = False
     try:
         process = subprocess.Popen(
             demucs_command,
@@ -181,7 +4419,7 @@ def main():
             stderr=subprocess.PIPE,
             text=True,
             bufsize=1,
-            env=custom_env 
+            env=env
         )
         
         print("--- Demucs Processing (Ctrl+C to interrupt) ---")
@@ -190,6 +4428,12 @@ def main():
                 break
             
             stripped_line = line.strip()
+            if _progress is not None:
+                tqdm_progress = parse_tqdm_progress(stripped_line)
+                if tqdm_progress:
+                    fraction, done, total = tqdm_progress
+                    report_progress("separate", fraction, audio_seconds=done, audio_seconds_total=total, track=track)
+                    continue
             progress_percentage = parse_demucs_progress(stripped_line)
             
             if progress_percentage:
@@ -231,125 +4475,391 @@ def main():
     except Exception as e:
         print(f"An unexpected error occurred during Demucs processing: {e}")
         # Script will proceed to input cleanup, then exit if demucs_succeeded is False
+    return demucs_succeeded
 
+def main():
+    parser = argparse.ArgumentParser(
+        description="Separates the vocals from the song(s) in the 'input' folder using Demucs."
+    )
+    parser.add_argument(
+        "--batch", action="store_true",
+        help="Separate every audio file in 'input' (any format ffmpeg decodes) in one process, loading the model only once."
+    )
+    parser.add_argument(
+        "--watch", action="store_true",
+        help="Keep running with the model loaded and separate every audio file dropped into 'input' as soon as it is fully written."
+    )
+    parser.add_argument(
+        "--preview", action="store_true",
+        help="Separate and publish the first --preview-seconds as '.preview' files first, then the full track."
+    )
+    parser.add_argument(
+        "--preview-seconds", dest="preview_seconds", type=float, default=PREVIEW_SECONDS,
+        help=f"Length of the --preview excerpt (default {PREVIEW_SECONDS:.0f}s)."
+    )
+    parser.add_argument(
+        "--precision", choices=PRECISIONS, default="fp32",
+        help="Fast CPU mode for in-process separation (--batch, --watch, --preview): 'int8' quantizes the model "
+             "dynamically, 'bf16' uses bfloat16 on CPUs that support it. Check the quality cost with --check-precision."
+    )
+    parser.add_argument(
+        "--check-precision", dest="check_precision", action="store_true",
+        help="Separate a synthetic fixture at every precision and report speed and SDR against fp32, then exit."
+    )
+    parser.add_argument(
+        "--backend", choices=SEPARATION_BACKENDS, default=None,
+        help="Separation backend: 'cli' runs the Demucs CLI (the default for single tracks), 'torch' separates "
+             "in-process (the default for --batch, --watch, --preview), 'compiled' in-process with the model compiled "
+             "for this CPU by AOTInductor, 'onnx' in-process with ONNX Runtime. Compiled and ONNX models are built "
+             "once on first use and kept in the user cache."
+    )
+    parser.add_argument(
+        "--benchmark-backends", dest="benchmark_backends", action="store_true",
+        help="Time startup, real-time factor and peak memory of every backend on a synthetic fixture, then exit."
+    )
+    parser.add_argument(
+        "--benchmark-memory", dest="benchmark_memory", action="store_true",
+        help=f"Report per-worker and total memory of {', '.join(map(str, MEMORY_BENCHMARK_WORKER_COUNTS))} "
+             "separation workers with private and with shared memory-mapped weights, then exit."
+    )
+    parser.add_argument(
+        "--mp3-encoder", dest="mp3_encoder", choices=MP3_ENCODERS, default="auto",
+        help="MP3 encoder: 'lame' encodes in-process with the lameenc package instead of starting an ffmpeg process "
+             "per stem, 'ffmpeg' always uses ffmpeg. 'auto' (the default) uses lame when lameenc is installed."
+    )
+    parser.add_argument(
+        "--benchmark-encoders", dest="benchmark_encoders", action="store_true",
+        help="Time both MP3 encoders on short synthetic tracks (wall and CPU time per track), then exit."
+    )
+    parser.add_argument(
+        "--benchmark-profiles", dest="benchmark_profiles", action="store_true",
+        help=f"Encode a synthetic fixture with every output format ({', '.join(OUTPUT_FORMATS)}) and report encode "
+             "time, file size and decode time, then exit."
+    )
+    parser.add_argument(
+        "--windowed", action="store_true",
+        help="With --batch or --watch, decode, separate and encode each track in --segment-seconds windows, "
+             "so memory use stays the same however long the track is."
+    )
+    parser.add_argument(
+        "--skip-silence", dest="skip_silence", action="store_true",
+        help=f"With --batch or --watch, don't separate silences longer than {SILENCE_MIN_SECONDS:g}s "
+             f"(below {SILENCE_THRESHOLD_DB:g} dBFS); they are spliced back in so timing is unchanged."
+    )
+    parser.add_argument(
+        "--no-pitch", dest="no_pitch", action="store_true",
+        help=f"Don't write the '<track> [{TWO_STEMS}]{PITCH_FILE_SUFFIX}' pitch contour (YIN f0 and confidence "
+             f"every {PITCH_HOP_SECONDS * 1000:g} ms) next to the vocals output."
+    )
+    parser.add_argument(
+        "--no-peaks", dest="no_peaks", action="store_true",
+        help=f"Don't write the '<track>{PEAKS_FILE_SUFFIX}' waveform peak pyramid (min/max of the original and "
+             f"vocals from {PEAKS_BASE_SAMPLES} samples per peak up to the whole track) next to the outputs."
+    )
+    parser.add_argument(
+        "--check-windowed", dest="check_windowed", action="store_true",
+        help=f"Separate {WINDOWED_CHECK_SECONDS / 60:.0f} minutes of synthetic audio with --windowed and fail if peak "
+             f"memory exceeds {WINDOWED_RSS_CEILING_MB} MB, then exit. Takes as long as separating that much audio."
+    )
+    parser.add_argument(
+        "--stream", action="store_true",
+        help="With --batch or --watch, pipe separated stems straight into the MP3 encoder instead of writing WAVs."
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="With --batch or --watch, split each track into overlapping segments separated by this many worker processes."
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=1,
+        help="With --batch, separate this many tracks at once in separate worker processes, "
+             "splitting the cores between them. 0 picks a count from the available cores and RAM."
+    )
+    parser.add_argument(
+        "--segment-seconds", dest="segment_seconds", type=float, default=DEFAULT_SEGMENT_SECONDS,
+        help=f"Segment length for --workers and window length for --windowed (default {DEFAULT_SEGMENT_SECONDS:.0f}s). "
+             "Longer segments waste less work on overlaps."
+    )
+    parser.add_argument(
+        "--benchmark-workers", dest="benchmark_workers", action="store_true",
+        help=f"Time the first input track at {', '.join(map(str, BENCHMARK_WORKER_COUNTS))} segment workers "
+             "against a single pass, without writing output or deleting the input."
+    )
+    parser.add_argument(
+        "--keep", default=DEFAULT_OUTPUT_PLAN,
+        help="Output plan: comma-separated stem[:format[:bitrate]] entries, e.g. "
+             f"'vocals:mp3:320k,no_vocals:wav'. Formats: {', '.join(OUTPUT_FORMATS)} (ogg is Vorbis). "
+             f"Stems not listed are never encoded (default '{DEFAULT_OUTPUT_PLAN}')."
+    )
+    parser.add_argument(
+        "--no-cache", dest="no_cache", action="store_true",
+        help="Always run Demucs, neither reading from nor adding to the separation cache."
+    )
+    parser.add_argument(
+        "--cache-dir", dest="cache_dir", default=None,
+        help="Separation cache location. Defaults to a per-user cache folder outside the install."
+    )
+    parser.add_argument(
+        "--cache-max-mb", dest="cache_max_mb", type=int, default=DEFAULT_CACHE_MAX_MB,
+        help=f"Disk quota for the separation cache in MB (default {DEFAULT_CACHE_MAX_MB}); oldest entries are evicted first."
+    )
+    parser.add_argument(
+        "--progress-fd", dest="progress_fd", type=int, default=None,
+        help="Write progress as JSON lines to this inherited file descriptor instead of 'Progress: NN%%' text."
+    )
+    parser.add_argument(
+        "--progress-socket", dest="progress_socket", default=None,
+        help="Like --progress-fd, but connect to this host:port over TCP (works the same on Windows)."
+    )
+    parser.add_argument(
+        "--progress-rate", dest="progress_rate", type=float, default=DEFAULT_PROGRESS_RATE,
+        help=f"Maximum progress events per second on the progress channel (default {DEFAULT_PROGRESS_RATE:g})."
+    )
+    args = parser.parse_args()
+    try:
+        plan = parse_output_plan(args.keep)
+    except ValueError as e:
+        print(f"Error: Invalid output plan: {e}")
+        sys.exit(1)
 
-    # --- INPUT FILE DELETION --- (Requirement 2)
-    print("\n--- Cleaning up input folder ---")
-    if os.path.isdir(input_folder):
-        input_files_to_delete = glob.glob(os.path.join(input_folder, "*"))
-        if not input_files_to_delete:
-            print(f"No files found in '{input_folder}' to delete.")
-        else:
-            deleted_input_count = 0
-            for file_path in input_files_to_delete:
-                try:
-                    if os.path.isfile(file_path) or os.path.islink(file_path):
-                        os.remove(file_path)
-                        print(f"Deleted from input: {os.path.basename(file_path)}")
-                        deleted_input_count +=1
-                    # Not attempting to delete subdirectories, only files.
-                except OSError as e:
-                    print(f"Warning: Could not delete '{os.path.basename(file_path)}' from input folder: {e}")
-            print(f"Attempted to delete {len(input_files_to_delete)} item(s), successfully deleted {deleted_input_count} file(s) from input folder.")
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parent_dir = os.path.dirname(script_dir)
+    output_directory = os.path.join(parent_dir, "output")
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    input_folder = os.path.join(script_dir, "input")
+
+    if not os.path.isdir(input_folder):
+        print(f"Error: 'input' folder not found at {input_folder}")
+        sys.exit(1)
+
+    if args.workers < 1 or args.jobs < 0:
+        print("Error: --workers must be at least 1 and --jobs at least 0.")
+        sys.exit(1)
+    if args.workers > 1 and args.jobs != 1:
+        print("Error: Use either --workers (split each track) or --jobs (several tracks at once), not both.")
+        sys.exit(1)
+
+    if args.progress_fd is not None or args.progress_socket:
+        global _progress
+        try:
+            _progress = ProgressChannel.open(fd=args.progress_fd, address=args.progress_socket,
+                                             max_rate=args.progress_rate)
+        except (OSError, ValueError) as e:
+            print(f"Error: Could not open the progress channel: {e}")
+            sys.exit(1)
+
+    global _mp3_encoder
+    _mp3_encoder = resolve_mp3_encoder(args.mp3_encoder)
+    if args.benchmark_encoders:
+        sys.exit(0 if run_encoder_benchmark() else 1)
+    if args.benchmark_profiles:
+        sys.exit(0 if run_profile_benchmark() else 1)
+    if args.check_precision:
+        sys.exit(0 if run_precision_check() else 1)
+    if args.precision != "fp32" and not (args.batch or args.watch or args.preview):
+        print("Error: --precision needs in-process separation; add --batch, --watch or --preview.")
+        sys.exit(1)
+    if args.benchmark_backends:
+        sys.exit(0 if run_backend_benchmark() else 1)
+    if args.benchmark_memory:
+        sys.exit(0 if run_memory_benchmark() else 1)
+    if args.check_windowed:
+        sys.exit(0 if run_windowed_check(plan, args.segment_seconds) else 1)
+    if args.windowed and not (args.batch or args.watch):
+        print("Error: --windowed needs --batch or --watch.")
+        sys.exit(1)
+    if args.skip_silence and not (args.batch or args.watch):
+        print("Error: --skip-silence needs --batch or --watch.")
+        sys.exit(1)
+    if args.windowed and args.workers > 1:
+        print("Error: Use either --workers (segments in parallel) or --windowed (one window at a time), not both.")
+        sys.exit(1)
+    in_process = args.batch or args.watch or args.preview
+    backend = args.backend or ("torch" if in_process else "cli")
+    if backend == "cli" and in_process:
+        in_process_backends = [name for name in SEPARATION_BACKENDS if name != "cli"]
+        print("Error: --batch, --watch and --preview separate in-process; use --backend "
+              f"{', '.join(in_process_backends[:-1])} or {in_process_backends[-1]}.")
+        sys.exit(1)
+    if backend != "cli" and not in_process:
+        print(f"Error: --backend {backend} separates in-process; add --batch, --watch or --preview.")
+        sys.exit(1)
+    if backend in ("compiled", "onnx") and args.precision != "fp32":
+        print("Error: --precision only applies to the torch backend.")
+        sys.exit(1)
+
+    if args.benchmark_workers:
+        sys.exit(0 if run_worker_benchmark(input_folder, args.segment_seconds) else 1)
+
+    cache = None
+    if not args.no_cache and not SeparationCache.supports_plan(plan):
+        print("Note: Separation cache skipped, it only stores vocals-only MP3 output plans.")
+    elif not args.no_cache:
+        try:
+            cache = SeparationCache(args.cache_dir or get_default_cache_dir(), args.cache_max_mb * 1024 * 1024,
+                                    precision=args.precision, backend=backend, windowed=args.windowed,
+                                    skip_silence=args.skip_silence)
+        except OSError as e:
+            print(f"Warning: Separation cache disabled, could not create it: {e}")
+
+    if args.watch:
+        if args.jobs != 1:
+            print("Error: --watch separates one track at a time; use --workers to split tracks instead of --jobs.")
+            sys.exit(1)
+        sys.exit(0 if run_watch(input_folder, output_directory, plan, cache=cache, stream=args.stream,
+                                workers=args.workers, segment_seconds=args.segment_seconds,
+                                precision=args.precision, backend=backend, windowed=args.windowed,
+                                skip_silence=args.skip_silence, pitch=not args.no_pitch,
+                                peaks=not args.no_peaks) else 1)
+
+    if args.batch:
+        sys.exit(0 if run_batch(input_folder, output_directory, plan, cache=cache, stream=args.stream,
+                           workers=args.workers, segment_seconds=args.segment_seconds, jobs=args.jobs,
+                           precision=args.precision, backend=backend, windowed=args.windowed,
+                           skip_silence=args.skip_silence, pitch=not args.no_pitch,
+                           peaks=not args.no_peaks) else 1)
+
+    input_audio_file = find_first_audio(input_folder, get_ffmpeg_exe_path())
+    if not input_audio_file:
+        print(f"Error: No audio file found in the '{input_folder}' directory.")
+        sys.exit(1)
+
+    print(f"Found input: {input_audio_file}")
+    print(f"Output directory: {output_directory}")
+    print(f"Output plan: {describe_output_plan(plan)}")
+
+    # Path where Demucs is expected to place WAV files, according to user's script
+    demucs_output_wav_folder = os.path.join(output_directory, DEMUCS_MODEL_NAME)
+    input_track_name = os.path.splitext(os.path.basename(input_audio_file))[0]
+    vocals_mp3_path = os.path.join(demucs_output_wav_folder, f"{input_track_name} [{TWO_STEMS}].mp3")
+
+    # An interrupted earlier run may have left this track separated or encoded already
+    manifest = JobManifest(os.path.join(output_directory, JOB_MANIFEST_NAME))
+    resume_state = manifest.resume_state(input_audio_file)
+
+    cache_key = None
+    if cache and resume_state is None:
+        cache_key = cache.key_for(input_audio_file, get_ffmpeg_exe_path(), plan[TWO_STEMS]["bitrate"])
+        os.makedirs(demucs_output_wav_folder, exist_ok=True)
+        if cache_key and cache.restore(cache_key, vocals_mp3_path):
+            print(f"\n--- Cache hit: restored {os.path.basename(vocals_mp3_path)} without running Demucs ---")
+            if not args.no_pitch:
+                write_vocal_pitch(demucs_output_wav_folder, input_track_name, plan, get_ffmpeg_exe_path())
+            if not args.no_peaks:
+                write_track_peaks(demucs_output_wav_folder, input_track_name, plan, input_audio_file,
+                                  get_ffmpeg_exe_path())
+            if not report_progress("done", 1.0, track=os.path.basename(input_audio_file), cached=True):
+                print("Progress: 100%")
+            remove_processed_input(input_audio_file)
+            cache.print_report()
+            print(f"\n--- Processing Finished ---")
+            print(f"Check the '{demucs_output_wav_folder}' (inside '{output_directory}') for remaining MP3 files.")
+            return
+
+    if args.preview and resume_state is None:
+        succeeded = run_progressive(input_audio_file, demucs_output_wav_folder, plan, args.preview_seconds,
+                                    manifest, cache=cache, cache_key=cache_key, precision=args.precision,
+                                    backend=backend, pitch=not args.no_pitch, peaks=not args.no_peaks)
+        if cache:
+            cache.print_report()
+        print(f"\n--- Processing Finished ---")
+        sys.exit(0 if succeeded else 1)
+
+    # Use demucs from venv
+    demucs_exe_path = get_demucs_exe_path()
+
+    if not os.path.isfile(demucs_exe_path):
+        print(f"Error: demucs executable not found at {demucs_exe_path}")
+        print("Please ensure Demucs is installed in the venv.")
+        sys.exit(1)
+
+    demucs_command = [
+        demucs_exe_path,
+        f"--two-stems={TWO_STEMS}",
+        input_audio_file,
+        "-o", output_directory,
+        "--filename", "{track} [{stem}].{ext}"
+    ]
+    if f"no_{TWO_STEMS}" not in plan:
+        # Don't even write the complement stem when nobody asked for it
+        demucs_command.insert(2, "--other-method=none")
+    # Prepare the environment for the subprocess
+    custom_env = os.environ.copy()
+    if sys.platform == "win32":
+        # Force absolute path so TorchCodec doesn't guess
+        custom_env["TORCHCODEC_FFMPEG_DIR"] = abs_ffmpeg_dir
+        # Put it at the front of PATH so 'ffmpeg' is found here first
+        custom_env["PATH"] = abs_ffmpeg_dir + os.pathsep + custom_env.get("PATH", "")
+    # Demucs runs alone here, so let torch use exactly the cores the encoders will later share
+    global _cpu_budget
+    _cpu_budget = CpuBudget()
+    for thread_variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        custom_env.setdefault(thread_variable, str(budget_cores()))
+
+    # Estimate the whole job from earlier runs on this machine before Demucs starts
+    global _job_eta
+    eta_predictor = EtaPredictor(get_default_history_path(), "cli", CLI_ETA_STAGES)
+    track_audio_seconds = probe_audio_seconds(input_audio_file, get_ffmpeg_exe_path())
+    if track_audio_seconds and resume_state is None:
+        _job_eta = JobEta(eta_predictor.predict(track_audio_seconds))
+        print(f"Estimated processing time: {_job_eta.total():.0f}s for {track_audio_seconds:.0f}s of audio")
+        report_progress("estimate", 1.0, track=os.path.basename(input_audio_file),
+                        audio_seconds_total=track_audio_seconds, job_eta_seconds=round(_job_eta.total(), 1))
+    stage_seconds = {}
+
+    separation_start = time.time()
+    if resume_state is None:
+        demucs_succeeded = run_demucs_cli(demucs_command, custom_env, track=os.path.basename(input_audio_file))
+        stage_seconds["separate"] = time.time() - separation_start
+        if demucs_succeeded:
+            manifest.advance(input_audio_file, "separated",
+                             outputs=separated_wav_paths(demucs_output_wav_folder, input_track_name, plan))
     else:
-        print(f"Input folder '{input_folder}' not found for cleanup (this shouldn't happen if script started correctly).")
+        print(f"\n--- Resuming: {os.path.basename(input_audio_file)} was already {resume_state}, skipping Demucs ---")
+        demucs_succeeded = True
 
     if not demucs_succeeded:
+        # The input stays where it is so the next run retries it
+        manifest.record_error(input_audio_file, "Demucs processing failed")
         print("Exiting due to Demucs processing failure.")
-        sys.exit(1) # Exit if Demucs failed, after attempting input cleanup
+        sys.exit(1)
 
 
     # --- BEGIN FFMPEG CONVERSION --- (Only if Demucs succeeded)
-    print("\n--- Starting WAV to MP3 conversion (320kbps) ---")
-    
-    # Path where Demucs is expected to place WAV files, according to user's script
-    demucs_output_wav_folder = os.path.join(output_directory,"htdemucs")
-    wav_files_to_convert = glob.glob(os.path.join(demucs_output_wav_folder, "*.wav"))
-    
-    if not wav_files_to_convert:
-        print(f"No .wav files found in '{demucs_output_wav_folder}' for conversion.")
+    planned_outputs = planned_output_paths(demucs_output_wav_folder, input_track_name, plan)
+    if resume_state in ("encoded", "finalized"):
+        print(f"\n--- Planned outputs already produced ({describe_output_plan(plan)}) ---")
     else:
-        num_wav_files = len(wav_files_to_convert)
-        print(f"Found {num_wav_files} .wav file(s) for conversion in '{demucs_output_wav_folder}':")
-
-        tasks = []
-        for wav_file in wav_files_to_convert:
-            mp3_file_name = os.path.splitext(os.path.basename(wav_file))[0] + ".mp3"
-            mp3_file_path = os.path.join(os.path.dirname(wav_file), mp3_file_name) # MP3 in same dir as WAV
-            tasks.append({"wav_path": wav_file, "mp3_path": mp3_file_path})
-        
-        converted_count = 0
-        failed_count = 0
-        
-        num_workers = os.cpu_count() or 1
-        if sys.platform == "win32":
-            ffmpeg_exe_path = os.path.join(abs_ffmpeg_dir, "ffmpeg.exe")
-        else:
-            ffmpeg_exe_path = "ffmpeg"
-        print(f"\nConverting {num_wav_files} file(s) using up to {num_workers} parallel ffmpeg process(es)...")
+        print(f"\n--- Producing planned outputs ({describe_output_plan(plan)}) ---")
+        report_progress("encode", 0.0, track=os.path.basename(input_audio_file))
+        encode_start = time.time()
+        converted_count, failed_count = finalize_stem_wavs(demucs_output_wav_folder, input_track_name, plan,
+                                                           get_ffmpeg_exe_path())
+        stage_seconds["encode"] = time.time() - encode_start
+        report_progress("encode", 1.0, track=os.path.basename(input_audio_file))
+        if failed_count:
+            manifest.record_error(input_audio_file, f"{failed_count} output conversion(s) failed")
+            print("Exiting due to failed conversions; the input is kept for a retry.")
+            sys.exit(1)
+        manifest.advance(input_audio_file, "encoded", outputs=planned_outputs)
 
-        with ThreadPoolExecutor(max_workers=num_workers) as executor:
-            future_to_task = {
-                executor.submit(convert_wav_to_mp3, task["wav_path"], task["mp3_path"], ffmpeg_path=ffmpeg_exe_path): task
-                for task in tasks
-            }
+    finalize_start = time.time()
+    if not args.no_pitch:
+        write_vocal_pitch(demucs_output_wav_folder, input_track_name, plan, get_ffmpeg_exe_path())
+    if not args.no_peaks:
+        write_track_peaks(demucs_output_wav_folder, input_track_name, plan, input_audio_file, get_ffmpeg_exe_path())
+    if remove_processed_input(input_audio_file):
+        manifest.advance(input_audio_file, "finalized", outputs=planned_outputs)
+    stage_seconds["finalize"] = time.time() - finalize_start
+    report_progress("done", 1.0, track=os.path.basename(input_audio_file))
+    if track_audio_seconds and set(stage_seconds) == set(CLI_ETA_STAGES):
+        eta_predictor.record(track_audio_seconds, stage_seconds)
+        if _job_eta:
+            print(f"Processing took {sum(stage_seconds.values()):.0f}s (estimated {_job_eta.total():.0f}s)")
 
-            for i, future in enumerate(as_completed(future_to_task)):
-                task_info = future_to_task[future]
-                wav_path_basename = os.path.basename(task_info["wav_path"])
-                current_progress_prefix = f"  ({i+1}/{num_wav_files})"
-                try:
-                    success, result_message = future.result()
-                    if success:
-                        mp3_basename = result_message
-                        print(f"{current_progress_prefix} SUCCESS: {wav_path_basename} -> {mp3_basename}")
-                        converted_count += 1
-                        
-                        # --- WAV DELETION --- (Requirement 3)
-                        try:
-                            os.remove(task_info["wav_path"])
-                            print(f"    SUCCESS: Deleted source WAV: {wav_path_basename}")
-                        except OSError as e:
-                            print(f"    WARNING: Could not delete source WAV {wav_path_basename}: {e}")
-                    else:
-                        error_details = result_message
-                        print(f"{current_progress_prefix} FAILED converting {wav_path_basename}:")
-                        for line in error_details.splitlines():
-                            print(f"    {line}")
-                        failed_count += 1
-                except Exception as exc:
-                    print(f"{current_progress_prefix} FAILED (unexpected exception) converting {wav_path_basename}: {exc}")
-                    failed_count += 1
-        
-        print("\n--- MP3 Conversion Summary ---")
-        print(f"Total WAV files found: {num_wav_files}")
-        print(f"Successfully converted to MP3: {converted_count}")
-        print(f"Failed conversions: {failed_count}")
-
-        if failed_count > 0:
-            print("\nPlease review error messages for failed conversions.")
-        elif converted_count == 0 and num_wav_files > 0:
-             print("No WAV files were successfully converted to MP3.")
-        elif converted_count > 0:
-             print("All found WAV files converted to MP3 successfully (and originals deleted).")
-
-        # --- NO_VOCALS MP3 DELETION --- (Requirement 4)
-        print("\n--- Deleting [no_vocals].mp3 files ---")
-        no_vocals_pattern = os.path.join(demucs_output_wav_folder, "*[no_vocals].mp3")
-        no_vocals_files_to_delete = glob.glob(no_vocals_pattern)
-
-        if not no_vocals_files_to_delete:
-            print(f"No '*[no_vocals].mp3' files found in '{demucs_output_wav_folder}' to delete.")
-        else:
-            deleted_no_vocals_count = 0
-            for file_path in no_vocals_files_to_delete:
-                try:
-                    os.remove(file_path)
-                    print(f"Deleted: {os.path.basename(file_path)}")
-                    deleted_no_vocals_count += 1
-                except OSError as e:
-                    print(f"Warning: Could not delete '{os.path.basename(file_path)}': {e}")
-            print(f"Found {len(no_vocals_files_to_delete)} '*[no_vocals].mp3' file(s), successfully deleted {deleted_no_vocals_count}.")
+    if cache:
+        if cache_key and os.path.exists(vocals_mp3_path):
+            cache.store(cache_key, vocals_mp3_path, time.time() - separation_start)
+        cache.print_report()
     
     print(f"\n--- Processing Finished ---")
     print(f"Check the '{demucs_output_wav_folder}' (inside '{output_directory}') for remaining MP3 files.")
@@ -0,0 +1,300 @@
+import json
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import main
+
+# Demucs-like segment settings at a low sample rate, so the arrays stay small
+SAMPLERATE = 8000
+CHUNK_SAMPLES = int(7.8 * SAMPLERATE)
+SHIFT_SAMPLES = SAMPLERATE // 2
+CROSSFADE_SAMPLES = SAMPLERATE
+SEGMENT_SAMPLES = 60 * SAMPLERATE
+
+
+# --- Output plans ---
+
+def test_default_output_plan_keeps_only_vocals_as_mp3():
+    assert main.parse_output_plan(main.DEFAULT_OUTPUT_PLAN) == {
+        main.TWO_STEMS: {"format": "mp3", "bitrate": main.MP3_BITRATE},
+    }
+
+
+def test_output_plan_keeps_order_and_fills_in_defaults():
+    plan = main.parse_output_plan(" no_vocals : WAV , vocals:ogg")
+
+    assert list(plan) == ["no_vocals", "vocals"]
+    assert plan["no_vocals"] == {"format": "wav", "bitrate": None}
+    assert plan["vocals"] == {"format": "ogg", "bitrate": main.OUTPUT_PROFILES["ogg"]["bitrate"]}
+    assert main.parse_output_plan("vocals:mp3:128K")["vocals"]["bitrate"] == "128k"
+    assert main.parse_output_plan("vocals")["vocals"] == {"format": "mp3", "bitrate": main.MP3_BITRATE}
+
+
+@pytest.mark.parametrize("spec", [
+    "",
+    "vocals,",
+    "drums",
+    "vocals,vocals:wav",
+    "vocals:flac",
+    "vocals:mp3:7k",
+    "vocals:mp3:321k",
+    "vocals:mp3:128",
+    "vocals:wav:128k",
+    "vocals:mp3:128k:extra",
+])
+def test_invalid_output_plans_are_rejected(spec):
+    with pytest.raises(ValueError):
+        main.parse_output_plan(spec)
+
+
+# --- Segments ---
+
+def segments_for(length):
+    return main.plan_segments(length, SEGMENT_SAMPLES, CHUNK_SAMPLES, SHIFT_SAMPLES, CROSSFADE_SAMPLES)
+
+
+@pytest.mark.parametrize("length", [1, SEGMENT_SAMPLES // 2, SEGMENT_SAMPLES, SEGMENT_SAMPLES + 1,
+                                    5 * SEGMENT_SAMPLES + 1234])
+def test_segments_cover_the_track_on_the_chunk_grid(length):
+    bounds, fades = segments_for(length)
+    stride, head, tail = main.segment_margins(CHUNK_SAMPLES, SHIFT_SAMPLES)
+
+    assert bounds[0][0] == 0 and bounds[-1][1] == length
+    assert len(fades) == len(bounds) - 1
+    for (start, end), (next_start, next_end), (fade_start, fade_end) in zip(bounds, bounds[1:], fades):
+        assert next_start % stride == 0
+        assert end - start == SEGMENT_SAMPLES
+        # Both neighbours computed every crossfaded sample from complete chunks
+        assert next_start + head <= fade_start < fade_end <= end - tail
+        assert fade_end - fade_start >= CROSSFADE_SAMPLES
+
+
+def test_segments_shorter_than_the_model_needs_are_rejected():
+    with pytest.raises(ValueError):
+        main.plan_segments(10 * SEGMENT_SAMPLES, CHUNK_SAMPLES, CHUNK_SAMPLES, SHIFT_SAMPLES, CROSSFADE_SAMPLES)
+
+
+@pytest.mark.parametrize("length", [SEGMENT_SAMPLES // 2, SEGMENT_SAMPLES + 1, 5 * SEGMENT_SAMPLES + 1234])
+def test_identity_model_segments_stitch_back_to_the_input_exactly(length):
+    audio = np.random.default_rng(0).standard_normal((2, length)).astype(np.float32)
+    bounds, fades = segments_for(length)
+
+    stitched = main.stitch_segments([audio[None, :, start:end] for start, end in bounds], bounds, fades, length)
+
+    assert stitched.shape == (1, 2, length)
+    np.testing.assert_array_equal(stitched[0], audio)
+
+
+def test_stitching_ignores_segment_edges_outside_the_crossfades():
+    length = 3 * SEGMENT_SAMPLES
+    audio = np.random.default_rng(1).standard_normal((2, length)).astype(np.float32)
+    bounds, fades = segments_for(length)
+    outputs = []
+    for index, (start, end) in enumerate(bounds):
+        output = audio[None, :, start:end].copy()
+        # What a single segment gets wrong at its edges must never reach the result
+        if index > 0:
+            output[..., :fades[index - 1][0] - start] = 100.0
+        if index < len(bounds) - 1:
+            output[..., fades[index][1] - start:] = -100.0
+        outputs.append(output)
+
+    np.testing.assert_array_equal(main.stitch_segments(outputs, bounds, fades, length)[0], audio)
+
+
+def test_preview_segments_stitch_back_to_the_input_exactly():
+    length = 3 * SEGMENT_SAMPLES
+    audio = np.random.default_rng(2).standard_normal((2, length)).astype(np.float32)
+    bounds, fades = main.plan_preview_segments(length, 10 * SAMPLERATE, CHUNK_SAMPLES, SHIFT_SAMPLES,
+                                               CROSSFADE_SAMPLES)
+
+    assert len(bounds) == 2
+    stitched = main.stitch_segments([audio[None, :, start:end] for start, end in bounds], bounds, fades, length)
+    np.testing.assert_array_equal(stitched[0], audio)
+
+
+# --- Job manifest ---
+
+@pytest.fixture
+def track(tmp_path):
+    input_file = tmp_path / "input" / "song.flac"
+    input_file.parent.mkdir()
+    input_file.write_bytes(b"audio")
+    output = tmp_path / "song [vocals].mp3"
+    output.write_bytes(b"mp3")
+    return str(input_file), str(output), str(tmp_path / "manifest.json")
+
+
+def test_manifest_resumes_from_the_last_state_after_reloading(track):
+    input_file, output, manifest_path = track
+    manifest = main.JobManifest(manifest_path)
+    manifest.advance(input_file, "queued")
+    assert main.JobManifest(manifest_path).resume_state(input_file) is None
+
+    manifest.advance(input_file, "encoded", outputs=[output])
+
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        assert json.load(f)["version"] == main.JOB_MANIFEST_VERSION
+    assert main.JobManifest(manifest_path).resume_state(input_file) == "encoded"
+
+
+def test_manifest_starts_over_when_the_input_or_its_outputs_changed(track):
+    input_file, output, manifest_path = track
+    manifest = main.JobManifest(manifest_path)
+    manifest.advance(input_file, "encoded", outputs=[output])
+
+    with open(input_file, "ab") as f:
+        f.write(b" replaced")
+    assert main.JobManifest(manifest_path).resume_state(input_file) is None
+
+    manifest.advance(input_file, "encoded", outputs=[output])
+    os.remove(output)
+    assert main.JobManifest(manifest_path).resume_state(input_file) is None
+
+
+def test_manifest_errors_keep_the_last_good_state(track):
+    input_file, output, manifest_path = track
+    manifest = main.JobManifest(manifest_path)
+    manifest.advance(input_file, "separated", outputs=[output])
+
+    manifest.record_error(input_file, "encode failed")
+
+    entry = main.JobManifest(manifest_path).tracks[os.path.basename(input_file)]
+    assert entry["state"] == "separated"
+    assert entry["error"] == "encode failed"
+    with pytest.raises(ValueError):
+        manifest.advance(input_file, "published")
+
+
+def test_manifest_forgets_finalized_tracks_whose_input_is_gone(track):
+    input_file, output, manifest_path = track
+    main.JobManifest(manifest_path).advance(input_file, "finalized", outputs=[output])
+
+    assert os.path.basename(input_file) in main.JobManifest(manifest_path).tracks
+    os.remove(input_file)
+    assert main.JobManifest(manifest_path).tracks == {}
+
+
+# --- Separation cache ---
+
+def store_entry(cache, folder, key, size, mtime):
+    vocals = os.path.join(folder, f"{key}.mp3")
+    with open(vocals, "wb") as f:
+        f.write(b"\0" * size)
+    cache.store(key, vocals, separation_seconds=1.0)
+    os.utime(cache._entry_path(key), (mtime, mtime))
+
+
+def test_cache_evicts_least_recently_used_entries_over_the_quota(tmp_path):
+    cache = main.SeparationCache(str(tmp_path / "cache"), max_bytes=2500)
+    store_entry(cache, str(tmp_path), "a", 1000, mtime=1000)
+    store_entry(cache, str(tmp_path), "b", 1000, mtime=2000)
+    # A hit makes "a" the most recently used entry
+    assert cache.restore("a", str(tmp_path / "restored.mp3"))
+
+    store_entry(cache, str(tmp_path), "c", 1000, mtime=os.path.getmtime(cache._entry_path("a")) + 1)
+
+    assert os.path.exists(cache._entry_path("a"))
+    assert not os.path.exists(cache._entry_path("b"))
+    assert not os.path.exists(cache._entry_path("b")[:-len(".mp3")] + ".json")
+    assert os.path.exists(cache._entry_path("c"))
+    assert cache._load_stats()["evictions"] == 1
+    assert not cache.restore("b", str(tmp_path / "restored.mp3"))
+
+
+def test_cache_keeps_everything_within_the_quota(tmp_path):
+    cache = main.SeparationCache(str(tmp_path / "cache"), max_bytes=3000)
+    for index, key in enumerate("abc"):
+        store_entry(cache, str(tmp_path), key, 1000, mtime=1000 + index)
+
+    assert all(os.path.exists(cache._entry_path(key)) for key in "abc")
+    assert "evictions" not in cache._load_stats()
+
+
+def test_cache_keys_depend_on_the_mp3_encoder(tmp_path, monkeypatch):
+    pytest.importorskip("lameenc")
+    cache = main.SeparationCache(str(tmp_path / "cache"), max_bytes=1000)
+    input_file = tmp_path / "song.flac"
+    input_file.write_bytes(b"audio")
+    audio = np.zeros((2, 1000), dtype=np.float32)
+
+    def key(encoder, bitrate="320k"):
+        monkeypatch.setattr(main, "_mp3_encoder", encoder)
+        return cache.key_for(str(input_file), "ffmpeg", bitrate, audio=audio, samplerate=44100)
+
+    assert key("lame") == key("lame")
+    assert key("lame") != key("ffmpeg")
+    # LAME leaves bitrates outside MPEG-1 to ffmpeg, so those share the ffmpeg key
+    assert key("lame", "8k") == key("ffmpeg", "8k")
+
+
+# --- Pitch ---
+
+@pytest.mark.parametrize("frequency", [82.4, 220.0, 440.0, 880.0])
+def test_yin_tracks_a_steady_tone(frequency):
+    seconds = 1.0
+    time = np.arange(int(seconds * main.PITCH_SAMPLERATE)) / main.PITCH_SAMPLERATE
+    samples = 0.5 * np.sin(2 * np.pi * frequency * time) + 0.2 * np.sin(4 * np.pi * frequency * time)
+
+    f0, confidence, hop, window = main.yin_pitch_contour(samples)
+
+    assert hop == round(main.PITCH_HOP_SECONDS * main.PITCH_SAMPLERATE)
+    assert window == round(main.PITCH_WINDOW_SECONDS * main.PITCH_SAMPLERATE)
+    assert len(f0) == len(confidence) == len(samples) // hop + 1
+    # Frames away from the edges, where the window is full of tone
+    steady = slice(window // hop + 1, -(window // hop + 1))
+    np.testing.assert_allclose(f0[steady], frequency, rtol=0.005)
+    assert confidence[steady].min() > 0.9
+
+
+def test_yin_reports_silence_and_noise_as_unvoiced():
+    rng = np.random.default_rng(0)
+    silence = np.zeros(main.PITCH_SAMPLERATE)
+    noise = rng.standard_normal(main.PITCH_SAMPLERATE) * 0.3
+
+    f0, confidence, _, _ = main.yin_pitch_contour(silence)
+    assert not f0.any() and not confidence.any()
+    f0, _, _, _ = main.yin_pitch_contour(noise)
+    assert (f0 == 0).mean() > 0.9
+
+
+# --- Peaks ---
+
+def test_peak_pyramid_levels_reduce_down_to_one_peak():
+    frames = np.random.default_rng(0).uniform(-0.9, 0.9, (100_000, 2)).astype(np.float32)
+
+    length, levels = main.peak_pyramid(frames)
+
+    assert length == len(frames)
+    assert len(levels[0]) == -(-len(frames) // main.PEAKS_BASE_SAMPLES)
+    assert len(levels[-1]) == 1
+    for finer, coarser in zip(levels, levels[1:]):
+        assert len(coarser) == -(-len(finer) // main.PEAKS_LEVEL_FACTOR)
+        for index, (low, high) in enumerate(coarser):
+            group = finer[index * main.PEAKS_LEVEL_FACTOR:(index + 1) * main.PEAKS_LEVEL_FACTOR]
+            assert low == group[:, 0].min() and high == group[:, 1].max()
+
+
+def test_peak_pyramid_base_level_bounds_every_sample():
+    frames = np.random.default_rng(1).uniform(-1.2, 1.2, (10 * main.PEAKS_BASE_SAMPLES + 7, 2)).astype(np.float32)
+
+    _, levels = main.peak_pyramid(frames)
+
+    for index, (low, high) in enumerate(levels[0]):
+        block = np.clip(frames[index * main.PEAKS_BASE_SAMPLES:(index + 1) * main.PEAKS_BASE_SAMPLES], -1.0, 1.0)
+        assert low == np.floor(block.min() * 127) and high == np.ceil(block.max() * 127)
+    assert levels[-1].tolist() == [[-127, 127]]
+
+
+def test_peak_pyramid_pads_and_cuts_to_a_length():
+    frames = np.full((3 * main.PEAKS_BASE_SAMPLES + 10, 2), 0.5, dtype=np.float32)
+
+    length, levels = main.peak_pyramid(frames, length=6 * main.PEAKS_BASE_SAMPLES)
+    assert length == 6 * main.PEAKS_BASE_SAMPLES
+    assert levels[0].tolist() == [[63, 64]] * 3 + [[0, 64]] + [[0, 0]] * 2
+
+    _, levels = main.peak_pyramid(frames, length=2 * main.PEAKS_BASE_SAMPLES)
+    assert levels[0].tolist() == [[63, 64]] * 2
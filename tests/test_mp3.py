@@ -0,0 +1,85 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import main
+
+requires_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+
+PLAN_BITRATES_KBPS = (8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+
+
+def noise_pcm(samplerate, channels, seconds=1.5, seed=0):
+    rng = np.random.default_rng(seed)
+    return (rng.standard_normal((int(samplerate * seconds), channels)) * 3000).astype("<i2")
+
+
+def decode_pcm16(path, channels):
+    output = subprocess.run(["ffmpeg", "-v", "error", "-i", str(path), "-f", "s16le", "-ac", str(channels), "-"],
+                            capture_output=True, check=True).stdout
+    return np.frombuffer(output, dtype="<i2").reshape(-1, channels)
+
+
+def mp3_samplerate(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    # The first frame after the Info frame is the first audio frame
+    header = data[main.mp3_frame_size(data[:4]):][:4]
+    return main.MP3_SAMPLERATES[(header[2] >> 2) & 3]
+
+
+@pytest.fixture
+def lame(monkeypatch):
+    pytest.importorskip("lameenc")
+    monkeypatch.setattr(main, "_mp3_encoder", "lame")
+
+
+@requires_ffmpeg
+@pytest.mark.parametrize("samplerate", [44100, 32000])
+@pytest.mark.parametrize("kbps", PLAN_BITRATES_KBPS)
+def test_every_plan_bitrate_encodes_to_the_input_length(tmp_path, lame, samplerate, kbps):
+    plan = main.parse_output_plan(f"vocals:mp3:{kbps}k")
+    pcm = noise_pcm(samplerate, 2)
+    wav_path = str(tmp_path / "stem.wav")
+    mp3_path = str(tmp_path / "stem.mp3")
+    main.write_pcm16_wav(wav_path, pcm, samplerate)
+
+    success, message = main.encode_wav(wav_path, mp3_path, plan["vocals"])
+
+    assert success, message
+    assert len(decode_pcm16(mp3_path, 2)) == len(pcm)
+
+
+@requires_ffmpeg
+@pytest.mark.parametrize("samplerate", [44100, 32000])
+@pytest.mark.parametrize("channels", [1, 2])
+@pytest.mark.parametrize("kbps", main.MP3_BITRATES_KBPS[1:])
+def test_lameenc_keeps_the_input_samplerate(tmp_path, lame, samplerate, channels, kbps):
+    assert main.lame_can_encode(samplerate, channels, f"{kbps}k")
+    pcm = noise_pcm(samplerate, channels)
+    mp3_path = str(tmp_path / "stem.mp3")
+
+    success, message = main.lame_encode_blocks(iter([pcm.tobytes()]), samplerate, channels, mp3_path, f"{kbps}k")
+
+    assert success, message
+    assert mp3_samplerate(mp3_path) == samplerate
+    assert len(decode_pcm16(mp3_path, channels)) == len(pcm)
+
+
+def test_lameenc_rejects_bitrates_outside_mpeg1(lame):
+    assert not main.lame_can_encode(44100, 2, "8k")
+    assert not main.lame_can_encode(22050, 2, "128k")
+
+
+def test_failed_lameenc_encode_leaves_no_file(tmp_path, lame):
+    mp3_path = str(tmp_path / "empty.mp3")
+
+    success, message = main.lame_encode_blocks(iter([]), 44100, 2, mp3_path)
+
+    assert not success
+    assert "no samples" in message
+    assert not os.path.exists(mp3_path)
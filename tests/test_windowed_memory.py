@@ -0,0 +1,78 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("demucs")
+
+import main
+
+requires_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+
+SHORT_SECONDS = 120
+LONG_SECONDS = 1800
+
+
+class VocalsPassthroughModel(torch.nn.Module):
+    """Stands in for Demucs under apply_model(): returns the mix as the vocals and silence for the rest."""
+
+    samplerate = main.DEMUCS_SAMPLERATE
+    audio_channels = main.DEMUCS_CHANNELS
+    sources = ["drums", "bass", "other", "vocals"]
+    segment = 7.8
+
+    def forward(self, mix):
+        sources = torch.zeros(mix.shape[0], len(self.sources), *mix.shape[1:], dtype=mix.dtype)
+        sources[:, self.sources.index("vocals")] = mix
+        return sources
+
+
+def separate_in_child(input_file, folder):
+    """Runs this file as a script on `input_file` in a fresh process and returns its peak RSS in bytes."""
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.run([sys.executable, os.path.abspath(__file__), input_file, folder],
+                             capture_output=True, text=True, check=True, env=dict(os.environ, PYTHONPATH=repo_root))
+    return int(process.stdout.split()[-1])
+
+
+def synthetic_track(folder, seconds):
+    # Generated by ffmpeg straight to FLAC, so the fixture never sits in this process's RAM
+    path = os.path.join(folder, f"synthetic-{seconds}.flac")
+    subprocess.run([
+        "ffmpeg", "-v", "error",
+        "-f", "lavfi", "-i", f"sine=frequency=220:sample_rate={main.DEMUCS_SAMPLERATE}:duration={seconds}",
+        "-f", "lavfi", "-i", f"anoisesrc=color=pink:amplitude=0.1:seed=1234:sample_rate={main.DEMUCS_SAMPLERATE}"
+                             f":duration={seconds}",
+        "-filter_complex", "amix=inputs=2,aformat=channel_layouts=stereo",
+        path, "-y",
+    ], check=True)
+    return path
+
+
+@requires_ffmpeg
+def test_windowed_peak_rss_does_not_grow_with_track_length(tmp_path):
+    peaks = {}
+    for seconds in (SHORT_SECONDS, LONG_SECONDS):
+        input_file = synthetic_track(str(tmp_path), seconds)
+        peaks[seconds] = separate_in_child(input_file, str(tmp_path))
+        vocals = main.stem_output_path(str(tmp_path), main.track_name_for(input_file), "vocals",
+                                       main.parse_output_plan("vocals:wav"))
+        assert main.probe_audio_seconds(vocals) == pytest.approx(seconds, abs=0.1)
+
+    # Holding the whole long track would add its decoded float32 samples to the peak; allocator
+    # noise between two runs stays well under half of that
+    extra_track_bytes = (LONG_SECONDS - SHORT_SECONDS) * main.DEMUCS_SAMPLERATE * main.DEMUCS_CHANNELS * 4
+    assert peaks[LONG_SECONDS] - peaks[SHORT_SECONDS] < extra_track_bytes / 2
+
+
+if __name__ == "__main__":
+    # Run by separate_in_child(): separates one file with --windowed and prints the peak RSS
+    input_file, folder = sys.argv[1:]
+    result = main.new_track_result(input_file)
+    main.separate_track_windowed(VocalsPassthroughModel(), input_file, folder, "ffmpeg",
+                                 main.parse_output_plan("vocals:wav"), result)
+    assert result["ok"], result["error"]
+    print(main.peak_rss_bytes())
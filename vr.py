@@ -139,6 +139,19 @@ def focus_window_by_title_substring(substring):
 
     return found
 
+def is_audio_file(path):
+    """Asks ffmpeg whether it can decode audio from the file, so any format works whatever its extension"""
+    if sys.platform == 'win32':
+        ffmpeg = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "vocalremover", "ffmpeg_lib", "ffmpeg.exe")
+    else:
+        ffmpeg = "ffmpeg"
+    try:
+        result = subprocess.run([ffmpeg, "-hide_banner", "-i", path], capture_output=True, text=True, errors="replace")
+    except OSError:
+        # Without ffmpeg to ask, leave it to the site to reject what it can't read
+        return True
+    return " Audio: " in result.stderr
+
 start_time = time.time()
 
 # --- Set download_dir automatically ---
@@ -178,17 +191,19 @@ if not os.path.isdir(input_dir):
     driver.quit()
     exit(1)
 
-wav_files = [f for f in os.listdir(input_dir) if f.lower().endswith('.mp3')]
+wav_files = [f for f in sorted(os.listdir(input_dir))
+             if not f.startswith('.') and os.path.isfile(os.path.join(input_dir, f))
+             and is_audio_file(os.path.join(input_dir, f))]
 if not wav_files:
-    print("No .wav file found in the 'input' folder.")
+    print("No audio file found in the 'input' folder.")
     driver.quit()
     exit(1)
 elif len(wav_files) > 1:
-    # pick the most recently created .mp3 and remove the others
+    # pick the most recently created audio file and remove the others
     full_paths = [os.path.join(input_dir, f) for f in wav_files]
     most_recent = max(full_paths, key=os.path.getctime)
     chosen = os.path.basename(most_recent)
-    safe_print(f"More than one .mp3 file found in 'input'; selecting most recently created: {chosen}")
+    safe_print(f"More than one audio file found in 'input'; selecting most recently created: {chosen}")
     for p in full_paths:
         if p != most_recent:
             try:
@@ -286,7 +301,9 @@ if downloaded_file:
     downloaded_filepath = os.path.join(download_dir, downloaded_file)
 
     original_filename = wav_files[0]
-    base_name, ext = os.path.splitext(original_filename)
+    base_name = os.path.splitext(original_filename)[0]
+    # The site always returns MP3, whatever format was uploaded
+    ext = os.path.splitext(downloaded_file)[1]
     new_filename = f"{base_name} [vocals]{ext}"
     new_filepath = os.path.join(download_dir, new_filename)
 
@@ -345,7 +362,8 @@ if downloaded_file:
     downloaded_filepath = os.path.join(download_dir, downloaded_file)
 
     original_filename = wav_files[0]
-    base_name, ext = os.path.splitext(original_filename)
+    base_name = os.path.splitext(original_filename)[0]
+    ext = os.path.splitext(downloaded_file)[1]
     new_filename = f"{base_name} [no_vocals]{ext}"
     new_filepath = os.path.join(download_dir, new_filename)
 